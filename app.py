@@ -1,15 +1,44 @@
 import os
 import time
 import json
+import re
 import random
+import heapq
+import bisect
+import math
+import itertools
 import threading
+import atexit
+import sqlite3
+import uuid
+import socket
+import zlib
+import base64
+import hashlib
+from urllib.parse import quote
+from collections import OrderedDict, deque
+import shutil
+import subprocess
 import mimetypes
+from concurrent.futures import ThreadPoolExecutor
 import yt_dlp
+from yt_dlp.extractor.youtube import YoutubeIE
+from yt_dlp.utils import DownloadCancelled
 import tempfile
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory, Response, redirect
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, Response, redirect
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.http import http_date
 from mutagen import File as MutagenFile
+try:
+    from PIL import Image, features as image_features
+except ImportError:
+    Image = None # Art is served at its original size without Pillow
+try:
+    import numpy as np
+except ImportError:
+    np = None # Weighted rotation re-scores in pure Python without NumPy
 
 app = Flask(__name__)
 
@@ -34,7 +63,12 @@ if os.name == 'nt': # Windows
 else:
     # Linux (Render) -> Check if mount exists, else fallback
     # DEBUG: Print what we see
-    if os.path.exists('/var/lib/grace_radio'):
+    if os.environ.get('STORAGE_DIR'):
+        # Explicit setting wins (other hosts, benchmark.py)
+        STORAGE_DIR = os.environ['STORAGE_DIR']
+        os.makedirs(STORAGE_DIR, exist_ok=True)
+        print(f"USING STORAGE_DIR: {STORAGE_DIR}")
+    elif os.path.exists('/var/lib/grace_radio'):
         STORAGE_DIR = '/var/lib/grace_radio'
         print(f"USING PERSISTENT DISK: {STORAGE_DIR}")
         # Test write permission
@@ -54,6 +88,8 @@ UPLOAD_FOLDER = STORAGE_DIR
 DATA_FILE = os.path.join(STORAGE_DIR, 'data.json')
 STATE_FILE = os.path.join(STORAGE_DIR, 'state.json')
 VOTE_FILE = os.path.join(STORAGE_DIR, 'votes.json')
+COMMAND_FILE = os.path.join(STORAGE_DIR, 'commands.jsonl') # JSON backend: playout commands for the leader
+JOB_FILE = os.path.join(STORAGE_DIR, 'jobs.json') # JSON backend: download jobs
 ALLOWED_EXTENSIONS = {'mp3', 'wav', 'ogg', 'm4a', 'mp4', 'webm'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -61,24 +97,995 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 print(f"FINAL UPLOAD_FOLDER: {app.config['UPLOAD_FOLDER']}")
 
+class LibraryStore:
+    """
+    Indexed media library.
+    Keeps the library in insertion order (that is what gets saved / returned by
+    /api/library) plus ID, basename, category, content fingerprint and
+    download source indexes so hot paths never scan the whole list. Items are
+    plain dicts; if you change an item's 'filename', 'category', 'fp' or
+    'source' in place, call reindex(item) afterwards, and
+    touch(item) after any other in-place edit so storage writes that row.
+    `revision` moves on every change, `version` only when the indexes do.
+    """
+
+    def __init__(self, items=None):
+        self._items = {}        # str(id) -> item (dict keeps insertion order)
+        self._by_basename = {}  # basename -> {str(id): None} (ordered set)
+        self._by_category = {}  # category -> set(str(id))
+        self._by_fp = {}        # content fingerprint -> set(str(id))
+        self._by_source = {}    # download source key -> set(str(id))
+        self._keys = {}         # str(id) -> (basename, category, fp, source) as indexed
+        self.version = 0        # bumped whenever the indexes change
+        self.revision = 0       # bumped on any change (read snapshots)
+        # Change tracking for row-level storage
+        self._dirty = {}        # str(id) -> None (ordered set)
+        self._removed = set()
+        self._full = False      # whole library replaced since last save
+        if items:
+            self.replace(items)
+
+    # --- Lookups ---
+    def get(self, media_id):
+        if media_id is None: return None
+        return self._items.get(str(media_id))
+
+    def __contains__(self, media_id):
+        return media_id is not None and str(media_id) in self._items
+
+    def by_basename(self, basename):
+        ids = self._by_basename.get(basename)
+        if not ids: return None
+        return self._items[next(iter(ids))]
+
+    def by_fp(self, fp):
+        """An item whose file has this content fingerprint, or None"""
+        ids = self._by_fp.get(fp) if fp else None
+        if not ids: return None
+        return self._items[next(iter(ids))]
+
+    def by_source(self, source):
+        """An item downloaded from this source key, or None"""
+        ids = self._by_source.get(source) if source else None
+        if not ids: return None
+        return self._items[next(iter(ids))]
+
+    def category_ids(self, category):
+        """Set of IDs in a category (live view, do not mutate)"""
+        return self._by_category.get(category, set())
+
+    def categories(self):
+        return [cat for cat, ids in self._by_category.items() if ids]
+
+    def in_category(self, category):
+        return [self._items[mid] for mid in self._by_category.get(category, ())]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        # Snapshot so callers may add/remove while iterating
+        return iter(list(self._items.values()))
+
+    def __repr__(self):
+        return f"LibraryStore({len(self._items)} items)"
+
+    def to_list(self):
+        return list(self._items.values())
+
+    # --- Mutations ---
+    def add(self, item):
+        mid = str(item['id'])
+        if mid in self._items:
+            self._unindex(mid)
+        self._items[mid] = item
+        self._index(mid, item)
+        self._dirty[mid] = None
+        self._removed.discard(mid)
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def remove(self, media_id):
+        mid = str(media_id)
+        item = self._items.pop(mid, None)
+        if item is not None:
+            self._unindex(mid)
+            self._dirty.pop(mid, None)
+            self._removed.add(mid)
+        return item
+
+    def replace(self, items):
+        """Swap in a whole new library (load / hot reload)"""
+        self._items = {}
+        self._by_basename = {}
+        self._by_category = {}
+        self._by_fp = {}
+        self._by_source = {}
+        self._keys = {}
+        self.extend(items)
+        self._dirty = {}
+        self._removed = set()
+        self._full = True
+
+    def reindex(self, item):
+        """Refresh indexes after an in-place filename/category edit"""
+        mid = str(item['id'])
+        if self._items.get(mid) is not item:
+            return
+        if self._keys.get(mid) != self._index_keys(item):
+            self._unindex(mid)
+            self._index(mid, item)
+        self._dirty[mid] = None
+        self.revision += 1
+
+    def touch(self, item):
+        """Mark an item edited in place so the next save writes it"""
+        mid = str(item['id'])
+        if mid in self._items:
+            self._dirty[mid] = None
+            self.revision += 1
+
+    def apply_remote(self, full, items, removed_ids):
+        """
+        Apply rows another process saved, without marking them for saving.
+        full=True means `items` is the whole library. Rows with unsaved local
+        edits are left alone (our write lands later and wins).
+        Returns True if anything changed.
+        """
+        if self._full:
+            return False
+        if full:
+            remote_ids = {str(m['id']) for m in items}
+            removed_ids = [mid for mid in self._items if mid not in remote_ids]
+        changed = False
+        for item in items:
+            mid = str(item['id'])
+            if mid in self._dirty or mid in self._removed or self._items.get(mid) == item:
+                continue
+            self._unindex(mid)
+            self._items[mid] = item
+            self._index(mid, item)
+            changed = True
+        for mid in removed_ids:
+            mid = str(mid)
+            if mid in self._dirty or mid not in self._items:
+                continue
+            del self._items[mid]
+            self._unindex(mid)
+            changed = True
+        return changed
+
+    # --- Change Tracking ---
+    def pending_changes(self):
+        """(full, changed_items, removed_ids) since the last mark_saved()"""
+        if self._full:
+            return True, self.to_list(), []
+        return False, [self._items[mid] for mid in self._dirty], list(self._removed)
+
+    def mark_saved(self):
+        self._dirty = {}
+        self._removed = set()
+        self._full = False
+
+    def mark_unsaved(self):
+        """A write failed: rewrite everything next time"""
+        self._full = True
+
+    # --- Internals ---
+    @staticmethod
+    def _index_keys(item):
+        fname = (item.get('filename') or '').replace('\\', '/')
+        return os.path.basename(fname), item.get('category'), item.get('fp'), item.get('source')
+
+    def _index(self, mid, item):
+        self.version += 1
+        self.revision += 1
+        bn, cat, fp, source = self._index_keys(item)
+        self._keys[mid] = (bn, cat, fp, source)
+        self._by_basename.setdefault(bn, {})[mid] = None
+        self._by_category.setdefault(cat, set()).add(mid)
+        if fp:
+            self._by_fp.setdefault(fp, set()).add(mid)
+        if source:
+            self._by_source.setdefault(source, set()).add(mid)
+
+    def _unindex(self, mid):
+        keys = self._keys.pop(mid, None)
+        if not keys: return
+        self.version += 1
+        self.revision += 1
+        bn, cat, fp, source = keys
+        ids = self._by_basename.get(bn)
+        if ids is not None:
+            ids.pop(mid, None)
+            if not ids: del self._by_basename[bn]
+        cats = self._by_category.get(cat)
+        if cats is not None:
+            cats.discard(mid)
+            if not cats: del self._by_category[cat]
+        fps = self._by_fp.get(fp)
+        if fps is not None:
+            fps.discard(mid)
+            if not fps: del self._by_fp[fp]
+        sources = self._by_source.get(source)
+        if sources is not None:
+            sources.discard(mid)
+            if not sources: del self._by_source[source]
+
+VOTE_RETENTION = 90 * 24 * 60 * 60 # Votes older than 90 days are dropped
+
+def vote_rating(v):
+    """1-5 rating of a stored vote (maps legacy like/dislike), or None"""
+    r = v.get('rating')
+    if r is None:
+        legacy = v.get('vote')
+        if legacy == 'like': r = 5
+        elif legacy == 'dislike': r = 1
+    return r
+
+class VoteStore:
+    """
+    Votes indexed by (track_id, listener_id) with running per-track aggregates.
+    Entries are kept oldest-first (re-voting moves a vote to the back), so
+    retention only ever pops expired votes off the front.
+    """
+
+    def __init__(self, votes=None):
+        self._votes = OrderedDict() # (track_id, listener_id) -> vote dict
+        self._stats = {}            # track_id -> {"total", "count", "1".."5"}
+        # Change tracking for row-level storage
+        self._dirty = set()
+        self._removed = set()
+        self._full = False
+        # Tracks whose aggregates changed, for the weighted rotation
+        self._stat_changes = set()
+        self._stats_reset = False
+        if votes:
+            self.replace(votes)
+
+    def __len__(self):
+        return len(self._votes)
+
+    def __repr__(self):
+        return f"VoteStore({len(self._votes)} votes)"
+
+    def rating(self, track_id, listener_id):
+        v = self._votes.get((str(track_id), listener_id))
+        return vote_rating(v) if v else None
+
+    def stats(self):
+        """{track_id: {"total", "count", "1".."5"}} (live view, do not mutate)"""
+        return self._stats
+
+    def to_list(self):
+        return list(self._votes.values())
+
+    def cast(self, track_id, listener_id, rating, now):
+        """Add or replace this listener's vote for a track"""
+        key = (str(track_id), listener_id)
+        existing = self._votes.pop(key, None)
+        if existing:
+            self._count(existing, -1)
+            existing['rating'] = rating
+            existing['timestamp'] = now
+            # Clear legacy field if exists
+            if 'vote' in existing: del existing['vote']
+            vote = existing
+        else:
+            vote = {
+                "track_id": key[0],
+                "listener_id": listener_id,
+                "rating": rating,
+                "timestamp": now
+            }
+        self._votes[key] = vote
+        self._count(vote, 1)
+        self._dirty.add(key)
+        self._removed.discard(key)
+
+    def expire(self, cutoff):
+        """Drop votes with timestamp <= cutoff. Returns how many were removed."""
+        removed = 0
+        while self._votes:
+            key, vote = next(iter(self._votes.items()))
+            if vote.get('timestamp', 0) > cutoff:
+                break
+            del self._votes[key]
+            self._count(vote, -1)
+            self._dirty.discard(key)
+            self._removed.add(key)
+            removed += 1
+        return removed
+
+    def clear(self):
+        self._votes = OrderedDict()
+        self._stats = {}
+        self._stat_changes = set()
+        self._stats_reset = True
+        self._dirty = set()
+        self._removed = set()
+        self._full = True
+
+    def replace(self, votes):
+        self.clear()
+        for v in sorted(votes, key=lambda x: x.get('timestamp', 0)):
+            if not v.get('listener_id'):
+                # Legacy anonymous votes: give each a stable key of its own
+                v['listener_id'] = '#legacy-' + uuid.uuid4().hex[:12]
+            key = (str(v['track_id']), v['listener_id'])
+            old = self._votes.pop(key, None)
+            if old: self._count(old, -1)
+            self._votes[key] = v
+            self._count(v, 1)
+
+    def apply_remote(self, full, votes, removed_keys):
+        """Apply votes another process saved (see LibraryStore.apply_remote)"""
+        if self._full:
+            return False
+        by_key = {}
+        for v in votes:
+            if v.get('listener_id'):
+                by_key[(str(v['track_id']), v['listener_id'])] = v
+        if full:
+            removed_keys = [k for k in self._votes if k not in by_key]
+        changed = False
+        for key, v in by_key.items():
+            if key in self._dirty or key in self._removed or self._votes.get(key) == v:
+                continue
+            old = self._votes.pop(key, None)
+            if old: self._count(old, -1)
+            self._votes[key] = v
+            self._count(v, 1)
+            changed = True
+        for key in removed_keys:
+            key = tuple(key)
+            if key in self._dirty or key not in self._votes:
+                continue
+            self._count(self._votes.pop(key), -1)
+            changed = True
+        return changed
+
+    def pending_changes(self):
+        """(full, {key: vote} changed, [key] removed) since the last mark_saved()"""
+        if self._full:
+            return True, dict(self._votes), []
+        return False, {k: self._votes[k] for k in self._dirty}, list(self._removed)
+
+    def mark_saved(self):
+        self._dirty = set()
+        self._removed = set()
+        self._full = False
+
+    def mark_unsaved(self):
+        """A write failed: rewrite everything next time"""
+        self._full = True
+
+    def take_stat_changes(self):
+        """(reset, track IDs) whose aggregates changed since the last call"""
+        reset, changed = self._stats_reset, self._stat_changes
+        self._stats_reset = False
+        self._stat_changes = set()
+        return reset, changed
+
+    def _count(self, vote, sign):
+        r = vote_rating(vote)
+        if r is None: return # Skip invalid
+        tid = str(vote['track_id'])
+        self._stat_changes.add(tid)
+        s = self._stats.get(tid)
+        if s is None:
+            s = self._stats[tid] = {"total": 0, "count": 0, "1": 0, "2": 0, "3": 0, "4": 0, "5": 0}
+        s['total'] += sign * r
+        s['count'] += sign
+        if str(r) in s:
+            s[str(r)] += sign
+        if s['count'] <= 0:
+            del self._stats[tid]
+
+class ScheduleStore:
+    """
+    Scheduled broadcasts: a min-heap on run_at plus ID and media indexes.
+    add / update / remove / pop_due are O(log n). Updates and removals leave
+    stale heap entries behind; they are skipped when they surface and the
+    heap is rebuilt once they outnumber the live ones.
+    """
+
+    def __init__(self, items=None):
+        self._items = {}     # str(id) -> {id, media_id, run_at}
+        self._heap = []      # (run_at, seq, str(id))
+        self._live_seq = {}  # str(id) -> seq of its current heap entry
+        self._by_media = {}  # str(media_id) -> set(str(id))
+        self._seq = itertools.count()
+        self.revision = 0    # bumped on any change (read snapshots)
+        # Change tracking for row-level storage
+        self._dirty = set()
+        self._removed = set()
+        self._full = False
+        if items:
+            self.replace(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items.values()))
+
+    def __repr__(self):
+        return f"ScheduleStore({len(self._items)} items)"
+
+    def get(self, item_id):
+        return self._items.get(str(item_id))
+
+    def to_list(self):
+        return list(self._items.values())
+
+    def add(self, item):
+        sid = str(item['id'])
+        self._discard(sid)
+        self._insert(sid, item)
+        self._dirty.add(sid)
+        self._removed.discard(sid)
+
+    def update(self, item_id, run_at):
+        item = self._items.get(str(item_id))
+        if item is None:
+            return None
+        item['run_at'] = float(run_at)
+        self._push(str(item_id), item['run_at'])
+        self._dirty.add(str(item_id))
+        return item
+
+    def remove(self, item_id):
+        sid = str(item_id)
+        item = self._discard(sid)
+        if item is not None:
+            self._dirty.discard(sid)
+            self._removed.add(sid)
+        return item
+
+    def remove_media(self, media_id):
+        """Drop every entry for a media item. Returns how many were removed."""
+        ids = list(self._by_media.get(str(media_id), ()))
+        for sid in ids:
+            self.remove(sid)
+        return len(ids)
+
+    def peek_next(self):
+        """Earliest scheduled item (not removed), or None"""
+        self._drop_stale()
+        return self._items[self._heap[0][2]] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the earliest item with run_at <= now, or None"""
+        item = self.peek_next()
+        if item is None or item['run_at'] > now:
+            return None
+        return self.remove(item['id'])
+
+    def replace(self, items):
+        self._items = {}
+        self._heap = []
+        self._live_seq = {}
+        self._by_media = {}
+        for item in items:
+            self.add(item)
+        self._dirty = set()
+        self._removed = set()
+        self._full = True
+
+    def apply_remote(self, full, items, removed_ids):
+        """Apply entries another process saved (see LibraryStore.apply_remote)"""
+        if self._full:
+            return False
+        if full:
+            remote_ids = {str(x['id']) for x in items}
+            removed_ids = [sid for sid in self._items if sid not in remote_ids]
+        changed = False
+        for item in items:
+            sid = str(item['id'])
+            if sid in self._dirty or sid in self._removed or self._items.get(sid) == item:
+                continue
+            self._discard(sid)
+            self._insert(sid, item)
+            changed = True
+        for sid in removed_ids:
+            sid = str(sid)
+            if sid not in self._dirty and self._discard(sid) is not None:
+                changed = True
+        return changed
+
+    # --- Change Tracking ---
+    def pending_changes(self):
+        """(full, changed_items, removed_ids) since the last mark_saved()"""
+        if self._full:
+            return True, self.to_list(), []
+        return False, [self._items[sid] for sid in self._dirty], list(self._removed)
+
+    def mark_saved(self):
+        self._dirty = set()
+        self._removed = set()
+        self._full = False
+
+    def mark_unsaved(self):
+        self._full = True
+
+    # --- Internals ---
+    def _insert(self, sid, item):
+        item['run_at'] = float(item['run_at'])
+        self._items[sid] = item
+        self._by_media.setdefault(str(item['media_id']), set()).add(sid)
+        self._push(sid, item['run_at'])
+
+    def _discard(self, sid):
+        item = self._items.pop(sid, None)
+        if item is None:
+            return None
+        self.revision += 1
+        del self._live_seq[sid]
+        ids = self._by_media.get(str(item['media_id']))
+        if ids is not None:
+            ids.discard(sid)
+            if not ids: del self._by_media[str(item['media_id'])]
+        self._maybe_compact()
+        return item
+
+    def _push(self, sid, run_at):
+        self.revision += 1
+        seq = next(self._seq)
+        self._live_seq[sid] = seq
+        heapq.heappush(self._heap, (run_at, seq, sid))
+        self._maybe_compact()
+
+    def _is_live(self, entry):
+        return self._live_seq.get(entry[2]) == entry[1]
+
+    def _drop_stale(self):
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _maybe_compact(self):
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._items):
+            self._heap = [e for e in self._heap if self._is_live(e)]
+            heapq.heapify(self._heap)
+
+# Rotation settings. ROTATION_MODE=weighted plays better-rated tracks more
+# often; the default shuffle mode plays every track once per cycle.
+ROTATION_MODE = os.environ.get('ROTATION_MODE', 'shuffle')
+ROTATION_VOTE_PRIOR = 3.0   # neutral rating, weight 1
+ROTATION_VOTE_PRIOR_N = 5   # pseudo-votes at the neutral rating (few votes stay near 1)
+ROTATION_VOTE_POWER = 2.0   # a 5.0 average weighs (5/3)^2 = 2.8, a 1.0 average 0.11
+ROTATION_RECOVERY = float(os.environ.get('ROTATION_RECOVERY', 6 * 3600)) # seconds to full weight after a play
+ROTATION_MIN_GAP = 10       # plays before a track may repeat
+ROTATION_TRIES = 32         # weighted samples before falling back to the shuffle bag
+# Category shares for the shuffle fallback, e.g. "Music:4,Worship:1"
+ROTATION_QUOTAS = {}
+for _quota in filter(None, os.environ.get('ROTATION_QUOTAS', '').split(',')):
+    _cat, _, _share = _quota.partition(':')
+    try:
+        ROTATION_QUOTAS[_cat.strip()] = float(_share)
+    except ValueError:
+        print(f"Ignoring bad ROTATION_QUOTAS entry: {_quota}")
+
+class PlayHistory:
+    """
+    Recently played track IDs, oldest first.
+    A deque in play order plus each ID's latest play number, so "played
+    recently?" and "played since play N?" are O(1) and dropping the oldest
+    entry is a popleft() instead of list.pop(0).
+    """
+
+    def __init__(self):
+        self._plays = deque()  # (play number, str(id))
+        self._last = {}        # str(id) -> latest play number still in history
+        self.count = 0         # plays recorded so far
+
+    def append(self, media_id, limit):
+        mid = str(media_id)
+        self.count += 1
+        self._plays.append((self.count, mid))
+        self._last[mid] = self.count
+        while len(self._plays) > limit:
+            n, old = self._plays.popleft()
+            if self._last.get(old) == n:
+                del self._last[old]
+
+    def last_play(self, media_id):
+        """Play number of the ID's latest play in history, or 0"""
+        return self._last.get(str(media_id), 0)
+
+    def __contains__(self, media_id):
+        return media_id is not None and str(media_id) in self._last
+
+    def __len__(self):
+        return len(self._plays)
+
+    def __iter__(self):
+        return iter([mid for _, mid in self._plays])
+
+class RotationEngine:
+    """
+    Shuffle-bag picker for queue auto-fill and the shuffle fallback.
+    Each named pool (a set of categories) deals a shuffled permutation of its
+    tracks one at a time and deals again when it runs out, so every track
+    plays once per cycle and a pick is amortised O(1) whatever the library
+    size. A deal puts tracks missing from recent history first and recently
+    played ones last (oldest play first). Tracks that left the pool, are
+    pending, are blocked (queued) or were played since the deal are dropped
+    as they come up; tracks added mid-cycle join at the next deal.
+    """
+
+    def __init__(self, library, history):
+        self.library = library
+        self.history = history
+        self._bags = {}   # pool name -> deque of str(id)
+        self._dealt = {}  # pool name -> history.count at the deal
+
+    def _deal(self, name, categories):
+        ids = set()
+        for cat in categories:
+            ids.update(self.library.category_ids(cat))
+        fresh = [mid for mid in ids if mid not in self.history]
+        random.shuffle(fresh)
+        recent = sorted((mid for mid in ids if mid in self.history), key=self.history.last_play)
+        self._bags[name] = deque(fresh + recent)
+        self._dealt[name] = self.history.count
+
+    def draw(self, name, categories, blocked=()):
+        """Next track ID from the pool that is not in `blocked`, or None"""
+        categories = set(categories)
+        if name not in self._bags:
+            self._deal(name, categories)
+        dealt = False
+        while True:
+            bag = self._bags[name]
+            while bag:
+                mid = bag.popleft()
+                item = self.library.get(mid)
+                if (not item or item.get('category') not in categories or item.get('pending')
+                        or mid in blocked or self.history.last_play(mid) > self._dealt[name]):
+                    continue
+                return mid
+            if dealt:
+                return None
+            self._deal(name, categories)
+            dealt = True
+
+def vote_weight(total, count):
+    """Rotation weight of a track from its vote sum / count"""
+    avg = (total + ROTATION_VOTE_PRIOR * ROTATION_VOTE_PRIOR_N) / (count + ROTATION_VOTE_PRIOR_N)
+    return (avg / ROTATION_VOTE_PRIOR) ** ROTATION_VOTE_POWER
+
+def vote_weights(totals, counts):
+    """vote_weight() over whole arrays, in one NumPy call when available"""
+    if np is not None and len(totals):
+        avg = (np.asarray(totals, dtype=float) + ROTATION_VOTE_PRIOR * ROTATION_VOTE_PRIOR_N) \
+            / (np.asarray(counts, dtype=float) + ROTATION_VOTE_PRIOR_N)
+        return ((avg / ROTATION_VOTE_PRIOR) ** ROTATION_VOTE_POWER).tolist()
+    return [vote_weight(t, c) for t, c in zip(totals, counts)]
+
+class FenwickTree:
+    """Weights with O(log n) update and O(log n) weighted sampling (binary indexed tree)"""
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        n = self.n = len(self.weights)
+        if np is not None and n:
+            # Node i covers (i - lowbit(i), i]: a difference of prefix sums
+            prefix = np.concatenate(([0.0], np.cumsum(self.weights)))
+            idx = np.arange(1, n + 1)
+            self._tree = [0.0] + (prefix[idx] - prefix[idx - (idx & -idx)]).tolist()
+        else:
+            tree = [0.0] + self.weights
+            for i in range(1, n + 1):
+                j = i + (i & -i)
+                if j <= n:
+                    tree[j] += tree[i]
+            self._tree = tree
+        self.total = float(sum(self.weights))
+
+    def update(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self.total += delta
+        i = index + 1
+        while i <= self.n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def find(self, x):
+        """Index whose cumulative weight range contains x (0 <= x < total)"""
+        pos = 0
+        step = 1 << (self.n.bit_length() - 1) if self.n else 0
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self._tree[nxt] <= x:
+                pos = nxt
+                x -= self._tree[nxt]
+            step >>= 1
+        return min(pos, self.n - 1)
+
+class WeightedRotation(RotationEngine):
+    """
+    Vote-weighted picker (ROTATION_MODE=weighted).
+    Each category keeps its track IDs in an array alongside a Fenwick tree of
+    their vote weights, so a weighted pick or a weight change is O(log n).
+    Vote changes are applied per track before the next pick; a change in
+    library membership re-scores everything in one batch (vectorised when
+    NumPy is installed). Time since last play is applied at pick time: a
+    sampled track is accepted with probability age / ROTATION_RECOVERY, and
+    never within ROTATION_MIN_GAP plays. The category is picked by
+    ROTATION_QUOTAS when set, else by total weight. If nothing is accepted
+    after ROTATION_TRIES samples the shuffle bag picks instead.
+    """
+
+    def __init__(self, library, history, votes):
+        super().__init__(library, history)
+        self.votes = votes
+        self._trees = {}    # category -> (ids, FenwickTree)
+        self._slots = {}    # str(id) -> (category, index)
+        self._built = None  # library.version the trees were built for
+
+    def rescore_all(self):
+        """Caller holds state_lock and votes_lock"""
+        self.votes.take_stat_changes()
+        stats = self.votes.stats()
+        cats = self.library.categories()
+        groups = [list(self.library.category_ids(cat)) for cat in cats]
+        flat = [mid for group in groups for mid in group]
+        totals = [stats[mid]['total'] if mid in stats else 0 for mid in flat]
+        counts = [stats[mid]['count'] if mid in stats else 0 for mid in flat]
+        weights = vote_weights(totals, counts)
+        self._trees = {}
+        self._slots = {}
+        start = 0
+        for cat, group in zip(cats, groups):
+            self._trees[cat] = (group, FenwickTree(weights[start:start + len(group)]))
+            for i, mid in enumerate(group):
+                self._slots[mid] = (cat, i)
+            start += len(group)
+        self._built = self.library.version
+
+    def _sync(self):
+        with votes_lock:
+            reset, changed = self.votes.take_stat_changes()
+            if reset or self._built != self.library.version:
+                self.rescore_all()
+                return
+            stats = self.votes.stats()
+            for tid in changed:
+                slot = self._slots.get(tid)
+                if slot:
+                    s = stats.get(tid)
+                    self._trees[slot[0]][1].update(slot[1], vote_weight(s['total'], s['count']) if s else 1.0)
+
+    def draw(self, name, categories, blocked=()):
+        self._sync()
+        pools = [(cat, self._trees[cat]) for cat in categories if cat in self._trees and self._trees[cat][1].total > 0]
+        shares = [ROTATION_QUOTAS.get(cat, 0) for cat, _ in pools]
+        if not any(shares):
+            shares = [tree.total for _, (_, tree) in pools]
+        now = time.time()
+        for _ in range(ROTATION_TRIES if pools else 0):
+            cat, (ids, tree) = random.choices(pools, weights=shares)[0]
+            mid = ids[tree.find(random.random() * tree.total)]
+            item = self.library.get(mid)
+            if (not item or item.get('category') != cat or item.get('pending') or mid in blocked
+                    or (mid in self.history and self.history.count - self.history.last_play(mid) < ROTATION_MIN_GAP)):
+                continue
+            age = now - (item.get('last_played_at') or 0)
+            if age < ROTATION_RECOVERY and random.random() * ROTATION_RECOVERY > age:
+                continue # played lately: less likely until it recovers
+            return mid
+        return super().draw(name, categories, blocked)
+
+# --- Metrics ---
+# Prometheus text-format metrics, served at /metrics. Everything is per
+# worker process: scrape each gunicorn worker, or read numbers behind a load
+# balancer as one worker's view. state_lock and listener_lock are TimedLocks,
+# which record how long callers wait for and then hold them.
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOCK_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+metric_families = [] # rendered in registration order
+
+def metric_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return f"{v:g}" if isinstance(v, float) else str(v)
+
+def metric_labels(names, values):
+    if not names:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{n}="{esc(v)}"' for n, v in zip(names, values)) + '}'
+
+class Histogram:
+    """Histogram family: per label set, bucket counts plus sum and count"""
+
+    def __init__(self, name, doc, labels=(), buckets=METRIC_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+        metric_families.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            series = [(values, list(counts), total) for values, (counts, total) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for values, counts, total in sorted(series):
+            cumulative = 0
+            for le, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{metric_labels(self.labels + ('le',), values + (metric_value(le),))} {cumulative}")
+            lines.append(f"{self.name}_sum{metric_labels(self.labels, values)} {metric_value(total)}")
+            lines.append(f"{self.name}_count{metric_labels(self.labels, values)} {cumulative}")
+        return lines
+
+class Counter:
+    """Counter family: a running total per label set"""
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        metric_families.append(self)
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{metric_labels(self.labels, values)} {metric_value(v)}" for values, v in series)
+        return lines
+
+REQUEST_SECONDS = Histogram('radio_http_request_duration_seconds',
+                            'Time to produce a response (streams: until the body starts)', ('route', 'method', 'status'))
+LOCK_WAIT = Histogram('radio_lock_wait_seconds', 'Time spent waiting to acquire a lock', ('lock',), LOCK_BUCKETS)
+LOCK_HOLD = Histogram('radio_lock_hold_seconds', 'Time a lock was held', ('lock',), LOCK_BUCKETS)
+LOOP_TICK = Histogram('radio_loop_tick_seconds', 'Work done per radio loop wake-up (leader)')
+TRACK_LATENESS = Histogram('radio_track_transition_lateness_seconds', 'How long after its end time a track was replaced',
+                           buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+PERSIST_SECONDS = Histogram('radio_persist_write_seconds', 'Write-behind storage write latency', ('kind',))
+PERSIST_BYTES = Counter('radio_persist_bytes_total', 'Serialized bytes handed to storage', ('kind',))
+PERSIST_ERRORS = Counter('radio_persist_errors_total', 'Failed storage writes', ('kind',))
+
+class TimedLock:
+    """threading.Lock that records wait and hold times (LOCK_WAIT / LOCK_HOLD)"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0 # only touched by the holder
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._acquired_at = time.perf_counter()
+        LOCK_WAIT.observe(self._acquired_at - started, self.name)
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        LOCK_HOLD.observe(held, self.name)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
 # Global State (In-Memory Cache)
 state = {
-    "library": [],        # List of media objects: {id, title, filename, duration, type, category}
+    "library": LibraryStore(), # Indexed media objects: {id, title, filename, duration, type, category}
     "queue": [],          # List of media IDs to play next (User manual queue)
-    "schedule": [],       # List of {id, run_at_timestamp, media_id}
-    "history": [],        # IDs of played songs
-    "votes": [],          # List of {track_id, timestamp, vote}
+    "schedule": ScheduleStore(), # Heap of {id, run_at_timestamp, media_id}
+    "history": PlayHistory(), # IDs of played songs
+    "votes": VoteStore(), # Indexed {track_id, listener_id, rating, timestamp} (votes_lock)
     "deleted_files": [],  # BLOCKLIST: Filenames that have been explicitly deleted
     "current_track": None, # { ...media_obj, start_time: timestamp }
-    "playing": False
+    "playing": False,
+    "hls": []             # Recent HLS timeline entries (see hls_start_track)
 }
 
-state_lock = threading.Lock()
+# Lock domains. state_lock guards the library, schedule, queue and playback
+# (the radio loop changes them together); votes have votes_lock and listener
+# heartbeats listener_lock. Nest them only in this order:
+# state_lock -> votes_lock -> dirty_lock (write-behind flags, never held long).
+state_lock = TimedLock('state')
+votes_lock = TimedLock('votes')
+# Track picker, guarded by state_lock
+if ROTATION_MODE == 'weighted':
+    rotation = WeightedRotation(state['library'], state['history'], state['votes'])
+else:
+    rotation = RotationEngine(state['library'], state['history'])
+
+# --- Status Snapshot & Push Channel (Server-Sent Events) ---
+# Anything a listener can see (track, queue, votes) goes through publish_status(),
+# which builds the shared part of /api/status once and stores it pre-encoded.
+# /api/status and /api/events only splice in the per-listener fields.
+SSE_KEEPALIVE = 15      # seconds between ": keepalive" comments
+SSE_CHECK_INTERVAL = 5  # how often idle streams re-check listener counts
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 48)) # each stream pins a worker thread
+
+# (version, body_bytes, current_track_id, start_time, playing) - replaced, never mutated
+status_snapshot = (0, b'{"version": 0, "playing": false, "current_track": null, "queue": []}', None, 0, False)
+status_cond = threading.Condition()
+sse_clients = 0
+
+def publish_status():
+    """
+    Rebuild the shared status snapshot and wake every /api/events stream.
+    Caller must hold state_lock.
+    """
+    global status_snapshot
+    current = state['current_track']
+    
+    # Auto-Repair properties from library if missing (e.g. lyrics)
+    lib_item = None
+    if current:
+        lib_item = state['library'].get(current['id'])
+        if lib_item:
+            if not current.get('lyrics') and lib_item.get('lyrics'):
+                 current['lyrics'] = lib_item['lyrics']
+
+    queue_preview = []
+    for q_id in state['queue'][:10]:
+        m = state['library'].get(q_id)
+        if m:
+            queue_preview.append({"id": m['id'], "title": m['title'], "category": m.get('category', 'Unknown')})
+        else:
+            queue_preview.append({"id": q_id, "title": "Loading...", "category": "Unknown"})
+
+    on_air = None
+    if current:
+        # Fingerprinted URL; the library copy picks up fingerprints computed later
+        on_air = dict(current, media_url=media_url(lib_item or current))
+
+    with status_cond:
+        version = status_snapshot[0] + 1
+        body = json.dumps({
+            "version": version,
+            "playing": state['playing'],
+            "current_track": on_air,
+            "queue": queue_preview
+        }).encode('utf-8')
+        status_snapshot = (
+            version, body,
+            str(current['id']) if current else None,
+            current.get('start_time', 0) if current else 0,
+            bool(state['playing'])
+        )
+        status_cond.notify_all()
 
 def extract_metadata(filepath, media_id):
     """
-    Extracts duration and Album Art (ID3).
-    Returns (duration, art_filename_or_None)
+    Extracts duration and checks for embedded Album Art (ID3 / FLAC).
+    Returns (duration, art_url_or_None). The picture itself is only pulled
+    out when the art URL is first requested (see Album Art).
     """
     duration = 0
     art_path = None
@@ -104,26 +1111,7 @@ def extract_metadata(filepath, media_id):
                          found_art = audio.pictures[0].data
 
             if found_art:
-                # Save to Persistent Storage
-                art_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'art')
-                if not os.path.exists(art_dir):
-                    os.makedirs(art_dir)
-                
-                ext = '.jpg' # Default
-                if found_art[0:4] == b'\x89PNG': ext = '.png'
-                
-                art_filename = f"{media_id}{ext}"
-                dest = os.path.join(art_dir, art_filename)
-                
-                # Write only if doesn't exist (to preserve custom uploads?)
-                # Actually, during bootstrap, we might respect existing.
-                if not os.path.exists(dest):
-                    with open(dest, 'wb') as f:
-                        f.write(found_art)
-                    print(f"Extracted Art for {media_id}")
-                    art_path = f"/static/art/{art_filename}"
-                else:
-                    art_path = f"/static/art/{art_filename}"
+                art_path = f"/api/art/{media_id}" # extracted on first request
 
     except Exception as e:
         print(f"Error reading metadata: {e}")
@@ -133,154 +1121,1560 @@ def extract_metadata(filepath, media_id):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def load_data():
-    loaded_from_disk = False
-    # 1. Load persistent data (Library, Schedule)
-    if os.path.exists(DATA_FILE):
+# --- Media Serving ---
+# Library files and art are served from an in-memory table of resolved paths
+# and content fingerprints (blake2b, recomputed only when size/mtime change).
+# /media/<fp>/<file> and /art/<fp>/<file> are immutable URLs: a new file
+# content gets a new URL, so browsers and proxies may cache them forever. The
+# old /static/media and /static/art URLs still work but must revalidate.
+# Responses support If-None-Match, single and multi-range requests; on
+# gunicorn, bodies go out through wsgi.file_wrapper (sendfile) at an offset.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+MAX_RANGES = 16
+
+media_paths = {}   # (kind, filename) -> absolute path
+media_digests = {} # path -> (size, mtime_ns, fingerprint)
+
+def media_roots(kind):
+    if kind == 'art':
+        return [os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], 'art'))]
+    return [os.path.abspath(app.config['UPLOAD_FOLDER']), os.path.join(app.root_path, 'static', 'media')]
+
+def resolve_media(kind, filename, fresh=False):
+    """
+    Absolute path for a media/art filename (uploads before bundled), or None.
+    A known path is trusted without touching the disk; callers that find it
+    gone retry with fresh=True.
+    """
+    key = (kind, filename)
+    if not fresh:
+        path = media_paths.get(key)
+        if path:
+            return path
+    media_paths.pop(key, None)
+    for base in media_roots(kind):
+        path = safe_join(base, filename)
+        if path and os.path.isfile(path):
+            media_paths[key] = path
+            return path
+    return None
+
+def media_path(filename):
+    """Path of a library file (persistent uploads first, then bundled), or None"""
+    path = resolve_media('media', filename)
+    if path and not os.path.isfile(path):
+        # Background callers hand the path to ffmpeg/mutagen: check it here
+        path = resolve_media('media', filename, fresh=True)
+    return path
+
+def file_fingerprint(f):
+    """blake2b of an open binary file from its current position"""
+    h = hashlib.blake2b(digest_size=8)
+    for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    return h.hexdigest()
+
+def open_media(kind, filename):
+    """
+    (open file, (path, size, mtime_ns, fingerprint)), or (None, None) if
+    there is no such file. Size and mtime come from the open file, so a file
+    replaced since it was hashed is hashed again.
+    """
+    for fresh in (False, True):
+        path = resolve_media(kind, filename, fresh)
+        if not path:
+            return None, None
         try:
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                state['library'] = data.get('library', [])
-                state['schedule'] = data.get('schedule', [])
-                state['deleted_files'] = data.get('deleted_files', [])
-                loaded_from_disk = True
-                
-                # Cleanup Duplicates (Root vs Folder)
-                clean_lib = []
-                folder_basenames = {os.path.basename(x['filename']) for x in state['library'] if '/' in x['filename'].replace('\\', '/')}
-                
-                removed_dupes = 0
-                for item in state['library']:
-                    bn = os.path.basename(item['filename'])
-                    is_root = '/' not in item['filename'].replace('\\', '/')
-                    # If this is a root item, and we have a version in a folder, drop the root one
-                    if is_root and bn in folder_basenames:
-                        removed_dupes += 1
+            f = open(path, 'rb')
+        except OSError:
+            continue # moved or deleted since it was resolved
+        st = os.fstat(f.fileno())
+        known = media_digests.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            fp = known[2]
+        else:
+            fp = file_fingerprint(f)
+            f.seek(0)
+            media_digests[path] = (st.st_size, st.st_mtime_ns, fp)
+        return f, (path, st.st_size, st.st_mtime_ns, fp)
+    return None, None
+
+def media_file(kind, filename):
+    """(path, size, mtime_ns, fingerprint) or None. Hashes only new/changed files."""
+    f, entry = open_media(kind, filename)
+    if f:
+        f.close()
+    return entry
+
+def media_url(item):
+    fname = item['filename'].replace('\\', '/')
+    if item.get('fp'):
+        return f"/media/{item['fp']}/{quote(fname)}"
+    return f"/static/media/{quote(fname)}"
+
+def art_file_from_url(url):
+    """'x.jpg' from /static/art/x.jpg?t=1 or /art/<fp>/x.jpg, else None"""
+    if not url:
+        return None
+    path = url.split('?', 1)[0]
+    if path.startswith('/static/art/'):
+        return path[len('/static/art/'):]
+    if path.startswith('/art/'):
+        return path.split('/', 3)[3] if path.count('/') >= 3 else None
+    return None
+
+def fingerprint_backfill():
+    """Leader only: fingerprint media files and move per-track art files into the art store"""
+    with state_lock:
+        items = [(m['id'], m['filename'], m.get('fp'), m.get('art')) for m in state['library']]
+    done = 0
+    for mid, filename, fp, art in items:
+        legacy = art_file_from_url(art)
+        try:
+            entry = None if fp else media_file('media', filename.replace('\\', '/'))
+            art_id = None
+            if legacy:
+                path = resolve_media('art', legacy)
+                if path:
+                    with open(path, 'rb') as f:
+                        art_id = store_art(f.read())
+        except OSError:
+            continue
+        if not entry and not legacy:
+            continue
+        with state_lock:
+            item = state['library'].get(mid)
+            if not item:
+                continue
+            if entry: item['fp'] = entry[3]
+            if legacy and item.get('art') == art:
+                set_item_art(item, art_id)
+            state['library'].reindex(item)
+            save_library()
+        if art_id:
+            try:
+                os.remove(path) # now stored once under its content hash
+                media_paths.pop(('art', legacy), None)
+            except OSError:
+                pass
+        done += 1
+    if done:
+        print(f"FINGERPRINTED {done} library items")
+
+def start_fingerprint_backfill():
+    threading.Thread(target=fingerprint_backfill, daemon=True).start()
+
+def parse_ranges(header, size):
+    """
+    [(start, end)] inclusive for a Range header; None to ignore the header
+    (absent / malformed / not bytes), [] if nothing is satisfiable.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[6:].split(','):
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        first, _, last = spec.partition('-')
+        try:
+            if first == '':
+                n = int(last) # suffix: last n bytes
+                if n <= 0: continue
+                start, end = max(0, size - n), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if end < start and last: return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None # Don't let one request fan out into hundreds of parts
+    # Coalesce overlapping / adjacent ranges
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def read_range(f, start, length, close=True):
+    try:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(65536, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        if close:
+            f.close()
+
+def file_body(f, start, length, size):
+    """Response body for [start, start+length) of an open file"""
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    # gunicorn sendfile()s Content-Length bytes from the current offset; other
+    # servers' wrappers read to EOF, so only use them when the range does too
+    if wrapper and (start + length == size or request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        f.seek(start)
+        return wrapper(f, 65536)
+    return read_range(f, start, length)
+
+def send_media(entry, cache_control, f=None):
+    """Response for a media_file() entry; takes ownership of f (from open_media) if given"""
+    path, size, mtime_ns, fp = entry
+    etag = f'"{fp}"'
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+        'Last-Modified': http_date(mtime_ns / 1e9),
+    }
+
+    if etag_matches(etag):
+        if f:
+            f.close()
+        return Response(status=304, headers=headers)
+
+    ranges = parse_ranges(request.headers.get('Range'), size)
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range and if_range.strip() != etag:
+        ranges = None # Changed since the client's partial copy: send it all
+    if ranges == []:
+        if f:
+            f.close()
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if f is None:
+        f = open(path, 'rb')
+    if ranges is None or ranges == [(0, size - 1)]:
+        resp = Response(file_body(f, 0, size, size), status=200, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+        resp.content_length = size
+        return resp
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        resp = Response(file_body(f, start, end - start + 1, size), status=206, headers=headers,
+                        mimetype=mimetype, direct_passthrough=True)
+        resp.content_length = end - start + 1
+        return resp
+
+    # multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = [(f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+              f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode('ascii')
+             for start, end in ranges]
+    closing = f"\r\n--{boundary}--\r\n".encode('ascii')
+    length = sum(len(h) for h in parts) + sum(e - s + 1 for s, e in ranges) + 2 * (len(ranges) - 1) + len(closing)
+
+    def multipart():
+        try:
+            for i, (start, end) in enumerate(ranges):
+                yield (b"\r\n" if i else b"") + parts[i]
+                yield from read_range(f, start, end - start + 1, close=False)
+            yield closing
+        finally:
+            f.close()
+
+    resp = Response(multipart(), status=206, headers=headers, direct_passthrough=True,
+                    content_type=f"multipart/byteranges; boundary={boundary}")
+    resp.content_length = length
+    return resp
+
+@app.route('/media/<fp>/<path:filename>')
+def fingerprinted_media(fp, filename):
+    f, entry = open_media('media', filename)
+    if not entry:
+        return "File not found", 404
+    if entry[3] != fp:
+        # Stale URL (file replaced): send the client to the current one
+        f.close()
+        return redirect(f"/media/{entry[3]}/{quote(filename)}")
+    return send_media(entry, IMMUTABLE, f)
+
+@app.route('/art/<fp>/<path:filename>')
+def fingerprinted_art(fp, filename):
+    f, entry = open_media('art', filename)
+    if not entry:
+        return "Not Found", 404
+    if entry[3] != fp:
+        f.close()
+        return redirect(f"/art/{entry[3]}/{quote(filename)}")
+    return send_media(entry, IMMUTABLE, f)
+
+@app.route('/static/media/<path:filename>')
+def custom_static(filename):
+    # Legacy URL: same file, but clients must revalidate (cheap 304s)
+    f, entry = open_media('media', filename)
+    if not entry:
+        print(f"404: Could not find {filename} in {media_roots('media')}")
+        return "File not found", 404
+    return send_media(entry, 'no-cache', f)
+
+@app.route('/static/art/<path:filename>')
+def custom_art(filename):
+    f, entry = open_media('art', filename)
+    if not entry:
+        print(f"404 Art: {filename} not found in {media_roots('art')}")
+        return "Not Found", 404
+    return send_media(entry, 'no-cache', f)
+
+# --- Album Art ---
+# Pictures are stored once per content hash (art/<hash>.<ext>), so an album
+# sharing one cover keeps one file. Library items carry `art_id` (the hash)
+# and `art` (the medium variant URL). /art/<hash>-<s|m|l> serves a variant
+# resized on first request (JPEG, or WebP when the browser accepts it and
+# Pillow supports it); without Pillow every variant is the original picture.
+# Embedded pictures aren't extracted at ingest: `art` starts as
+# /api/art/<id>, which extracts on first request and redirects.
+ART_VARIANTS = {'s': 128, 'm': 512, 'l': 1024} # library thumbnail, player, Media Session
+ART_WEBP = Image is not None and image_features.check('webp')
+ART_TYPES = [(b'\x89PNG', '.png'), (b'GIF8', '.gif'), (b'RIFF', '.webp')]
+
+def art_dir():
+    return os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], 'art'))
+
+def art_url(art_id, variant='m'):
+    return f"/art/{art_id}-{variant}"
+
+def set_item_art(item, art_id):
+    """Point an item (and the track on air) at stored art. Caller holds state_lock."""
+    item['art_id'] = art_id
+    item['art'] = art_url(art_id) if art_id else None
+    current = state['current_track']
+    if current and str(current['id']) == str(item['id']):
+        current['art_id'] = item['art_id']
+        current['art'] = item['art']
+
+def store_art(data):
+    """Save picture bytes under their content hash (once) and return the hash"""
+    art_id = hashlib.blake2b(data, digest_size=10).hexdigest()
+    ext = next((e for magic, e in ART_TYPES if data.startswith(magic)), '.jpg')
+    folder = art_dir()
+    dest = os.path.join(folder, art_id + ext)
+    if not os.path.exists(dest):
+        os.makedirs(folder, exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, dest)
+    return art_id
+
+def art_original(art_id):
+    for ext in ('.jpg', '.png', '.gif', '.webp'):
+        path = os.path.join(art_dir(), art_id + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def art_variant(art_id, variant, webp):
+    """Path of a resized variant, made on first use; the original without Pillow"""
+    original = art_original(art_id)
+    if not original or Image is None:
+        return original
+    fmt = 'webp' if webp else 'jpg'
+    path = os.path.join(art_dir(), f"{art_id}-{variant}.{fmt}")
+    if os.path.isfile(path):
+        return path
+    size = ART_VARIANTS[variant]
+    try:
+        with Image.open(original) as img:
+            img.thumbnail((size, size)) # never upscales
+            img = img.convert('RGB')
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            img.save(tmp, 'WEBP' if webp else 'JPEG', quality=80 if webp else 85)
+        os.replace(tmp, path)
+        return path
+    except Exception as e:
+        print(f"ART RESIZE FAILED for {art_id}: {e}")
+        return original
+
+def read_embedded_art(filepath):
+    """Bytes of the first embedded picture (ID3 APIC / FLAC), or None"""
+    audio = MutagenFile(filepath)
+    if audio is None:
+        return None
+    if getattr(audio, 'tags', None):
+        for tag in audio.tags.values():
+            if getattr(tag, 'FrameID', None) == 'APIC':
+                return tag.data
+    if getattr(audio, 'pictures', None):
+        return audio.pictures[0].data
+    return None
+
+@app.route('/art/<art_id>-<variant>')
+def art_image(art_id, variant):
+    if variant not in ART_VARIANTS or not re.fullmatch(r'[0-9a-f]{20}', art_id):
+        return "Not Found", 404
+    webp = ART_WEBP and 'image/webp' in request.headers.get('Accept', '')
+    path = art_variant(art_id, variant, webp)
+    if not path:
+        return "Not Found", 404
+    st = os.stat(path)
+    etag = f"{art_id}-{variant}" + ('-w' if webp else '')
+    resp = send_media((path, st.st_size, st.st_mtime_ns, etag), IMMUTABLE)
+    if ART_WEBP:
+        resp.headers['Vary'] = 'Accept'
+    return resp
+
+@app.route('/api/art/<media_id>')
+def track_art(media_id):
+    """Art of a track by ID; pulls embedded art out of the file on first use"""
+    variant = request.args.get('v', 'm')
+    if variant not in ART_VARIANTS:
+        variant = 'm'
+    with state_lock:
+        item = state['library'].get(media_id)
+        art_id = item.get('art_id') if item else None
+        filename = item['filename'] if item else None
+    if not item:
+        return "Not Found", 404
+    if not art_id:
+        path = media_path(filename)
+        data = read_embedded_art(path) if path else None
+        if not data:
+            return "Not Found", 404
+        art_id = store_art(data)
+        with state_lock:
+            item = state['library'].get(media_id)
+            if item and not item.get('art_id'):
+                set_item_art(item, art_id)
+                state['library'].touch(item)
+                save_library()
+                publish_status()
+        print(f"Extracted Art for {media_id}")
+    resp = redirect(art_url(art_id, variant))
+    resp.headers['Cache-Control'] = 'public, max-age=3600'
+    return resp
+
+# --- Persistence ---
+# STORAGE_BACKEND=sqlite (default): row-level writes to radio.db in WAL mode.
+# STORAGE_BACKEND=json: the original whole-file data.json / state.json / votes.json.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite').lower()
+DB_FILE = os.path.join(STORAGE_DIR, 'radio.db')
+
+def file_signature(path_or_fd):
+    """(inode, mtime_ns, size) of a file, or None. Survives os.replace()."""
+    try:
+        st = os.fstat(path_or_fd) if isinstance(path_or_fd, int) else os.stat(path_or_fd)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class JsonStorage:
+    """Whole-file JSON persistence (data.json, state.json, votes.json)"""
+    name = 'json'
+
+    def __init__(self):
+        # path -> file_signature() of the version we last loaded or wrote,
+        # so poll_changes() only parses files someone else rewrote
+        self._seen = {}
+        self.bytes_written = 0 # encoded bytes handed to the OS (metrics)
+        # Read position in COMMAND_FILE; commands from before we started are stale
+        try:
+            self._command_offset = os.path.getsize(COMMAND_FILE)
+        except OSError:
+            self._command_offset = 0
+
+    def describe(self):
+        try:
+            return f"{DATA_FILE} (Last Mod: {time.ctime(os.stat(DATA_FILE).st_mtime)})"
+        except OSError:
+            return DATA_FILE
+
+    def load_data(self):
+        """{'library', 'schedule', 'deleted_files'} or None if nothing saved yet"""
+        return self._read(DATA_FILE)
+
+    def load_playback(self):
+        return self._read(STATE_FILE)
+
+    def load_votes(self):
+        return self._read(VOTE_FILE)
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            sig = file_signature(f.fileno())
+            data = json.load(f)
+        self._seen[path] = sig
+        return data
+
+    def _write(self, path, body, atomic=False):
+        target = path + ".tmp" if atomic else path
+        with open(target, 'w') as f:
+            f.write(body)
+            self.bytes_written += len(body)
+            f.flush()
+            if atomic:
+                os.fsync(f.fileno()) # FORCE WRITE TO DISK
+            sig = file_signature(f.fileno())
+        if atomic:
+            os.replace(target, path) # Atomic Replace
+        self._seen[path] = sig
+
+    def poll_changes(self):
+        """
+        Whole-file changes written by other processes since we last loaded
+        or wrote each file, or None. Our own writes are recognised by file
+        signature and never re-parsed.
+        """
+        changes = {}
+        for path in (DATA_FILE, STATE_FILE, VOTE_FILE):
+            sig = file_signature(path)
+            if sig is None or sig == self._seen.get(path):
+                continue
+            try:
+                data = self._read(path)
+            except ValueError:
+                continue # Caught mid-write; next poll retries
+            if path == DATA_FILE:
+                changes['library'] = (True, data.get('library', []), [])
+                changes['schedule'] = (True, data.get('schedule', []), [])
+                changes['deleted_files'] = data.get('deleted_files', [])
+            elif path == STATE_FILE:
+                changes['playback'] = data
+            else:
+                changes['votes'] = (True, data, [])
+        commands = self._read_commands()
+        if commands:
+            changes['commands'] = commands
+        return changes or None
+
+    def _read_commands(self):
+        try:
+            size = os.path.getsize(COMMAND_FILE)
+        except OSError:
+            return []
+        if size < self._command_offset:
+            self._command_offset = 0 # truncated / replaced
+        if size == self._command_offset:
+            return []
+        with open(COMMAND_FILE, 'rb') as f:
+            f.seek(self._command_offset)
+            chunk = f.read(size - self._command_offset)
+        end = chunk.rfind(b'\n') + 1 # only whole lines; the rest is mid-append
+        self._command_offset += end
+        commands = []
+        for line in chunk[:end].splitlines():
+            try:
+                commands.append(json.loads(line))
+            except ValueError:
+                pass
+        return commands
+
+    def post_commands(self, commands):
+        body = ''.join(json.dumps(cmd) + '\n' for cmd in commands)
+        with open(COMMAND_FILE, 'a') as f:
+            f.write(body)
+        self.bytes_written += len(body)
+
+    def acquire_lease(self, holder, ttl):
+        # Heartbeat lock file; the holder is this PID
+        return acquire_lock()
+
+    def release_lease(self, holder):
+        try:
+            with open(LOCK_FILE, 'r') as f:
+                if f.read().strip() == str(os.getpid()):
+                    os.remove(LOCK_FILE)
+        except OSError:
+            pass
+
+    # Writes are split in two: snapshot_*() runs under the domain's lock and
+    # only copies rows; write_*() encodes them and does the disk I/O after
+    # the lock is released.
+    def snapshot_data(self, library, schedule, deleted_files, parts):
+        library_rows = [dict(m) for m in library.to_list()]
+        schedule_rows = [dict(x) for x in schedule.to_list()]
+        library.mark_saved()
+        schedule.mark_saved()
+        return {"library": library_rows, "schedule": schedule_rows, "deleted_files": list(deleted_files)}
+
+    def write_data(self, batch):
+        self._write(DATA_FILE, json.dumps(batch, indent=2), atomic=True)
+        return len(batch['library'])
+
+    def snapshot_votes(self, votes):
+        rows = [dict(v) for v in votes.to_list()]
+        votes.mark_saved()
+        return rows
+
+    def write_votes(self, rows):
+        self._write(VOTE_FILE, json.dumps(rows))
+
+    def write_playback(self, body):
+        # Save volatile state separate for fast writes
+        self._write(STATE_FILE, body)
+
+    def load_jobs(self):
+        return self._read(JOB_FILE)
+
+    def write_jobs(self, body):
+        self._write(JOB_FILE, body, atomic=True)
+
+    def load_report(self, name):
+        """Status saved by the leader for other workers ('ingest', ...), or None"""
+        return self._read(os.path.join(STORAGE_DIR, f"{name}_status.json"))
+
+    def write_report(self, name, body):
+        self._write(os.path.join(STORAGE_DIR, f"{name}_status.json"), body, atomic=True)
+
+    def load_reports(self, prefix):
+        """{name: report} of the saved reports whose name starts with prefix"""
+        reports = {}
+        for fname in os.listdir(STORAGE_DIR):
+            if fname.startswith(prefix) and fname.endswith('_status.json'):
+                name = fname[:-len('_status.json')]
+                try:
+                    reports[name] = self.load_report(name)
+                except (OSError, ValueError):
+                    pass # being replaced or removed
+        return reports
+
+    def delete_report(self, name):
+        path = os.path.join(STORAGE_DIR, f"{name}_status.json")
+        self._seen.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+CHANGE_LOG_KEEP = 10000 # rows kept in the SQLite change feed
+
+class SqliteStorage:
+    """
+    Row-level persistence in SQLite (WAL journal).
+    Library, schedule and votes report their own changed rows; tombstones
+    are diffed against what was last written. Each save is one transaction.
+    Every save also appends (origin, kind, key) rows to the `changes` table,
+    which other processes read in poll_changes() to pick up just those rows.
+    """
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS library (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS schedule (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS tombstones (basename TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS votes (
+            track_id TEXT NOT NULL,
+            listener_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (track_id, listener_id)
+        );
+        CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            kind TEXT NOT NULL,  -- library / schedule / tombstones / votes / playback / command
+            key TEXT             -- changed row, NULL = whole table rewritten; command JSON
+        );
+        CREATE TABLE IF NOT EXISTS lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock() # one connection shared by all threads
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL') # WAL keeps this crash-safe
+        self._conn.executescript(self.SCHEMA)
+        self._tombstones = set()
+        self.bytes_written = 0 # encoded bytes handed to SQLite (metrics)
+        self.origin = uuid.uuid4().hex # tags our rows in `changes`
+        self._cursor = 0               # last `changes` seq we have applied
+        self._data_version = self._query_data_version()
+        self._migrate_json()
+
+    def describe(self):
+        return f"{self.path} (sqlite/WAL)"
+
+    def _query_data_version(self):
+        # Changes only when *another* connection commits
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _migrate_json(self):
+        """One-time import of data.json / state.json / votes.json"""
+        with self._lock:
+            c = self._conn
+            c.execute('BEGIN IMMEDIATE') # Serialize with other processes
+            try:
+                if c.execute("SELECT 1 FROM kv WHERE key = 'migrated'").fetchone():
+                    c.execute('COMMIT')
+                    return
+                imported = []
+                if os.path.exists(DATA_FILE) and not c.execute('SELECT 1 FROM library LIMIT 1').fetchone():
+                    with open(DATA_FILE, 'r') as f:
+                        data = json.load(f)
+                    c.executemany('INSERT OR IGNORE INTO library (id, data) VALUES (?, ?)',
+                                  [(str(m['id']), json.dumps(m)) for m in data.get('library', [])])
+                    c.executemany('INSERT OR REPLACE INTO schedule (id, data) VALUES (?, ?)',
+                                  [(str(x['id']), json.dumps(x)) for x in data.get('schedule', [])])
+                    c.executemany('INSERT OR IGNORE INTO tombstones (basename) VALUES (?)',
+                                  [(bn,) for bn in data.get('deleted_files', [])])
+                    imported.append(DATA_FILE)
+                if os.path.exists(VOTE_FILE):
+                    with open(VOTE_FILE, 'r') as f:
+                        votes = VoteStore(json.load(f)) # assigns keys to legacy votes
+                    c.executemany('INSERT OR REPLACE INTO votes (track_id, listener_id, data) VALUES (?, ?, ?)',
+                                  [(k[0], k[1], json.dumps(v)) for k, v in votes.pending_changes()[1].items()])
+                    imported.append(VOTE_FILE)
+                if os.path.exists(STATE_FILE):
+                    with open(STATE_FILE, 'r') as f:
+                        c.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('playback', ?)", (f.read(),))
+                    imported.append(STATE_FILE)
+                c.execute("INSERT INTO kv (key, value) VALUES ('migrated', ?)", (json.dumps(time.time()),))
+                c.execute('COMMIT')
+                if imported:
+                    print(f"MIGRATED {', '.join(imported)} -> {self.path}")
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+
+    def load_data(self):
+        with self._lock:
+            c = self._conn
+            c.execute('BEGIN') # one consistent read, including the feed position
+            try:
+                library = [json.loads(r[0]) for r in c.execute('SELECT data FROM library ORDER BY seq')]
+                schedule = [json.loads(r[0]) for r in c.execute('SELECT data FROM schedule')]
+                deleted = [r[0] for r in c.execute('SELECT basename FROM tombstones')]
+                self._cursor = c.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+            finally:
+                c.execute('COMMIT')
+            self._data_version = self._query_data_version()
+        self._tombstones = set(deleted)
+        if not library and not schedule and not deleted:
+            return None
+        return {"library": library, "schedule": schedule, "deleted_files": deleted}
+
+    def load_playback(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE key = 'playback'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_votes(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT data FROM votes').fetchall()
+        return [json.loads(r[0]) for r in rows] if rows else None
+
+    def poll_changes(self):
+        """
+        Rows other processes changed since the last poll, or None.
+        Cheap when nothing happened: PRAGMA data_version only moves when
+        another connection commits.
+        """
+        with self._lock:
+            version = self._query_data_version()
+            if version == self._data_version:
+                return None
+            self._data_version = version
+            c = self._conn
+            c.execute('BEGIN')
+            try:
+                oldest = c.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+                rows = c.execute('SELECT seq, origin, kind, key FROM changes WHERE seq > ? ORDER BY seq',
+                                 (self._cursor,)).fetchall()
+                # Fell behind the pruned log: treat everything as rewritten
+                behind = oldest is not None and oldest > self._cursor + 1
+                if rows:
+                    self._cursor = rows[-1][0]
+
+                keys = {}  # kind -> set(key), None = whole table
+                commands = []
+                for _, origin, kind, key in rows:
+                    if kind == 'command':
+                        # Not filtered by origin: whoever leads when it is read runs it
+                        commands.append(json.loads(key))
                         continue
-                    clean_lib.append(item)
-                
-                if removed_dupes > 0:
-                    print(f"Auto-cleaned {removed_dupes} duplicate root items.")
-                    state['library'] = clean_lib
-                    save_data() # Persist cleanup
-
-                # Metadata Debug
-                stat = os.stat(DATA_FILE)
-                mtime = time.ctime(stat.st_mtime)
-                print(f"LOADED {len(state['library'])} items from {DATA_FILE} (Last Mod: {mtime})")
-        except Exception as e:
-            print(f"ERROR LOADING DATA_FILE {DATA_FILE}: {e}")
+                    if origin == self.origin or keys.get(kind, ()) is None:
+                        continue
+                    if key is None:
+                        keys[kind] = None
+                    else:
+                        keys.setdefault(kind, set()).add(key)
+                if behind:
+                    keys = dict.fromkeys(('library', 'schedule', 'tombstones', 'votes', 'playback'))
+                if not keys and not commands:
+                    return None
+
+                changes = {}
+                if commands:
+                    changes['commands'] = commands
+                for kind, table in (('library', 'library'), ('schedule', 'schedule')):
+                    if kind not in keys:
+                        continue
+                    order = ' ORDER BY seq' if table == 'library' else ''
+                    if keys[kind] is None:
+                        items = [json.loads(r[0]) for r in c.execute(f'SELECT data FROM {table}{order}')]
+                        changes[kind] = (True, items, [])
+                    else:
+                        wanted = sorted(keys[kind])
+                        items = []
+                        for i in range(0, len(wanted), 500): # stay under SQLite's variable limit
+                            chunk = wanted[i:i + 500]
+                            q = f'SELECT data FROM {table} WHERE id IN (%s){order}' % ','.join('?' * len(chunk))
+                            items.extend(json.loads(r[0]) for r in c.execute(q, chunk))
+                        found = {str(x['id']) for x in items}
+                        changes[kind] = (False, items, [k for k in wanted if k not in found])
+                if 'tombstones' in keys:
+                    changes['deleted_files'] = [r[0] for r in c.execute('SELECT basename FROM tombstones')]
+                    self._tombstones = set(changes['deleted_files'])
+                if 'votes' in keys:
+                    if keys['votes'] is None:
+                        votes = [json.loads(r[0]) for r in c.execute('SELECT data FROM votes')]
+                        changes['votes'] = (True, votes, [])
+                    else:
+                        votes, removed = [], []
+                        for key in keys['votes']:
+                            tid, lid = json.loads(key)
+                            row = c.execute('SELECT data FROM votes WHERE track_id = ? AND listener_id = ?',
+                                            (tid, lid)).fetchone()
+                            if row: votes.append(json.loads(row[0]))
+                            else: removed.append((tid, lid))
+                        changes['votes'] = (False, votes, removed)
+                if 'playback' in keys:
+                    row = c.execute("SELECT value FROM kv WHERE key = 'playback'").fetchone()
+                    if row: changes['playback'] = json.loads(row[0])
+                return changes
+            finally:
+                c.execute('COMMIT')
+
+    def post_commands(self, commands):
+        rows = [json.dumps(cmd) for cmd in commands]
+        with self._lock, self._conn as c:
+            self._log_changes(c, 'command', False, rows)
+        self.bytes_written += sum(map(len, rows))
+
+    def acquire_lease(self, holder, ttl):
+        """Take or renew the playout lease. True if `holder` now owns it."""
+        now = time.time()
+        with self._lock:
+            c = self._conn
+            c.execute('BEGIN IMMEDIATE')
             try:
-                with open("persistence.log", "a") as log:
-                    log.write(f"{datetime.now()} LOAD ERROR: {e}\n")
-            except: pass
-            
-    # BOOTSTRAP logic...
-    # We want to ensure we at least have the bundled music.
-    # But checking 'not state["library"]' acts as the trigger.
-    
-    # Check bundled content
+                row = c.execute("SELECT holder, expires FROM lease WHERE name = 'playout'").fetchone()
+                if row and row[0] != holder and row[1] > now and lease_holder_alive(row[0]):
+                    return False
+                c.execute("INSERT OR REPLACE INTO lease (name, holder, expires) VALUES ('playout', ?, ?)",
+                          (holder, now + ttl))
+                return True
+            finally:
+                c.execute('COMMIT')
+
+    def release_lease(self, holder):
+        with self._lock, self._conn as c:
+            c.execute("DELETE FROM lease WHERE name = 'playout' AND holder = ?", (holder,))
+
+    def _log_changes(self, c, kind, full, keys):
+        """Append feed rows for a write (inside its transaction)"""
+        if full:
+            c.execute('INSERT INTO changes (origin, kind, key) VALUES (?, ?, NULL)', (self.origin, kind))
+        elif keys:
+            c.executemany('INSERT INTO changes (origin, kind, key) VALUES (?, ?, ?)',
+                          [(self.origin, kind, k) for k in keys])
+
+    def _prune_changes(self, c):
+        c.execute('DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?', (CHANGE_LOG_KEEP,))
+
+    def snapshot_data(self, library, schedule, deleted_files, parts):
+        """Copy only changed library/schedule/tombstone rows (encoded in write_data)"""
+        batch = {"full": False, "upsert": [], "delete": [],
+                 "sched_full": False, "sched_upsert": [], "sched_delete": [], "tombstones": None}
+        if 'library' in parts:
+            full, changed, removed = library.pending_changes()
+            batch['full'] = full
+            batch['upsert'] = [(str(m['id']), dict(m)) for m in changed]
+            batch['delete'] = [(mid,) for mid in removed]
+            batch['tombstones'] = set(deleted_files)
+            library.mark_saved()
+        if 'schedule' in parts:
+            full, changed, removed = schedule.pending_changes()
+            batch['sched_full'] = full
+            batch['sched_upsert'] = [(str(x['id']), dict(x)) for x in changed]
+            batch['sched_delete'] = [(sid,) for sid in removed]
+            schedule.mark_saved()
+        return batch
+
+    def write_data(self, batch):
+        """Apply a snapshot in one transaction. Returns rows written."""
+        tombs = batch['tombstones']
+        batch['upsert'] = [(mid, json.dumps(m)) for mid, m in batch['upsert']]
+        batch['sched_upsert'] = [(sid, json.dumps(x)) for sid, x in batch['sched_upsert']]
+        self.bytes_written += sum(len(r[1]) for r in batch['upsert']) + sum(len(r[1]) for r in batch['sched_upsert'])
+        with self._lock, self._conn as c:
+            if batch['full']:
+                c.execute('DELETE FROM library')
+            c.executemany('INSERT INTO library (id, data) VALUES (?, ?) '
+                          'ON CONFLICT(id) DO UPDATE SET data = excluded.data', batch['upsert'])
+            c.executemany('DELETE FROM library WHERE id = ?', batch['delete'])
+            if batch['sched_full']:
+                c.execute('DELETE FROM schedule')
+            c.executemany('INSERT OR REPLACE INTO schedule (id, data) VALUES (?, ?)', batch['sched_upsert'])
+            c.executemany('DELETE FROM schedule WHERE id = ?', batch['sched_delete'])
+            if tombs is not None:
+                c.executemany('INSERT OR IGNORE INTO tombstones (basename) VALUES (?)',
+                              [(bn,) for bn in tombs - self._tombstones])
+                c.executemany('DELETE FROM tombstones WHERE basename = ?',
+                              [(bn,) for bn in self._tombstones - tombs])
+                self._log_changes(c, 'tombstones', tombs != self._tombstones, ())
+
+            self._log_changes(c, 'library', batch['full'],
+                              [r[0] for r in batch['upsert']] + [r[0] for r in batch['delete']])
+            self._log_changes(c, 'schedule', batch['sched_full'],
+                              [r[0] for r in batch['sched_upsert']] + [r[0] for r in batch['sched_delete']])
+            self._prune_changes(c)
+
+        if tombs is not None:
+            self._tombstones = tombs
+        return len(batch['upsert']) + len(batch['delete']) + len(batch['sched_upsert']) + len(batch['sched_delete'])
+
+    def snapshot_votes(self, votes):
+        full, changed, removed = votes.pending_changes()
+        votes.mark_saved()
+        return {"full": full,
+                "upsert": [(k[0], k[1], dict(v)) for k, v in changed.items()],
+                "delete": removed}
+
+    def write_votes(self, batch):
+        batch['upsert'] = [(tid, lid, json.dumps(v)) for tid, lid, v in batch['upsert']]
+        self.bytes_written += sum(len(r[2]) for r in batch['upsert'])
+        with self._lock, self._conn as c:
+            if batch['full']:
+                c.execute('DELETE FROM votes')
+            c.executemany('INSERT OR REPLACE INTO votes (track_id, listener_id, data) VALUES (?, ?, ?)', batch['upsert'])
+            c.executemany('DELETE FROM votes WHERE track_id = ? AND listener_id = ?', batch['delete'])
+            self._log_changes(c, 'votes', batch['full'],
+                              [json.dumps([k[0], k[1]]) for k in batch['upsert']] +
+                              [json.dumps([k[0], k[1]]) for k in batch['delete']])
+            self._prune_changes(c)
+
+    def write_playback(self, body):
+        with self._lock, self._conn as c:
+            c.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('playback', ?)", (body,))
+            self._log_changes(c, 'playback', True, ())
+        self.bytes_written += len(body)
+
+    def load_jobs(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE key = 'jobs'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_jobs(self, body):
+        # Read on demand by /api/jobs and on takeover, so not in the change feed
+        with self._lock, self._conn as c:
+            c.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('jobs', ?)", (body,))
+        self.bytes_written += len(body)
+
+    def load_report(self, name):
+        """Status saved by the leader for other workers ('ingest', ...), or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE key = ?", ('report:' + name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_report(self, name, body):
+        with self._lock, self._conn as c:
+            c.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", ('report:' + name, body))
+        self.bytes_written += len(body)
+
+    def load_reports(self, prefix):
+        """{name: report} of the saved reports whose name starts with prefix"""
+        key = 'report:' + prefix
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv WHERE substr(key, 1, ?) = ?",
+                                      (len(key), key)).fetchall()
+        return {k[len('report:'):]: json.loads(v) for k, v in rows}
+
+    def delete_report(self, name):
+        with self._lock, self._conn as c:
+            c.execute("DELETE FROM kv WHERE key = ?", ('report:' + name,))
+
+def open_storage():
+    if STORAGE_BACKEND == 'json':
+        return JsonStorage()
+    try:
+        return SqliteStorage(DB_FILE)
+    except Exception as e:
+        print(f"SQLITE STORAGE UNAVAILABLE ({e}). Falling back to JSON files.")
+        return JsonStorage()
+
+storage = open_storage()
+print(f"STORAGE BACKEND: {storage.name}")
+
+def log_persistence_error(kind, e):
+    try:
+        with open("persistence.log", "a") as log:
+            log.write(f"{datetime.now()} {kind} ERROR: {e}\n")
+    except: pass
+
+# --- Bootstrap Scan ---
+# Bundled files (static/media in the app) are added to the library on every
+# start. Their metadata is cached in BOOTSTRAP_CACHE keyed by filename and
+# validated by (size, mtime), so a warm start only stats the directory; new or
+# changed files are read with mutagen on a thread pool (mostly disk reads; a
+# process pool can't be used while this module is still being imported).
+# Fingerprints and art URLs are filled in later by the leader's backfill.
+BOOTSTRAP_CACHE = os.path.join(STORAGE_DIR, 'bootstrap_cache.json')
+BOOTSTRAP_WORKERS = int(os.environ.get('BOOTSTRAP_WORKERS', min(16, (os.cpu_count() or 1) * 4)))
+BOOTSTRAP_POOL_MIN = 32  # fewer new files than this are read inline
+
+def read_bundled_metadata(job):
+    """Pool worker: (filename, duration, art) for one bundled file"""
+    filename, filepath, mid = job
+    duration, art = extract_metadata(filepath, mid)
+    return filename, duration, art
+
+def load_json_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_json_cache(path, cache):
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"CACHE WRITE FAILED ({os.path.basename(path)}): {e}")
+
+def bundled_id(filename):
+    # Derived from the filename so workers bootstrapping at the
+    # same time agree on it instead of adding duplicates.
+    return str(zlib.crc32(filename.encode('utf-8')))
+
+def bundled_in_library(filename):
+    return bool(state['library'].by_basename(filename)) or bundled_id(filename) in state['library']
+
+def scan_bundled_media():
+    """Add bundled files missing from the library. Caller must not hold state_lock."""
     local_static = os.path.join(app.root_path, 'static', 'media')
-    
-    # We should ALWAYS check for bundled content to add any "Hardcoded" songs that might be missing from DB
-    if os.path.exists(local_static):
-        added_count = 0
-        for filename in os.listdir(local_static):
-            if filename in state.get('deleted_files', []):
-                 continue
-
-            if allowed_file(filename):
-                # IMPORTANT: Use string comparison
-                # Check if already in library (by filename or basename)
-                if any(os.path.basename(m['filename']) == filename for m in state['library']):
-                    continue
-                    
-                filepath = os.path.join(local_static, filename)
-                # Generate ID first so we can use it for art
-                mid = str(int(time.time()*1000) + random.randint(1,999))
-                duration, art = extract_metadata(filepath, mid)
-                
-                media_item = {
-                    "id": mid,
-                    "title": os.path.splitext(filename)[0].replace('_', ' '),
-                    "filename": filename,
-                    "duration": duration,
-                    "art": art,  # New Field
-                    "category": "Music", # Default to Music for bootstrap
-                    "type": "audio",
-                    "added_at": time.time()
-                }
-                state['library'].append(media_item)
-                added_count += 1
-        
+    if not os.path.exists(local_static):
+        return 0
+    started = time.time()
+    deleted = set(state.get('deleted_files', []))
+    old_cache = load_json_cache(BOOTSTRAP_CACHE)
+    cache = {}
+    found = []   # (filename, cached metadata or None)
+    with os.scandir(local_static) as entries:
+        for entry in entries:
+            filename = entry.name
+            if filename in deleted or not allowed_file(filename) or not entry.is_file():
+                continue
+            st = entry.stat()
+            hit = old_cache.get(filename)
+            if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns and hit[2] is not None:
+                cache[filename] = hit
+            else:
+                cache[filename] = [st.st_size, st.st_mtime_ns, None, None]
+                hit = None
+            # Check if already in library (by basename, or by ID once ingest
+            # has transcoded it to a new name)
+            if not bundled_in_library(filename):
+                found.append((filename, hit))
+    listed = time.time()
+
+    jobs = [(f, os.path.join(local_static, f), bundled_id(f)) for f, hit in found if not hit]
+    if len(jobs) >= BOOTSTRAP_POOL_MIN and BOOTSTRAP_WORKERS > 1:
+        with ThreadPoolExecutor(max_workers=BOOTSTRAP_WORKERS) as pool:
+            results = list(pool.map(read_bundled_metadata, jobs))
+    else:
+        results = [read_bundled_metadata(job) for job in jobs]
+    for filename, duration, art in results:
+        cache[filename][2:] = [duration, art]
+    extracted = time.time()
+
+    added_count = 0
+    with state_lock:
+        for filename, _ in found:
+            if bundled_in_library(filename):
+                continue # Added meanwhile (another process, via the change feed)
+            _, _, duration, art = cache[filename]
+            state['library'].add({
+                "id": bundled_id(filename),
+                "title": os.path.splitext(filename)[0].replace('_', ' '),
+                "filename": filename,
+                "duration": duration,
+                "art": art,  # New Field
+                "category": "Music", # Default to Music for bootstrap
+                "type": "audio",
+                "added_at": time.time()
+            })
+            added_count += 1
         if added_count > 0:
             print(f"Bootstrapped/Merged {added_count} items from bundled static/media")
-            save_data()
-    
+            save_library()
+    if cache != old_cache:
+        save_json_cache(BOOTSTRAP_CACHE, cache)
+    print(f"BOOTSTRAP SCAN: {len(cache)} files, {len(found)} not in library, {len(jobs)} read; "
+          f"{time.time() - started:.2f}s (list {listed - started:.2f}s, metadata {extracted - listed:.2f}s)")
+    return added_count
+
+def load_data():
+    loaded_from_disk = False
+    # 1. Load persistent data (Library, Schedule)
+    try:
+        data = storage.load_data()
+        if data is not None:
+            raw_library = data.get('library', [])
+            state['schedule'].replace(data.get('schedule', []))
+            state['schedule'].mark_saved()
+            state['deleted_files'] = data.get('deleted_files', [])
+            loaded_from_disk = True
+            
+            # Cleanup Duplicates (Root vs Folder)
+            clean_lib = []
+            folder_basenames = {os.path.basename(x['filename']) for x in raw_library if '/' in x['filename'].replace('\\', '/')}
+            
+            removed_dupes = 0
+            for item in raw_library:
+                bn = os.path.basename(item['filename'])
+                is_root = '/' not in item['filename'].replace('\\', '/')
+                # If this is a root item, and we have a version in a folder, drop the root one
+                if is_root and bn in folder_basenames:
+                    removed_dupes += 1
+                    continue
+                clean_lib.append(item)
+            
+            state['library'].replace(clean_lib)
+            if removed_dupes > 0:
+                print(f"Auto-cleaned {removed_dupes} duplicate root items.")
+                save_library() # Persist cleanup
+            else:
+                state['library'].mark_saved() # Matches disk already
+
+            print(f"LOADED {len(state['library'])} items from {storage.describe()}")
+    except Exception as e:
+        print(f"ERROR LOADING DATA from {storage.describe()}: {e}")
+        log_persistence_error("LOAD", e)
+            
+    # BOOTSTRAP logic...
+    # We should ALWAYS check for bundled content to add any "Hardcoded" songs that might be missing from DB
+    scan_bundled_media()
+
     # 2. Load volatile state (Current Track)
-    if os.path.exists(STATE_FILE):
-        try:
-             with open(STATE_FILE, 'r') as f:
-                s_data = json.load(f)
-                state['current_track'] = s_data.get('current_track')
-                state['playing'] = s_data.get('playing', False)
-                
-                # Restore queue if validity checks pass
-                q = s_data.get('queue', [])
-                # Filter strict string
-                state['queue'] = [str(x) for x in q]
-        except: pass
+    try:
+        s_data = storage.load_playback()
+        if s_data:
+            state['current_track'] = s_data.get('current_track')
+            state['playing'] = s_data.get('playing', False)
+            
+            # Restore queue if validity checks pass
+            q = s_data.get('queue', [])
+            # Filter strict string
+            state['queue'] = [str(x) for x in q]
+            state['hls'] = s_data.get('hls', [])
+    except: pass
 
     # 3. Load votes
-    if os.path.exists(VOTE_FILE):
+    with votes_lock:
         try:
-            with open(VOTE_FILE, 'r') as f:
-                state['votes'] = json.load(f)
+            votes = storage.load_votes()
+            if votes is not None:
+                state['votes'].replace(votes)
+                state['votes'].mark_saved()
         except Exception as e:
             print(f"Error loading votes: {e}")
-            state['votes'] = []
+            state['votes'].clear()
 
-def save_data():
-    # Save persistent data
+# --- Playout Leadership ---
+# Any number of processes (gunicorn workers) may serve requests, but only the
+# holder of the 'playout' lease runs the radio loop and writes playback state.
+# Followers mirror playback from storage through the change feed and hand
+# skip / queue commands to the leader via storage.post_commands().
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 15)) # failover after this many seconds
+LEASE_RENEW = LEASE_TTL / 3
+COMMAND_TTL = 30 # commands nobody picked up in time are dropped
+
+playout_leader = False
+lease_checked_at = 0
+
+def lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def lease_holder_alive(holder):
+    """False only if `holder` is a process on this host that no longer exists"""
+    host, _, pid = holder.rpartition(':')
+    if host != socket.gethostname():
+        return True
     try:
-        temp_file = DATA_FILE + ".tmp"
-        with open(temp_file, 'w') as f:
-            json.dump({
-                "library": state['library'],
-                "schedule": state['schedule'],
-                "deleted_files": state['deleted_files']
-            }, f, indent=2)
-            f.flush()
-            os.fsync(f.fileno()) # FORCE WRITE TO DISK
-        
-        # Atomic Replace
-        os.replace(temp_file, DATA_FILE)
-            
-        print(f"saved data to {DATA_FILE}: {len(state['library'])} items")
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        pass
+    return True
+
+def hold_playout_lease(now):
+    """Acquire or renew the lease when due. True while we are the leader."""
+    global playout_leader, lease_checked_at
+    if now - lease_checked_at < LEASE_RENEW:
+        return playout_leader
+    try:
+        leader = storage.acquire_lease(lease_holder(), LEASE_TTL)
     except Exception as e:
-        print(f"Error saving data: {e}")
+        print(f"LEASE ERROR: {e}")
+        leader = False
+    lease_checked_at = now
+    if leader != playout_leader:
+        print(f"PLAYOUT LEADER {'ACQUIRED' if leader else 'LOST'} (PID: {os.getpid()})")
+        playout_leader = leader
+    return leader
+
+def release_playout_lease():
+    global playout_leader
+    if playout_leader:
+        flush_now() # last playback write while we still own it
+        playout_leader = False
         try:
-            with open("persistence.log", "a") as log:
-                log.write(f"{datetime.now()} SAVE ERROR: {e}\n")
-        except: pass
+            storage.release_lease(lease_holder())
+        except Exception as e:
+            print(f"LEASE RELEASE FAILED: {e}")
+
+# --- Write-Behind Persistence ---
+# save_*() only flag what changed; the flusher thread coalesces the flags and
+# writes every FLUSH_INTERVAL seconds (and on shutdown). Changed rows are
+# copied under state_lock (votes under votes_lock); JSON encoding and disk
+# I/O happen after the locks are released.
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', 2.0))
+
+dirty_parts = set()          # 'library', 'schedule', 'state', 'votes', 'commands' (dirty_lock)
+dirty_lock = threading.Lock()
+flush_lock = threading.Lock() # one flush at a time (keeps write order)
+flush_requested = threading.Event()
+flusher_thread = None
+command_outbox = []          # playout commands waiting for post_commands()
+
+def mark_dirty(*parts):
+    with dirty_lock:
+        dirty_parts.update(parts)
+
+def request_flush():
+    """Flush now instead of at the next interval (other processes are waiting)"""
+    flush_requested.set()
+
+def save_library():
+    # Library items and tombstones
+    mark_dirty('library')
+
+def save_schedule():
+    mark_dirty('schedule')
+
+def save_data():
+    # Library, schedule and tombstones
+    mark_dirty('library', 'schedule')
 
 def save_votes():
-    try:
-        with open(VOTE_FILE, 'w') as f:
-            json.dump(state['votes'], f)
-    except Exception as e:
-        print(f"Error saving votes: {e}")
+    mark_dirty('votes')
 
 def save_state():
-    # Save volatile state separate for fast writes
-    with open(STATE_FILE, 'w') as f:
-        json.dump({
-            "current_track": state['current_track'],
-            "playing": state['playing'],
-            "queue": state['queue']
-        }, f)
+    # Current track, playing flag and queue
+    mark_dirty('state')
+
+def flush_now():
+    """
+    Synchronously write everything that is dirty.
+    Must NOT be called with state_lock held. Returns False if a write failed.
+    """
+    with flush_lock:
+        with state_lock:
+            with dirty_lock:
+                parts = set(dirty_parts)
+                dirty_parts.clear()
+            if not playout_leader:
+                parts.discard('state') # only the leader writes playback
+                parts.discard('jobs')  # ... and runs downloads
+                parts.discard('ingest') # ... ingest
+                parts.discard('repair') # ... and library repair
+            elif time.time() >= listener_sync_at:
+                parts.add('listeners') # merge the other workers' shards even if no one polls us
+            if not parts:
+                return True
+            batches = []
+            try:
+                if parts & {'library', 'schedule'}:
+                    batches.append(('data', storage.snapshot_data(
+                        state['library'], state['schedule'], state['deleted_files'], parts)))
+                if 'votes' in parts:
+                    with votes_lock:
+                        batches.append(('votes', storage.snapshot_votes(state['votes'])))
+                if 'state' in parts:
+                    current = state['current_track']
+                    batches.append(('state', {
+                        "current_track": dict(current) if current else current,
+                        "playing": state['playing'],
+                        "queue": list(state['queue']),
+                        "hls": list(state['hls'])
+                    }))
+                if 'commands' in parts:
+                    batches.append(('commands', command_outbox[:]))
+                    del command_outbox[:]
+                if 'jobs' in parts:
+                    batches.append(('jobs', [dict(job) for job in download_jobs.values()]))
+                if 'ingest' in parts:
+                    batches.append(('ingest', ingest_status()))
+                if 'repair' in parts:
+                    batches.append(('repair', repair_status()))
+                if 'listeners' in parts:
+                    batches.append(('listeners', None)) # shard / merged report, built below outside state_lock
+            except Exception as e:
+                print(f"Error preparing save: {e}")
+                mark_dirty(*parts)
+                return False
+            library_size = len(state['library'])
+
+        # Disk I/O outside state_lock
+        ok = True
+        for kind, batch in batches:
+            try:
+                started = time.perf_counter()
+                bytes_before = storage.bytes_written
+                if kind == 'data':
+                    written = storage.write_data(batch)
+                    print(f"saved data to {storage.name}: {library_size} items ({written} written)")
+                elif kind == 'votes':
+                    storage.write_votes(batch)
+                elif kind == 'commands':
+                    storage.post_commands(batch)
+                elif kind == 'jobs':
+                    storage.write_jobs(json.dumps(batch))
+                elif kind in ('ingest', 'repair'):
+                    storage.write_report(kind, json.dumps(batch))
+                elif kind == 'listeners':
+                    save_listener_report()
+                else:
+                    storage.write_playback(json.dumps(batch))
+                PERSIST_SECONDS.observe(time.perf_counter() - started, kind)
+                PERSIST_BYTES.inc(storage.bytes_written - bytes_before, kind)
+            except Exception as e:
+                ok = False
+                PERSIST_ERRORS.inc(1, kind)
+                print(f"Error saving {kind}: {e}")
+                log_persistence_error("SAVE", e)
+                # Put it back so the next flush retries
+                with state_lock:
+                    if kind == 'data':
+                        state['library'].mark_unsaved()
+                        state['schedule'].mark_unsaved()
+                        mark_dirty(*(parts & {'library', 'schedule'}))
+                    elif kind == 'votes':
+                        with votes_lock:
+                            state['votes'].mark_unsaved()
+                        mark_dirty('votes')
+                    elif kind == 'commands':
+                        command_outbox[:0] = batch
+                        mark_dirty('commands')
+                    elif kind in ('jobs', 'ingest', 'repair', 'listeners'):
+                        mark_dirty(kind)
+                    else:
+                        mark_dirty('state')
+        return ok
+
+def flusher_loop():
+    while True:
+        flush_requested.wait(FLUSH_INTERVAL)
+        flush_requested.clear()
+        try:
+            flush_now()
+        except Exception as e:
+            print(f"FLUSHER ERROR: {e}")
+
+def start_flusher_thread():
+    global flusher_thread
+    if flusher_thread is None or not flusher_thread.is_alive():
+        flusher_thread = threading.Thread(target=flusher_loop, daemon=True)
+        flusher_thread.start()
+
+# Don't lose the last few seconds of changes on a clean shutdown
+atexit.register(flush_now)
+atexit.register(release_playout_lease) # runs first (atexit is LIFO)
+
+# --- Read Snapshots ---
+# GET /api/library, /api/library/folders and /api/schedule/list read
+# immutable copy-on-write snapshots instead of live state. A snapshot is
+# tagged with its store's revision; the first reader to find it stale copies
+# the rows under state_lock (shallow copies, no I/O), builds the new
+# snapshot outside the lock and publishes it with one assignment. Readers of
+# a current snapshot take no lock at all.
+snapshot_lock = threading.Lock() # one rebuild at a time
+library_snapshot = (-1, b'[]', '""', ())  # (revision, JSON body, ETag, items)
+schedule_snapshot = None                   # ScheduleView
+
+class ScheduleView:
+    """Immutable schedule snapshot sorted by run_at"""
+
+    def __init__(self, revision, items):
+        self.revision = revision
+        self.items = tuple(sorted(items, key=lambda x: x['run_at']))
+        self.times = [x['run_at'] for x in self.items]
+
+    def window(self, start=None, end=None, offset=0, limit=None):
+        """(total, items) with start <= run_at < end, sorted by time, paginated"""
+        lo = 0 if start is None else bisect.bisect_left(self.times, start)
+        hi = len(self.items) if end is None else bisect.bisect_left(self.times, end)
+        hi = max(lo, hi)
+        first = lo + offset
+        stop = hi if limit is None else min(hi, first + limit)
+        return hi - lo, list(self.items[first:stop])
+
+def library_view():
+    """(revision, encoded JSON list, ETag, items) of the current library"""
+    global library_snapshot
+    snap = library_snapshot
+    if snap[0] == state['library'].revision:
+        return snap
+    with snapshot_lock:
+        snap = library_snapshot
+        if snap[0] == state['library'].revision:
+            return snap
+        with state_lock:
+            rev = state['library'].revision
+            items = tuple(dict(m) for m in state['library'].to_list())
+        body = json.dumps(items).encode('utf-8')
+        etag = '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest()
+        library_snapshot = snap = (rev, body, etag, items)
+        return snap
+
+def schedule_view():
+    global schedule_snapshot
+    snap = schedule_snapshot
+    if snap is not None and snap.revision == state['schedule'].revision:
+        return snap
+    with snapshot_lock:
+        snap = schedule_snapshot
+        if snap is not None and snap.revision == state['schedule'].revision:
+            return snap
+        with state_lock:
+            rev = state['schedule'].revision
+            items = [dict(x) for x in state['schedule'].to_list()]
+        schedule_snapshot = snap = ScheduleView(rev, items)
+        return snap
+
+# --- Change Feed ---
+# Other processes (admin tools, other workers) write to the same storage.
+# storage.poll_changes() returns only what *they* changed: the SQLite backend
+# reads its `changes` table, the JSON backend re-reads a file only when its
+# signature differs from the version we last loaded or wrote. The watcher
+# thread applies those rows in place and wakes the radio loop.
+# Followers also mirror playback from here, so keep the interval short.
+CHANGE_POLL_INTERVAL = float(os.environ.get('CHANGE_POLL_INTERVAL', 0.5))
+
+change_watcher_thread = None
+
+def apply_external_changes(changes):
+    """Merge a poll_changes() result into state. Caller holds state_lock."""
+    changed = False
+    if 'library' in changes:
+        changed |= state['library'].apply_remote(*changes['library'])
+    if 'schedule' in changes:
+        changed |= state['schedule'].apply_remote(*changes['schedule'])
+    if 'deleted_files' in changes:
+        remote = changes['deleted_files']
+        if 'library' in dirty_parts:
+            # Keep our unsaved tombstones too
+            remote = remote + [bn for bn in state['deleted_files'] if bn not in set(remote)]
+        if set(remote) != set(state['deleted_files']):
+            state['deleted_files'] = list(remote)
+            changed = True
+    if 'votes' in changes:
+        with votes_lock:
+            changed |= state['votes'].apply_remote(*changes['votes'])
+
+    if not playout_leader:
+        # Followers mirror what the leader is playing
+        pb = changes.get('playback')
+        if pb is not None:
+            state['current_track'] = pb.get('current_track')
+            state['playing'] = pb.get('playing', False)
+            state['queue'] = [str(x) for x in pb.get('queue', [])]
+            state['hls'] = pb.get('hls', [])
+            changed = True
+        return changed
+
+    if changed:
+        # Library edits made elsewhere: drop deleted IDs from the queue and
+        # carry title / trim / volume edits over to the track on air
+        state['queue'] = [q for q in state['queue'] if q in state['library']]
+        current = state['current_track']
+        item = state['library'].get(current['id']) if current else None
+        if item:
+            for k in ('title', 'category', 'volume', 'gain', 'art', 'art_id', 'trim_start', 'trim_end', 'lyrics'):
+                if k in item: current[k] = item[k]
+        save_state()
+    now = time.time()
+    for cmd in changes.get('commands', []):
+        handler = PLAYOUT_COMMANDS.get(cmd.get('name'))
+        if handler and now - cmd.get('at', 0) < COMMAND_TTL:
+            try:
+                handler(**cmd.get('args', {}))
+            except Exception as e:
+                print(f"COMMAND {cmd.get('name')} FAILED: {e}")
+            if cmd.get('name') not in QUIET_COMMANDS:
+                save_state()
+                changed = True
+    if changed:
+        request_flush() # followers are waiting for the new playback state
+    return changed
+
+def sync_external_changes():
+    """
+    Pull and apply other processes' writes. Returns True if state changed.
+    Must NOT be called with state_lock held.
+    """
+    # flush_lock: never apply remote rows between a snapshot and its write
+    with flush_lock:
+        changes = storage.poll_changes()
+        if not changes:
+            return False
+        with state_lock:
+            changed = apply_external_changes(changes)
+            if changed:
+                publish_status()
+    if changed:
+        print(f"EXTERNAL CHANGES APPLIED: {', '.join(sorted(changes))}")
+        wake_radio()
+    return changed
+
+def change_watcher_loop():
+    while True:
+        time.sleep(CHANGE_POLL_INTERVAL)
+        try:
+            sync_external_changes()
+        except Exception as e:
+            print(f"CHANGE WATCHER ERROR: {e}")
+
+def start_change_watcher():
+    global change_watcher_thread
+    if change_watcher_thread is None or not change_watcher_thread.is_alive():
+        change_watcher_thread = threading.Thread(target=change_watcher_loop, daemon=True)
+        change_watcher_thread.start()
 
 load_data()
+with state_lock:
+    publish_status()
+start_flusher_thread()
+start_change_watcher()
 
 
 
@@ -314,38 +2708,423 @@ def acquire_lock():
         # Lock is old or missing. Take it.
         with open(LOCK_FILE, 'w') as f:
             f.write(str(os.getpid()))
-        return True
+        # Two processes can race past the freshness check; last writer wins
+        with open(LOCK_FILE, 'r') as f:
+            return f.read().strip() == str(os.getpid())
     except:
         return False
 
-def update_heartbeat():
-    # Deprecated/Redundant given acquire_lock updates it, 
-    # but kept for safety if used elsewhere
-    try:
-        if os.path.exists(LOCK_FILE):
-             os.utime(LOCK_FILE, None)
-    except: pass
+def update_heartbeat():
+    # Deprecated/Redundant given acquire_lock updates it, 
+    # but kept for safety if used elsewhere
+    try:
+        if os.path.exists(LOCK_FILE):
+             os.utime(LOCK_FILE, None)
+    except: pass
+
+# --- Thread Management ---
+radio_thread = None
+
+# Listener Tracking
+# Every worker counts the heartbeats it answers. Every LISTENER_SYNC seconds
+# the other workers save a shard (a sketch of their active IDs plus the recent
+# hour/day sketches) as their own storage report, and the playout leader
+# merges the fresh ones by register max, deletes stale ones and saves the
+# combined report, which the other workers serve. The leader's hour/day
+# sketches are saved every LISTENER_SAVE seconds so a new leader keeps the
+# history.
+LISTENER_TIMEOUT = 30    # Active in last 30s
+LISTENER_BUCKET = 5      # expiry granularity: a listener may count up to this much longer
+LISTENER_HOURS = 48      # hourly unique-listener sketches kept
+LISTENER_DAYS = 31       # daily ones
+LISTENER_SYNC = 5        # seconds between a worker's shards / the leader's report saves
+LISTENER_SAVE = 60       # seconds between saves of the leader's sketches
+LISTENER_SHARD = 'listener_shard-' # report name prefix, followed by the worker
+
+class HyperLogLog:
+    """Approximate distinct count in 2^p one-byte registers (p=12: 4 KB, ~1.6% error)"""
+
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(registers) if registers else bytearray(self.m)
+        self._count = None # cached estimate, dropped when a register grows
+
+    def add(self, key):
+        x = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+            self._count = None
+
+    def merge(self, other):
+        """Union with another sketch of the same size"""
+        merged = bytearray(map(max, self.registers, other.registers))
+        if merged != self.registers:
+            self.registers = merged
+            self._count = None
+
+    def count(self):
+        if self._count is not None:
+            return self._count
+        m = self.m
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros) # small-range correction (linear counting)
+        self._count = int(round(estimate))
+        return self._count
+
+    def dump(self):
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+
+    @classmethod
+    def load(cls, text):
+        return cls(registers=zlib.decompress(base64.b64decode(text)))
+
+class ListenerRegistry:
+    """
+    Active listeners with time-bucketed expiry, plus audience counters.
+    A heartbeat records the listener's last-seen time and files its ID in the
+    current LISTENER_BUCKET-second bucket (once per bucket). Pruning drops
+    whole buckets once they are older than the timeout and only checks the
+    IDs filed in them, so the work is amortised over heartbeats instead of
+    scanning every listener on each /api/status. Each ID filed in a bucket
+    also goes into HyperLogLog sketches for its UTC hour and day, and the
+    highest concurrent count is kept as the peak. On the leader, shards from
+    the other workers are merged in (see Listener Tracking above).
+    Caller holds listener_lock.
+    """
+
+    def __init__(self):
+        self._seen = {}            # listener id -> last heartbeat
+        self._buckets = deque()    # (bucket number, set of ids), oldest first
+        self._hours = OrderedDict() # hour start -> HyperLogLog
+        self._days = OrderedDict()  # day start -> HyperLogLog
+        self._remote = {}          # worker -> (shard time, HyperLogLog of its active IDs)
+        self._total = (0.0, 0)     # (counted at, active across workers)
+        self.peak = 0
+        self.peak_at = None
+
+    def heartbeat(self, lid, now):
+        self._seen[lid] = now
+        b = int(now // LISTENER_BUCKET)
+        if not self._buckets or self._buckets[-1][0] != b:
+            self._buckets.append((b, set()))
+        ids = self._buckets[-1][1]
+        if lid not in ids:
+            ids.add(lid)
+            self._sketch(self._hours, int(now // 3600) * 3600, LISTENER_HOURS).add(lid)
+            self._sketch(self._days, int(now // 86400) * 86400, LISTENER_DAYS).add(lid)
+        self._update_peak(self.total(now), now)
+
+    def active(self, now):
+        """Listeners with a heartbeat to this worker"""
+        cutoff = now - LISTENER_TIMEOUT
+        while self._buckets and (self._buckets[0][0] + 1) * LISTENER_BUCKET <= cutoff:
+            _, ids = self._buckets.popleft()
+            for lid in ids:
+                if self._seen.get(lid, now) < cutoff:
+                    del self._seen[lid]
+        return len(self._seen)
+
+    def total(self, now):
+        """Listeners across workers: ours, plus the shards workers sent lately (leader)"""
+        cutoff = now - LISTENER_TIMEOUT
+        for worker in [w for w, (at, _) in self._remote.items() if at < cutoff]:
+            del self._remote[worker]
+        if not self._remote:
+            return self.active(now)
+        if now - self._total[0] >= 1:
+            # A listener polling several workers counts once
+            hll = self._active_sketch(now)
+            for _, sketch in self._remote.values():
+                hll.merge(sketch)
+            self._total = (now, hll.count())
+        return self._total[1]
+
+    def _active_sketch(self, now):
+        self.active(now)
+        hll = HyperLogLog()
+        for lid in self._seen:
+            hll.add(lid)
+        return hll
+
+    def _update_peak(self, n, now):
+        if n > self.peak:
+            self.peak = n
+            self.peak_at = now
+
+    @staticmethod
+    def _sketch(sketches, start, keep):
+        hll = sketches.get(start)
+        if hll is None:
+            late = bool(sketches) and start < next(reversed(sketches))
+            hll = sketches[start] = HyperLogLog()
+            if late: # from a shard or a saved copy: keep the periods in order
+                for t in sorted(sketches):
+                    sketches.move_to_end(t)
+            while len(sketches) > keep:
+                sketches.popitem(last=False)
+        return hll
+
+    def _merge_sketches(self, saved):
+        for key, sketches, keep in (('hours', self._hours, LISTENER_HOURS), ('days', self._days, LISTENER_DAYS)):
+            for start, text in saved.get(key, {}).items():
+                self._sketch(sketches, int(start), keep).merge(HyperLogLog.load(text))
+
+    def shard(self, now):
+        """What a worker saves for the leader: active IDs and the current and previous hour/day"""
+        return {
+            "at": now,
+            "active": self._active_sketch(now).dump(),
+            "hours": {str(t): h.dump() for t, h in list(self._hours.items())[-2:]},
+            "days": {str(t): h.dump() for t, h in list(self._days.items())[-2:]}
+        }
+
+    def merge_shard(self, worker, shard, now):
+        self._merge_sketches(shard)
+        self._remote[worker] = (shard['at'], HyperLogLog.load(shard['active']))
+        self._total = (0.0, 0) # recount
+        self._update_peak(self.total(now), now)
+
+    def sketches(self):
+        """Everything needed to carry the history over to a new leader"""
+        return {
+            "peak": self.peak, "peak_at": self.peak_at,
+            "hours": {str(t): h.dump() for t, h in self._hours.items()},
+            "days": {str(t): h.dump() for t, h in self._days.items()}
+        }
+
+    def restore(self, saved):
+        self._merge_sketches(saved)
+        if saved.get('peak', 0) > self.peak:
+            self.peak = saved['peak']
+            self.peak_at = saved.get('peak_at')
+
+    def report(self, now):
+        return {
+            "at": now,
+            "active": self.total(now),
+            "workers": 1 + len(self._remote),
+            "peak": self.peak,
+            "peak_at": self.peak_at,
+            "hours": [{"start": t, "unique": h.count()} for t, h in self._hours.items()],
+            "days": [{"start": t, "unique": h.count()} for t, h in self._days.items()]
+        }
+
+listeners = ListenerRegistry()
+listener_lock = TimedLock('listener')
+listener_sync_at = 0.0       # next time this worker sends a shard / saves the report
+listener_saved_at = 0.0      # leader: last save of the sketches
+listener_view = (0.0, None)  # follower: (read at, the leader's saved report)
+
+def update_listeners(lid):
+    global listener_sync_at
+    now = time.time()
+    with listener_lock:
+        listeners.heartbeat(lid, now)
+        due = now >= listener_sync_at
+        if due:
+            listener_sync_at = now + LISTENER_SYNC
+    if due:
+        mark_dirty('listeners') # the flusher saves our shard / the merged report
+
+def leader_listener_report(now):
+    """Follower: the report the leader saved (re-read every LISTENER_SYNC s), or None if stale"""
+    global listener_view
+    read_at, report = listener_view
+    if now - read_at >= LISTENER_SYNC:
+        try:
+            report = storage.load_report('listeners')
+        except Exception as e:
+            print(f"Error loading listener report: {e}")
+            report = None
+        listener_view = (now, report)
+    if report and now - report.get('at', 0) <= LISTENER_TIMEOUT:
+        return report
+    return None # no leader saving: fall back to our own heartbeats
+
+def get_active_listeners():
+    now = time.time()
+    if not playout_leader:
+        report = leader_listener_report(now)
+        if report:
+            return report['active']
+    with listener_lock:
+        return listeners.total(now)
+
+def save_listener_report():
+    """
+    Flusher: a follower saves its shard. The leader merges the other workers'
+    shards and saves the combined report, and the sketches every LISTENER_SAVE s.
+    """
+    global listener_saved_at, listener_sync_at
+    now = time.time()
+    own = LISTENER_SHARD + lease_holder().replace(':', '-')
+    if not playout_leader:
+        with listener_lock:
+            shard = listeners.shard(now)
+        storage.write_report(own, json.dumps(shard))
+        return
+    shards = storage.load_reports(LISTENER_SHARD)
+    stale = [w for w, shard in shards.items() if w == own or now - shard.get('at', 0) > LISTENER_TIMEOUT]
+    sketches = None
+    with listener_lock:
+        listener_sync_at = now + LISTENER_SYNC
+        for worker, shard in shards.items():
+            if worker not in stale:
+                listeners.merge_shard(worker, shard, now)
+        report = listeners.report(now)
+        if now - listener_saved_at >= LISTENER_SAVE:
+            sketches = listeners.sketches()
+    report['pid'] = os.getpid()
+    storage.write_report('listeners', json.dumps(report))
+    if sketches:
+        storage.write_report('listener_sketches', json.dumps(sketches))
+        listener_saved_at = now
+    for worker in stale:
+        storage.delete_report(worker) # stopped, idle, or our own from before we led
+
+def resume_listener_stats():
+    """New leader: merge in the hour/day sketches and peak the last leader saved"""
+    try:
+        saved = storage.load_report('listener_sketches')
+    except Exception as e:
+        print(f"Error loading listener sketches on takeover: {e}")
+        return
+    if saved:
+        with listener_lock:
+            listeners.restore(saved)
+
+# --- Playout Scheduling ---
+# The loop sleeps until the next thing that can change what's on air
+# (track end, temporary item expiry, schedule due while idle) and wake_radio()
+# cuts the sleep short for skip / queue / schedule changes, including ones
+# the change watcher picks up from other processes.
+RADIO_MAX_SLEEP = 60    # idle cap, e.g. nothing to play
+TEMP_ITEM_TTL = 86400   # 'Temporary' items are removed after a day
+
+radio_wakeup = threading.Condition()
+radio_wake_pending = False
+
+def wake_radio():
+    """Make the radio loop re-evaluate now. Safe to call with state_lock held."""
+    global radio_wake_pending
+    with radio_wakeup:
+        radio_wake_pending = True
+        radio_wakeup.notify_all()
+
+def wait_for_radio_event(deadline):
+    global radio_wake_pending
+    with radio_wakeup:
+        if not radio_wake_pending:
+            radio_wakeup.wait(max(0.01, deadline - time.time()))
+        radio_wake_pending = False
+
+# --- Playout Commands ---
+# Skip / queue edits change playback, which only the leader may write.
+# Routes call run_playout_command(); on a follower it is queued for
+# storage.post_commands() and the leader runs it from the change feed.
+PLAYOUT_COMMANDS = {}
+QUIET_COMMANDS = set() # leader-side jobs that leave playback alone
+
+def playout_command(name, playback=True):
+    def register(fn):
+        PLAYOUT_COMMANDS[name] = fn
+        if not playback:
+            QUIET_COMMANDS.add(name)
+        return fn
+    return register
+
+@playout_command('skip')
+def cmd_skip():
+    state['current_track'] = None
+    state['playing'] = False
+
+@playout_command('queue_add')
+def cmd_queue_add(media_id):
+    # Priority: Insert at 0 so it plays NEXT
+    if media_id in state['library']:
+        state['queue'].insert(0, str(media_id))
+
+@playout_command('queue_remove')
+def cmd_queue_remove(media_id):
+    state['queue'] = [q for q in state['queue'] if str(q) != str(media_id)]
+    ensure_queue_filled(exclude_ids=[str(media_id)])
+
+@playout_command('queue_reorder')
+def cmd_queue_reorder(order):
+    state['queue'] = [str(qid) for qid in order if qid in state['library']]
+    ensure_queue_filled()
+
+def run_playout_command(name, **args):
+    """
+    Apply a playback change here if we are the leader, else forward it.
+    Caller holds state_lock. Returns True if it was applied locally.
+    """
+    if not playout_leader:
+        command_outbox.append({"name": name, "args": args, "at": time.time()})
+        mark_dirty('commands')
+        request_flush()
+        return False
+    PLAYOUT_COMMANDS[name](**args)
+    if name in QUIET_COMMANDS:
+        return True
+    save_state()
+    request_flush()
+    publish_status()
+    wake_radio()
+    return True
+
+def track_end_time(current):
+    """When the on-air track finishes (trimmed duration), as a timestamp"""
+    dur = current.get('duration', 1)
+    if not isinstance(dur, (int, float)) or dur <= 0: dur = 10
+    trim_start = current.get('trim_start', 0)
+    trim_end = current.get('trim_end', dur)
+    effective_dur = trim_end - trim_start
+    if effective_dur <= 0: effective_dur = dur # Safety fallback
+    return current['start_time'] + effective_dur
 
-# --- Thread Management ---
-radio_thread = None
+def next_radio_deadline(now, last_disk_check):
+    """Earliest time the loop has work to do. Caller holds state_lock."""
+    deadlines = [now + RADIO_MAX_SLEEP]
 
-# Listener Tracking
-listeners = {} # {ip: timestamp}
-listener_lock = threading.Lock()
+    current = state['current_track']
+    if current:
+        deadlines.append(track_end_time(current))
+    else:
+        # Idle: start a scheduled item as soon as it is due
+        upcoming = state['schedule'].peek_next()
+        if upcoming:
+            deadlines.append(upcoming['run_at'])
 
-def update_listeners(ip):
-    with listener_lock:
-        listeners[ip] = time.time()
+    for item in state['library'].in_category('Temporary'):
+        if item.get('added_at'):
+            deadlines.append(item['added_at'] + TEMP_ITEM_TTL)
 
-def get_active_listeners():
-    with listener_lock:
-        cutoff = time.time() - 30 # Active in last 30s
-        # Prune
-        bad = [k for k,v in listeners.items() if v < cutoff]
-        for k in bad:
-            listeners.pop(k, None)
-        return len(listeners)
+    if not state['library']:
+        deadlines.append(last_disk_check + 10)
 
+    return min(deadlines)
+
+def take_over_playback():
+    """New leader: continue from the saved playback state, not our mirror of it"""
+    try:
+        s_data = storage.load_playback()
+    except Exception as e:
+        print(f"Error loading playback on takeover: {e}")
+        return
+    if s_data:
+        with state_lock:
+            state['current_track'] = s_data.get('current_track')
+            state['playing'] = s_data.get('playing', False)
+            state['queue'] = [str(x) for x in s_data.get('queue', [])]
+            state['hls'] = s_data.get('hls', [])
+            publish_status()
 
 def radio_loop():
     print(f"--- Radio Loop Started (PID: {os.getpid()}) ---")
@@ -363,15 +3142,38 @@ def radio_loop():
 
     last_disk_check = 0
 
+    def fill_queue():
+        # --- Queue Maintenance ---
+        # Caller holds state_lock
+        if ensure_queue_filled():
+            publish_status()
+
     while True:
         # Ghost Thread Check: Am I the official thread?
         if radio_thread and radio_thread != threading.current_thread():
              log_loop("I am a GHOST thread (replaced). Exiting.")
              break
 
+        # --- Leadership: only the lease holder plays out ---
+        was_leader = playout_leader
+        if not hold_playout_lease(time.time()):
+            # Follower: the change watcher mirrors playback; retry the lease later
+            wait_for_radio_event(lease_checked_at + LEASE_RENEW)
+            continue
+        if not was_leader:
+            take_over_playback()
+            resume_download_jobs()
+            resume_repair()
+            resume_listener_stats()
+            queue_metadata_backfill()
+            queue_ingest_backfill()
+            queue_hls_backfill()
+            start_fingerprint_backfill()
+            log_loop("Became playout leader.")
+
         try:
-            time.sleep(1.0) # Tick
             now = time.time()
+            tick_started = time.perf_counter()
             
             # --- Failsafe: Re-bootstrap if empty ---
             if not state['library']:
@@ -379,71 +3181,37 @@ def radio_loop():
                 if now - last_disk_check > 10:
                     log_loop("Library is empty! Attempting force reload/bootstrap...")
                     load_data()
+                    with state_lock:
+                        publish_status()
                     last_disk_check = now
             
+            # Pick up edits other processes saved (cheap when there are none)
+            try:
+                sync_external_changes()
+            except Exception as e:
+                print(f"CHANGE SYNC FAILED: {e}")
+
             with state_lock:
-                # --- Queue Maintenance (Inline to ensure execution) ---
-                target_len = 10
-                q_len = len(state['queue'])
-                if q_len < target_len:
-                    needed = target_len - q_len
-                    # Candidates
-                    music = [m for m in state['library'] if m.get('category') == 'Music']
-                    if music:
-                        hist = set(state['history'])
-                        q_set = set(state['queue'])
-                        added_count = 0
-                        for _ in range(needed):
-                            # Try unplayed
-                            cands = [m for m in music if m['id'] not in hist and str(m['id']) not in q_set]
-                            if not cands: cands = [m for m in music if str(m['id']) not in q_set]
-                            if not cands: break
-                            
-                            pick = random.choice(cands)
-                            state['queue'].append(str(pick['id']))
-                            q_set.add(str(pick['id']))
-                            added_count += 1
-                        
-                        if added_count > 0:
-                            save_data()
+                fill_queue()
                 
-                # Check for Hot Reload
-                try:
-                    if os.path.exists(DATA_FILE):
-                        stat = os.stat(DATA_FILE)
-                        if stat.st_mtime > state.get('last_disk_read', 0):
-                            print(f"DISK CHANGE DETECTED. Reloading library... (Old: {len(state['library'])})")
-                            with open(DATA_FILE, 'r') as f:
-                                data = json.load(f)
-                                # Only update if valid
-                                if 'library' in data:
-                                    state['library'] = data.get('library', [])
-                                    state['schedule'] = data.get('schedule', [])
-                                    state['last_disk_read'] = stat.st_mtime
-                                    print(f"RELOAD COMPLETE. New size: {len(state['library'])}")
-                                    state['queue'] = [str(x) for x in state['queue']]
-                except Exception as e:
-                    print(f"HOT RELOAD FAILED: {e}")
-                # ------------------------------------------
-
                 current = state['current_track']
                 
                 # --- Cleanup ---
                 to_remove = []
-                for item in state['library']:
-                    if item.get('category') == 'Temporary' and item.get('added_at'):
-                        if now - item.get('added_at') > 86400:
+                for item in state['library'].in_category('Temporary'):
+                    if item.get('added_at'):
+                        if now - item.get('added_at') > TEMP_ITEM_TTL:
                             to_remove.append(item)
                 
                 for item in to_remove:
                     try:
                         os.remove(os.path.join(app.config['UPLOAD_FOLDER'], item['filename']))
                     except: pass
-                    if item in state['library']:
-                        state['library'].remove(item)
+                    state['library'].remove(item['id'])
                 
                 if to_remove:
-                    save_data()
+                    save_library()
+                    publish_status()
 
                 # --- Playback Decision ---
                 should_pick = False
@@ -456,16 +3224,14 @@ def radio_loop():
                     if not isinstance(dur, (int, float)) or dur <= 0: dur = 10
                     
                     # Trim Logic:
-                    trim_start = current.get('trim_start', 0)
-                    trim_end = current.get('trim_end', dur)
-                    effective_dur = trim_end - trim_start
-                    if effective_dur <= 0: effective_dur = dur # Safety fallback
+                    effective_dur = track_end_time(current) - current['start_time']
 
                     elapsed = now - current['start_time']
                     
                     # Normal Finish (using trimmed duration)
                     if elapsed >= effective_dur: # Removed buffer, just strict
                         should_pick = True
+                        TRACK_LATENESS.observe(elapsed - effective_dur)
                         log_loop(f"Picking: Track Finished ({elapsed:.1f}s / {effective_dur}s)")
                     
                     # Overdue Failsafe (Safety Net)
@@ -475,36 +3241,23 @@ def radio_loop():
 
                     if should_pick:
                         # Update Last Played
-                        lib_item = next((m for m in state['library'] if m['id'] == current['id']), None)
+                        lib_item = state['library'].get(current['id'])
                         if lib_item:
                             lib_item['last_played_at'] = now
-                            save_data()
+                            state['library'].touch(lib_item)
+                            save_library()
 
                 if should_pick:
-                    # SYNC: Read fresh queue from disk before deciding
-                    try:
-                        if os.path.exists(STATE_FILE):
-                             with open(STATE_FILE, 'r') as f:
-                                 s_data = json.load(f)
-                                 disk_queue = s_data.get('queue', [])
-                                 # Trust disk fully for queue
-                                 state['queue'] = disk_queue
-                    except: pass
-
+                    # Queue edits from other processes arrived via sync_external_changes()
                     next_media = None
 
                     # 1. Schedule
-                    state['schedule'].sort(key=lambda x: x['run_at'])
-                    due_idx = -1
-                    for i, item in enumerate(state['schedule']):
-                        if item['run_at'] <= now:
-                            due_idx = i
-                            break
-                    if due_idx != -1:
-                        item = state['schedule'].pop(due_idx)
+                    item = state['schedule'].pop_due(now)
+                    if item:
+                        save_schedule()
                         log_loop(f"Processing SCHEDULED Item: {item['media_id']} (Due: {item['run_at']})")
                         
-                        media = next((m for m in state['library'] if str(m['id']) == str(item['media_id'])), None)
+                        media = state['library'].get(item['media_id'])
                         if media:
                             next_media = media
                             log_loop(f"Selected SCHEDULED: {media['title']}")
@@ -518,7 +3271,7 @@ def radio_loop():
                          media_id = state['queue'][0] # Peek first
                          log_loop(f"Peeking Queue ID: {media_id}")
                          
-                         media = next((m for m in state['library'] if str(m['id']) == str(media_id)), None)
+                         media = state['library'].get(media_id)
                          
                          if media:
                              state['queue'].pop(0)
@@ -531,119 +3284,1287 @@ def radio_loop():
                      # 3. Shuffle
                     if not next_media:
                         blocklist = ['Sermon', 'Temporary']
-                        candidates = [m for m in state['library'] if m.get('category') not in blocklist]
-                        
-                        history_set = set(state['history'])
-                        final_cands = [m for m in candidates if m['id'] not in history_set]
-                        
-                        if not final_cands:
-                             final_cands = candidates
+                        categories = state['library'].categories()
+                        pick = rotation.draw('shuffle', [c for c in categories if c not in blocklist])
+                        if not pick:
+                             pick = rotation.draw('any', [c for c in categories if c != 'Temporary'])
+
+                        if pick:
+                             next_media = state['library'].get(pick)
+                             log_loop(f"Selected SHUFFLE: {next_media['title']}")
+                        else:
+                             log_loop("No candidates found in library!")
+
+                    if next_media:
+                        state['current_track'] = next_media.copy()
+                        state['current_track'].pop('hls', None) # segment list stays in the library
+                        state['current_track']['start_time'] = time.time()
+                        state['playing'] = True
+                        hls_start_track(state['current_track'], state['current_track']['start_time'])
                         
-                        if not final_cands:
-                             final_cands = [m for m in state['library'] if m.get('category') != 'Temporary']
+                        # Add to history
+                        max_hist = max(10, len(state['library']) - 5)
+                        state['history'].append(next_media['id'], limit=max_hist)
+                    else:
+                        state['current_track'] = None
+                        state['playing'] = False
+                        log_loop("RADIO STOPPED: No media available.")
+                    
+                    # Maintain Queue Depth (Run auto-fill)
+                    # ensure_queue_filled() # logic is inline now
+
+                    # Sync state to disk immediately
+                    save_state()
+                    request_flush() # followers show the new track once it is saved
+                    publish_status()
+
+                    # Top the queue back up right away instead of next wake-up
+                    fill_queue()
+
+                deadline = min(next_radio_deadline(now, last_disk_check), lease_checked_at + LEASE_RENEW)
+            LOOP_TICK.observe(time.perf_counter() - tick_started)
+
+        except Exception as e:
+            print(f"CRITICAL RADIO LOOP ERROR: {e}")
+            try:
+                with open("loop_debug.log", "a") as f:
+                    f.write(f"CRASH: {e}\n")
+            except: pass
+            deadline = time.time() + 1 # Back off before retrying
+            
+        wait_for_radio_event(deadline)
+
+# Thread management lock
+thread_start_lock = threading.Lock()
+
+def start_radio_thread():
+    global radio_thread
+    with thread_start_lock:
+        # Check if actually alive
+        if radio_thread is None or not radio_thread.is_alive():
+            print("Starting Radio Loop Thread...")
+            radio_thread = threading.Thread(target=radio_loop, daemon=True)
+            radio_thread.start()
+
+# Watchdog: Check thread on every request
+@app.before_request
+def watchdog():
+    start_radio_thread()
+    start_flusher_thread()
+    start_change_watcher()
+
+@app.before_request
+def start_request_timer():
+    request.environ['radio.started'] = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = request.environ.get('radio.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition for this worker"""
+    with state_lock:
+        queue_depth = len(state['queue'])
+        library_size = len(state['library'])
+    lines = []
+    for family in metric_families:
+        lines.extend(family.render())
+    for name, doc, value in (
+            ('radio_queue_depth', 'Tracks in the play queue', queue_depth),
+            ('radio_library_tracks', 'Tracks in the library', library_size),
+            ('radio_active_listeners', 'Listeners with a heartbeat in the last 30s (all workers)', get_active_listeners()),
+            ('radio_playout_leader', '1 if this worker runs playout', int(playout_leader))):
+        lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/logs')
+def get_logs():
+    # Helper to view what the loop is doing
+    try:
+        with open("loop_debug.log", "r") as f:
+            lines = f.readlines()
+            return "<br>".join(lines[-50:]) # last 50 lines
+    except:
+        return "No logs"
+
+@app.route('/api/debug/state')
+def debug_state():
+    with state_lock:
+        return jsonify({
+            "playing": state.get('playing'),
+            "current_track": state.get('current_track'),
+            "queue_len": len(state.get('queue', [])),
+            "library_len": len(state.get('library', [])),
+            "history_len": len(state.get('history', [])),
+            "library_sample": [m['title'] for m in state['library'].to_list()[:5]],
+            "queue_dump": state.get('queue'),
+            "thread_alive": radio_thread.is_alive() if radio_thread else False,
+            "pid": os.getpid(),
+            "playout_leader": playout_leader
+        })
+
+@app.route('/api/debug/logs')
+def debug_logs():
+    try:
+        if os.path.exists("loop_debug.log"):
+            with open("loop_debug.log", "r") as f:
+                return "<pre>" + f.read() + "</pre>"
+        return "No logs"
+    except Exception as e:
+        return str(e)
+
+@app.route('/api/stream/current')
+def stream_current():
+    with state_lock:
+        current = state.get('current_track')
+        if current and state.get('playing'):
+            # specific file URL
+            return redirect(f"/static/media/{current['filename']}")
+        else:
+            # Fallback or silent mp3
+            return "Radio Offline", 404
+
+# --- Live Stream (/live) ---
+# One producer thread per process reads the on-air track in real time into a
+# ring buffer and every /live listener is served from that buffer, so disk
+# reads don't grow with the number of listeners. MP3 files are passed through
+# frame-aligned; other formats need ffmpeg on the PATH (transcoded to MP3).
+LIVE_BITRATE = int(os.environ.get('LIVE_BITRATE', 128)) # kbps, ffmpeg transcodes only
+LIVE_CHUNK = 0.25      # seconds of audio per buffer entry
+LIVE_BUFFER = 15       # seconds kept in the ring buffer
+LIVE_BURST = 3         # seconds sent at once to a new listener
+LIVE_IDLE_STOP = 30    # producer exits this long after the last listener leaves
+LIVE_MAX_CLIENTS = int(os.environ.get('LIVE_MAX_CLIENTS', 16)) # each pins a worker thread
+FFMPEG = shutil.which('ffmpeg')
+
+live_cond = threading.Condition()
+live_chunks = deque(maxlen=int(LIVE_BUFFER / LIVE_CHUNK)) # (seq, bytes)
+live_seq = 0      # seq of the newest chunk
+live_clients = 0
+live_thread = None
+
+class Mp3Source:
+    """Reads an MP3's [start, end) window as raw frames at its own bitrate"""
+
+    def __init__(self, path, start, end):
+        info = MutagenFile(path).info
+        self.byte_rate = info.bitrate / 8.0
+        self.f = open(path, 'rb')
+        audio_start, audio_end = self._audio_bounds()
+        self.pos = self._frame_sync(audio_start + int(start * self.byte_rate))
+        self.end = audio_end if end is None else min(audio_end, audio_start + int(end * self.byte_rate))
+
+    def _audio_bounds(self):
+        """Byte range between the ID3v2 header and the ID3v1 trailer"""
+        f = self.f
+        head = f.read(10)
+        start = 0
+        if head[:3] == b'ID3' and len(head) == 10:
+            size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+            start = 10 + size + (10 if head[5] & 0x10 else 0)
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+        return start, end
+
+    def _frame_sync(self, offset):
+        """First plausible MPEG frame header at or after offset"""
+        self.f.seek(offset)
+        buf = self.f.read(8192)
+        for i in range(len(buf) - 3):
+            b1, b2 = buf[i + 1], buf[i + 2]
+            if (buf[i] == 0xFF and (b1 & 0xE0) == 0xE0 and (b1 & 0x06) != 0
+                    and (b2 >> 4) not in (0, 15) and ((b2 >> 2) & 3) != 3):
+                return offset + i
+        return offset
+
+    def read(self, seconds):
+        n = min(int(self.byte_rate * seconds), self.end - self.pos)
+        if n <= 0:
+            return b''
+        self.f.seek(self.pos)
+        data = self.f.read(n)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class FfmpegSource:
+    """Any format, transcoded to MP3 by ffmpeg; reads block on the pipe"""
+
+    def __init__(self, path, start, end):
+        self.byte_rate = LIVE_BITRATE * 1000 / 8.0
+        cmd = [FFMPEG, '-v', 'error', '-ss', f"{start:.3f}"]
+        if end is not None:
+            cmd += ['-t', f"{max(0, end - start):.3f}"]
+        cmd += ['-i', path, '-vn', '-f', 'mp3', '-b:a', f"{LIVE_BITRATE}k", '-']
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def read(self, seconds):
+        return self.proc.stdout.read(int(self.byte_rate * seconds))
+
+    def close(self):
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+
+def open_live_source(current, now):
+    """Source for the on-air track positioned at the station's playhead, or None"""
+    path = media_path(current['filename'])
+    if not path:
+        return None
+    start = current.get('trim_start', 0) + max(0, now - current.get('start_time', now))
+    end = current.get('trim_end')
+    if path.lower().endswith('.mp3'):
+        return Mp3Source(path, start, end)
+    if FFMPEG:
+        return FfmpegSource(path, start, end)
+    print(f"LIVE: cannot stream {current['filename']} without ffmpeg")
+    return None
+
+def live_producer():
+    global live_seq, live_thread
+    source = None
+    source_key = None
+    idle_since = None
+    next_tick = time.time()
+    try:
+        while True:
+            now = time.time()
+            with live_cond:
+                if live_clients > 0:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = now
+                elif now - idle_since > LIVE_IDLE_STOP:
+                    live_thread = None # under live_cond, so a new listener starts a fresh one
+                    live_chunks.clear()
+                    return
+
+            # Follow the station: (track id, start_time) changes on every transition
+            snapshot = status_snapshot
+            key = (snapshot[2], snapshot[3]) if snapshot[4] else None
+            if key != source_key:
+                if source:
+                    source.close()
+                source = None
+                source_key = key
+                if key:
+                    with state_lock:
+                        current = dict(state['current_track']) if state['current_track'] else None
+                    try:
+                        source = open_live_source(current, now) if current else None
+                    except Exception as e:
+                        print(f"LIVE SOURCE ERROR: {e}")
+
+            data = source.read(LIVE_CHUNK) if source else b''
+            if data:
+                with live_cond:
+                    live_seq += 1
+                    live_chunks.append((live_seq, data))
+                    live_cond.notify_all()
+
+            next_tick += LIVE_CHUNK
+            if next_tick < time.time() - 1:
+                next_tick = time.time() # Fell far behind (e.g. suspended): don't race to catch up
+            time.sleep(max(0, next_tick - time.time()))
+    finally:
+        if source:
+            source.close()
+        with live_cond:
+            if live_thread is threading.current_thread():
+                live_thread = None # crashed
+
+def start_live_producer():
+    global live_thread
+    with live_cond:
+        if live_thread is None:
+            live_thread = threading.Thread(target=live_producer, daemon=True)
+            live_thread.start()
+
+@app.route('/live')
+def live_stream():
+    """
+    Continuous MP3 stream of whatever is on air (Icecast-style), for players
+    that can't run the web client's sync logic. New listeners get the last
+    LIVE_BURST seconds at once so playback starts immediately.
+    """
+    global live_clients
+    with live_cond:
+        if live_clients >= LIVE_MAX_CLIENTS:
+            return "Too many listeners", 503
+        live_clients += 1
+    start_live_producer()
+    lid = 'live-' + uuid.uuid4().hex[:12] # counts as a listener while connected
+
+    def stream():
+        with live_cond:
+            burst = int(LIVE_BURST / LIVE_CHUNK)
+            cursor = live_seq - min(burst, len(live_chunks))
+        last_seen = 0
+        while True:
+            with live_cond:
+                if live_seq == cursor:
+                    live_cond.wait(LIVE_BUFFER)
+                # Slow client that fell out of the buffer skips ahead
+                first = live_seq - len(live_chunks)
+                cursor = max(cursor, first)
+                data = b''.join(c for _, c in itertools.islice(live_chunks, cursor - first, None))
+                cursor = live_seq
+            now = time.time()
+            if now - last_seen > 10:
+                update_listeners(lid)
+                last_seen = now
+            if data:
+                yield data
+
+    def release():
+        global live_clients
+        with live_cond:
+            live_clients -= 1
+
+    resp = Response(stream(), mimetype='audio/mpeg', headers={
+        'Cache-Control': 'no-cache, no-store',
+        'X-Accel-Buffering': 'no',
+        'icy-name': 'Grace Radio',
+        'icy-br': str(LIVE_BITRATE)
+    })
+    resp.call_on_close(release) # also runs for HEAD and early disconnects
+    return resp
+
+# --- HLS ---
+# Each track is cut once into fixed-length AAC segments under HLS_DIR/<id>/
+# (needs ffmpeg). When the playout loop starts a track it appends a timeline
+# entry, and /hls/live.m3u8 lists the last HLS_WINDOW segments that have
+# finished airing. Segment URLs carry a hash of the segment set
+# (/hls/<id>/<ver>/<n>.ts), so a track that is cut again gets new URLs and
+# a CDN can cache each one forever; only the small playlist is dynamic.
+# The timeline is saved with playback state, so every worker serves the
+# same sequence numbers.
+HLS_DIR = os.path.abspath(os.path.join(STORAGE_DIR, 'hls'))
+HLS_SEGMENT = 6          # target segment length, seconds
+HLS_WINDOW = 6           # segments listed in the live playlist
+HLS_TIMELINE_KEEP = 3    # tracks kept in state['hls']
+
+hls_cond = threading.Condition()
+hls_pending = deque()    # media IDs waiting to be segmented
+hls_thread = None
+
+def hls_dir(media_id):
+    return os.path.join(HLS_DIR, secure_filename(str(media_id)))
+
+def hls_track_segments(item):
+    """[[index, duration, end offset from track start]] within the trim window"""
+    durations = item.get('hls') or []
+    trim_start = item.get('trim_start', 0)
+    trim_end = item.get('trim_end') or sum(durations)
+    segs = []
+    pos = 0.0
+    for idx, dur in enumerate(durations):
+        seg_start, pos = pos, pos + dur
+        if pos > trim_start and seg_start < trim_end:
+            segs.append([idx, dur, round(pos - trim_start, 3)])
+    return segs
+
+def hls_start_track(track, now):
+    """Append the new on-air track to the HLS timeline. Caller holds state_lock."""
+    timeline = state['hls']
+    seq = disc = 0
+    if timeline:
+        last = timeline[-1]
+        # Sequence continues after the segments of the last track that fully aired
+        seq = last['seq'] + sum(1 for seg in last['segs'] if last['start'] + seg[2] <= now)
+        disc = last['disc'] + 1
+    item = state['library'].get(track['id'])
+    timeline.append({
+        "id": str(track['id']), "start": now, "seq": seq, "disc": disc,
+        "ver": item.get('hls_ver') if item else None,
+        "segs": hls_track_segments(item) if item else []
+    })
+    del timeline[:-HLS_TIMELINE_KEEP]
+
+def hls_playlist(timeline, now):
+    """Live media playlist text for a timeline snapshot, or None if nothing aired yet"""
+    listed = []
+    for i, entry in enumerate(timeline):
+        cutoff = min(now, timeline[i + 1]['start']) if i + 1 < len(timeline) else now
+        for k, (idx, dur, end) in enumerate(entry['segs']):
+            if entry['start'] + end <= cutoff:
+                listed.append((entry['seq'] + k, entry, idx, dur))
+    listed = listed[-HLS_WINDOW:]
+    if not listed:
+        return None
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{max(HLS_SEGMENT, math.ceil(max(x[3] for x in listed)))}",
+        f"#EXT-X-MEDIA-SEQUENCE:{listed[0][0]}",
+        f"#EXT-X-DISCONTINUITY-SEQUENCE:{listed[0][1]['disc']}",
+    ]
+    prev = listed[0][1]
+    for _, entry, idx, dur in listed:
+        if entry is not prev:
+            lines.append("#EXT-X-DISCONTINUITY")
+            prev = entry
+        lines.append(f"#EXTINF:{dur:.3f},")
+        lines.append(f"/hls/{entry['id']}/{entry['ver']}/{idx}.ts")
+    return "\n".join(lines) + "\n"
+
+def segment_for_hls(media_id):
+    """Cut one library track into HLS segments and record their durations,
+    or drop the segments of a track that is no longer in the library"""
+    with state_lock:
+        item = state['library'].get(media_id)
+        filename = item['filename'] if item else None
+        gain = item.get('gain', 1.0) if item else 1.0
+    out = hls_dir(media_id)
+    if not item:
+        shutil.rmtree(out, ignore_errors=True)
+        return
+    path = media_path(filename) if filename else None
+    if not path:
+        return
+    tmp = out + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    cmd = [FFMPEG, '-v', 'error', '-y', '-i', path, '-vn',
+           '-af', f"volume={gain:.4f}", # ingest loudness gain; browsers apply it themselves
+           '-c:a', 'aac', '-b:a', f"{LIVE_BITRATE}k",
+           '-f', 'hls', '-hls_time', str(HLS_SEGMENT), '-hls_playlist_type', 'vod',
+           '-hls_segment_filename', os.path.join(tmp, '%05d.ts'), os.path.join(tmp, 'index.m3u8')]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        shutil.rmtree(tmp, ignore_errors=True)
+        print(f"HLS SEGMENTING FAILED for {filename}: {result.stderr.strip()[:200]}")
+        return
+    with open(os.path.join(tmp, 'index.m3u8')) as f:
+        durations = [round(float(line[8:].split(',')[0]), 3) for line in f if line.startswith('#EXTINF:')]
+    h = hashlib.blake2b(digest_size=8)
+    for idx in range(len(durations)):
+        with open(os.path.join(tmp, f"{idx:05d}.ts"), 'rb') as f:
+            h.update(f.read())
+    # Swap in the finished directory so readers never see a partial set
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    with state_lock:
+        item = state['library'].get(media_id)
+        if item:
+            item['hls'] = durations
+            item['hls_ver'] = h.hexdigest()
+            state['library'].touch(item)
+            save_library()
+    print(f"HLS: segmented {filename} ({len(durations)} segments)")
+
+def hls_worker():
+    while True:
+        with hls_cond:
+            while not hls_pending:
+                hls_cond.wait()
+            media_id = hls_pending.popleft()
+        try:
+            segment_for_hls(media_id)
+        except Exception as e:
+            print(f"HLS WORKER ERROR: {e}")
+
+def queue_hls(media_id):
+    """Segment a track in the background (no-op without ffmpeg)"""
+    global hls_thread
+    if not FFMPEG:
+        return
+    with hls_cond:
+        if media_id not in hls_pending:
+            hls_pending.append(media_id)
+        if hls_thread is None or not hls_thread.is_alive():
+            hls_thread = threading.Thread(target=hls_worker, daemon=True)
+            hls_thread.start()
+        hls_cond.notify()
+
+def queue_hls_backfill():
+    """Leader only: segment library tracks that predate HLS or failed before"""
+    with state_lock:
+        # Tracks still waiting for ingest are segmented when it finishes
+        missing = [m['id'] for m in state['library'] if not m.get('hls') and 'loudness' in m]
+    for mid in missing:
+        queue_hls(mid)
+
+@app.route('/hls/live.m3u8')
+def hls_live_playlist():
+    with state_lock:
+        timeline = list(state['hls'])
+    body = hls_playlist(timeline, time.time())
+    if body is None:
+        return "No HLS segments on air", 404
+    return Response(body, mimetype='application/vnd.apple.mpegurl', headers={
+        'Cache-Control': 'max-age=1' # changes every segment; CDNs may hold it briefly
+    })
+
+@app.route('/hls/<media_id>/<ver>/<int:index>.ts')
+def hls_segment(media_id, ver, index):
+    item = state['library'].get(media_id) # single dict lookup; no lock needed
+    if not item or item.get('hls_ver') != ver:
+        return "Segment replaced", 404 # re-cut since this playlist was written
+    resp = send_from_directory(hls_dir(media_id), f"{index:05d}.ts", mimetype='video/mp2t', max_age=31536000)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+# --- Ingest Pipeline ---
+# Every new track (upload, YouTube, bundled file) is measured once for EBU R128
+# integrated loudness and true peak by ffmpeg, at most INGEST_WORKERS at a time
+# and off the request threads (the pool threads only wait on the ffmpeg
+# processes; a fork pool deadlocks when the leader backfill runs while this
+# module is still being imported). The result is stored on the library item as `gain` (linear), which
+# players multiply into the per-track `volume`, so tracks air at a common level
+# without touching the file. With INGEST_CODEC set, files in another codec or
+# above INGEST_BITRATE are also transcoded. Ingest finishing queues HLS.
+# Jobs run on the playout leader (other workers forward new tracks as a
+# playout command); the leader saves the job list so any worker can answer
+# /api/admin/ingest.
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', max(1, min(2, (os.cpu_count() or 1) // 2))))
+INGEST_TARGET_LUFS = float(os.environ.get('INGEST_TARGET_LUFS', -16.0))
+INGEST_MAX_PEAK = -1.0   # dBTP ceiling after gain
+INGEST_MAX_GAIN = 12.0   # dB, don't blow up near-silent recordings
+INGEST_CODEC = os.environ.get('INGEST_CODEC', '')   # '' (keep files), 'mp3' or 'aac'
+INGEST_BITRATE = int(os.environ.get('INGEST_BITRATE', 192)) # kbps
+INGEST_HISTORY = 200     # finished jobs kept for /api/admin/ingest
+INGEST_CODECS = {'mp3': ('libmp3lame', '.mp3'), 'aac': ('aac', '.m4a')}
+
+ingest_lock = threading.Lock()
+ingest_jobs = OrderedDict() # media_id -> job dict, leader only
+ingest_pool = None
+
+def measure_and_transcode(path, ffmpeg, codec, bitrate, out_path):
+    """
+    Runs on the ingest pool: one ffmpeg decode measures loudness (ebur128) and,
+    if the file needs transcoding, writes it to out_path. Returns a plain dict.
+    """
+    started = time.time()
+    if out_path:
+        current_codec, rate = probe_audio(path)
+        if current_codec == codec and (rate is None or rate <= bitrate * 1.1):
+            out_path = None
+    cmd = [ffmpeg, '-nostats', '-hide_banner', '-y', '-i', path, '-map', '0:a:0',
+           '-af', 'ebur128=peak=true']
+    if out_path:
+        cmd += ['-map_metadata', '0', '-c:a', INGEST_CODECS[codec][0], '-b:a', f"{bitrate}k", out_path]
+    else:
+        cmd += ['-f', 'null', '-']
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+    if result.returncode != 0:
+        return {"error": result.stderr.strip()[-300:]}
+    # Summary block is printed last: "I: -14.2 LUFS" ... "Peak: -0.3 dBFS"
+    summary = result.stderr[result.stderr.rfind('Summary:'):]
+    loud = re.search(r'I:\s+(-?[\d.]+|-inf) LUFS', summary)
+    peak = re.search(r'Peak:\s+(-?[\d.]+|-inf) dBFS', summary)
+    if not loud:
+        return {"error": "no loudness summary in ffmpeg output"}
+    return {
+        "i": float(loud.group(1)),
+        "tp": float(peak.group(1)) if peak else None,
+        "output": out_path,
+        "seconds": round(time.time() - started, 2)
+    }
+
+def probe_audio(path):
+    """(codec_name, bit_rate kbps) of the first audio stream, or (None, None)"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return None, None
+    try:
+        out = subprocess.run([ffprobe, '-v', 'error', '-select_streams', 'a:0',
+                              '-show_entries', 'stream=codec_name,bit_rate:format=bit_rate',
+                              '-of', 'json', path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        info = json.loads(out or '{}')
+        stream = (info.get('streams') or [{}])[0]
+        rate = stream.get('bit_rate') or info.get('format', {}).get('bit_rate')
+        return stream.get('codec_name'), (int(rate) // 1000 if rate else None)
+    except Exception:
+        return None, None
+
+def transcode_target(path, media_id):
+    """Where a transcoded copy would go (the pool decides if it's needed), or None"""
+    if INGEST_CODEC not in INGEST_CODECS:
+        return None
+    ext = INGEST_CODECS[INGEST_CODEC][1]
+    base = os.path.splitext(os.path.basename(path))[0]
+    folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    out = os.path.join(folder, base + ext)
+    if os.path.exists(out) and os.path.abspath(out) != os.path.abspath(path):
+        out = os.path.join(folder, f"{base}-{media_id}{ext}") # don't clobber another track
+    return out
+
+def loudness_gain(i, tp):
+    """Linear gain that brings integrated loudness to the target without clipping"""
+    if i is None or math.isinf(i):
+        return 1.0
+    gain_db = INGEST_TARGET_LUFS - i
+    if tp is not None and not math.isinf(tp):
+        gain_db = min(gain_db, INGEST_MAX_PEAK - tp)
+    gain_db = max(-INGEST_MAX_GAIN, min(INGEST_MAX_GAIN, gain_db))
+    return round(10 ** (gain_db / 20), 4)
+
+def get_ingest_pool():
+    global ingest_pool
+    with ingest_lock:
+        if ingest_pool is None:
+            ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+        return ingest_pool
+
+def queue_ingest(media_id):
+    """Measure (and maybe transcode) a track in the background; HLS follows"""
+    media_id = str(media_id)
+    if not FFMPEG:
+        queue_hls(media_id) # no-op as well without ffmpeg
+        return
+    with state_lock:
+        if playout_leader:
+            submit_ingest(media_id)
+        else:
+            # Posted after the library rows of the same flush, so the
+            # leader already has the track when it runs the command
+            run_playout_command('ingest', media_id=media_id)
+
+@playout_command('ingest', playback=False)
+def submit_ingest(media_id):
+    """Put one track on the ingest pool. Leader only; caller holds state_lock."""
+    item = state['library'].get(media_id)
+    filename = item['filename'] if item else None
+    path = media_path(filename) if filename else None
+    if not path:
+        return
+    with ingest_lock:
+        job = ingest_jobs.get(media_id)
+        if job and job['status'] in ('queued', 'running'):
+            return
+    out_path = transcode_target(path, media_id)
+    job = {"media_id": media_id, "title": item['title'], "filename": filename, "status": "queued",
+           "queued_at": time.time(), "finished_at": None, "transcoded": False, "error": None}
+    tmp_out = out_path + '.part' + os.path.splitext(out_path)[1] if out_path else None
+    try:
+        future = get_ingest_pool().submit(run_ingest, job, path, tmp_out)
+    except Exception as e:
+        print(f"INGEST SUBMIT FAILED for {filename}: {e}")
+        return
+    with ingest_lock:
+        ingest_jobs[media_id] = job
+        ingest_jobs.move_to_end(media_id)
+    mark_dirty('ingest')
+    future.add_done_callback(lambda f: finish_ingest(job, path, out_path, tmp_out, f))
+
+def run_ingest(job, path, tmp_out):
+    with ingest_lock:
+        job.update(status='running', started_at=time.time())
+    mark_dirty('ingest')
+    return measure_and_transcode(path, FFMPEG, INGEST_CODEC, INGEST_BITRATE, tmp_out)
+
+def finish_ingest(job, path, out_path, tmp_out, future):
+    """Pool callback: store the measured gain / new file on the library item"""
+    try:
+        apply_ingest(job, path, out_path, tmp_out, future)
+    except Exception as e:
+        # Otherwise the job would stay 'running' forever
+        job.update(status='failed', error=f"finishing: {e}", finished_at=time.time())
+        print(f"INGEST FAILED for {job['filename']} while finishing: {e}")
+    with ingest_lock:
+        finished = [k for k, j in ingest_jobs.items() if j['status'] in ('done', 'failed')]
+        for k in finished[:-INGEST_HISTORY]:
+            del ingest_jobs[k]
+    mark_dirty('ingest')
+    request_flush()
+    queue_hls(job['media_id'])
+
+def apply_ingest(job, path, out_path, tmp_out, future):
+    media_id = job['media_id']
+    try:
+        result = future.result()
+    except Exception as e:
+        result = {"error": str(e)}
+    if result.get('error'):
+        if tmp_out and os.path.exists(tmp_out):
+            os.remove(tmp_out)
+        job.update(status='failed', error=result['error'], finished_at=time.time())
+        print(f"INGEST FAILED for {job['filename']}: {result['error']}")
+    else:
+        new_filename = None
+        if result['output']:
+            os.replace(tmp_out, out_path)
+            new_filename = os.path.basename(out_path)
+            media_paths.pop(('media', new_filename), None)
+        gain = loudness_gain(result['i'], result['tp'])
+        entry = media_file('media', new_filename) if new_filename else None
+        with state_lock:
+            item = state['library'].get(media_id)
+            if item:
+                item['gain'] = gain
+                item['loudness'] = {"i": result['i'], "tp": result['tp'], "target": INGEST_TARGET_LUFS}
+                if new_filename:
+                    item['filename'] = new_filename
+                    item['fp'] = entry[3] if entry else None
+                state['library'].reindex(item)
+                current = state['current_track']
+                if current and str(current['id']) == media_id:
+                    current['gain'] = gain
+                    save_state()
+                save_library()
+                publish_status()
+        # The old file goes once the library points at the new one
+        if new_filename and os.path.abspath(out_path) != os.path.abspath(path) \
+                and os.path.dirname(os.path.abspath(path)) == os.path.abspath(app.config['UPLOAD_FOLDER']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        job.update(status='done', gain=gain, loudness=result['i'], true_peak=result['tp'],
+                   seconds=result['seconds'], transcoded=bool(new_filename), filename=new_filename or job['filename'], finished_at=time.time())
+        print(f"INGEST: {job['filename']} {result['i']} LUFS, peak {result['tp']} dBTP -> gain {gain}")
+
+def queue_ingest_backfill():
+    """Leader only: ingest library tracks added before the pipeline (or bundled)"""
+    with state_lock:
+        missing = [m['id'] for m in state['library'] if 'loudness' not in m]
+    for mid in missing:
+        queue_ingest(mid)
+
+def ingest_status():
+    with ingest_lock:
+        jobs = [dict(job) for job in reversed(ingest_jobs.values())]
+    counts = {}
+    for job in jobs:
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    return {
+        "pid": os.getpid(),
+        "ffmpeg": bool(FFMPEG),
+        "workers": INGEST_WORKERS,
+        "target_lufs": INGEST_TARGET_LUFS,
+        "codec": INGEST_CODEC or None,
+        "bitrate": INGEST_BITRATE,
+        "counts": counts,
+        "jobs": jobs
+    }
+
+@app.route('/api/admin/ingest')
+def ingest_admin_status():
+    """Ingest jobs: the leader's own list, or the copy it last saved"""
+    if playout_leader:
+        return jsonify(ingest_status())
+    try:
+        saved = storage.load_report('ingest')
+    except Exception as e:
+        print(f"Error loading ingest status: {e}")
+        saved = None
+    return jsonify(saved or {"ffmpeg": bool(FFMPEG), "counts": {}, "jobs": []})
+
+# --- Library Repair ---
+# Re-reads track durations with ffprobe as a background job: REPAIR_WORKERS
+# probes run at once without holding state_lock, and fixes are applied to the
+# library REPAIR_BATCH tracks at a time. Probed durations are cached in
+# REPAIR_CACHE by track id and checked by (size, mtime), so a repeat run only
+# probes new or changed files. Runs on the playout leader, one at a time
+# (other workers forward the request); the leader saves the job status so
+# any worker can report progress, and a new leader restarts a run that was
+# interrupted.
+REPAIR_CACHE = os.path.join(STORAGE_DIR, 'repair_cache.json')
+REPAIR_WORKERS = int(os.environ.get('REPAIR_WORKERS', 4))
+REPAIR_BATCH = 50        # probed tracks per library save
+REPAIR_TOLERANCE = 5     # seconds off before a duration is fixed
+REPAIR_LISTED = 500      # fixes listed in the result
+
+repair_lock = threading.Lock()
+repair_job = {"status": "idle"}
+
+def probe_duration(path):
+    """Container duration in seconds via ffprobe, or None"""
+    ffprobe = shutil.which('ffprobe')
+    if not ffprobe:
+        return None
+    try:
+        out = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration',
+                              '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=60).stdout
+        return float(out.strip())
+    except Exception:
+        return None
+
+def apply_repairs(batch):
+    """Set the probed durations that are off by more than REPAIR_TOLERANCE"""
+    fixed = []
+    with state_lock:
+        for mid, real in batch:
+            item = state['library'].get(mid)
+            if not item:
+                continue # deleted meanwhile
+            old = item.get('duration', 0)
+            if isinstance(old, (int, float)) and abs(real - old) <= REPAIR_TOLERANCE:
+                continue
+            item['duration'] = real
+            state['library'].touch(item)
+            fixed.append({"id": mid, "title": item.get('title'), "old": old, "new": real})
+        if fixed:
+            save_library()
+    return fixed
+
+def run_repair(job):
+    with state_lock:
+        tracks = [(m['id'], m['filename']) for m in state['library']]
+    job['total'] = len(tracks)
+    mark_dirty('repair')
+    old_cache = load_json_cache(REPAIR_CACHE)
+    cache = {}
+    known = []   # (id, cached duration): unchanged files, no probe needed
+    todo = []    # (id, path, size, mtime_ns)
+    for mid, filename in tracks:
+        path = media_path(filename)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if not st:
+            job['missing'] += 1
+            continue
+        hit = old_cache.get(mid)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            cache[mid] = hit
+            known.append((mid, hit[2]))
+        else:
+            todo.append((mid, path, st.st_size, st.st_mtime_ns))
+    job['skipped'] = len(known)
+
+    def record(fixed):
+        job['fixed_count'] += len(fixed)
+        room = REPAIR_LISTED - len(job['fixed'])
+        job['fixed'].extend(fixed[:max(room, 0)])
+        mark_dirty('repair')
+
+    # The cached duration may still disagree with an edited library entry
+    for i in range(0, len(known), REPAIR_BATCH):
+        record(apply_repairs(known[i:i + REPAIR_BATCH]))
+    job['checked'] = len(known)
+
+    batch = []
+    with ThreadPoolExecutor(max_workers=REPAIR_WORKERS) as pool:
+        for (mid, path, size, mtime_ns), real in zip(todo, pool.map(lambda t: probe_duration(t[1]), todo)):
+            job['checked'] += 1
+            job['probed'] += 1
+            mark_dirty('repair') # progress for the other workers
+            if real is None:
+                job['failed'] += 1
+                print(f"Repair failed for {os.path.basename(path)}")
+                continue
+            cache[mid] = [size, mtime_ns, real]
+            batch.append((mid, real))
+            if len(batch) >= REPAIR_BATCH:
+                record(apply_repairs(batch))
+                batch = []
+    if batch:
+        record(apply_repairs(batch))
+    if cache != old_cache:
+        save_json_cache(REPAIR_CACHE, cache)
+
+def repair_thread(job):
+    try:
+        run_repair(job)
+        job['status'] = 'done'
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        print(f"REPAIR ERROR: {e}")
+    job['finished_at'] = time.time()
+    mark_dirty('repair')
+    request_flush()
+    print(f"REPAIR: {job['checked']}/{job['total']} checked, {job['probed']} probed, "
+          f"{job['skipped']} unchanged, {job['fixed_count']} fixed, {job['failed']} failed")
+
+@playout_command('repair_start', playback=False)
+def start_repair():
+    """Start a repair run unless one is going (leader only); returns (job, started)"""
+    global repair_job
+    with repair_lock:
+        if repair_job['status'] == 'running':
+            return repair_job, False
+        repair_job = {
+            "status": "running", "pid": os.getpid(), "started_at": time.time(), "finished_at": None,
+            "total": 0, "checked": 0, "probed": 0, "skipped": 0, "missing": 0, "failed": 0,
+            "fixed_count": 0, "fixed": [], "error": None
+        }
+        threading.Thread(target=repair_thread, args=(repair_job,), daemon=True).start()
+        mark_dirty('repair')
+        return repair_job, True
+
+def repair_status():
+    """The leader's run, or the copy it last saved"""
+    if not playout_leader:
+        try:
+            return storage.load_report('repair') or {"status": "idle"}
+        except Exception as e:
+            print(f"Error loading repair status: {e}")
+            return {"status": "idle"}
+    job = dict(repair_job)
+    if 'fixed' in job:
+        job['fixed'] = list(job['fixed'])
+    return job
+
+def resume_repair():
+    """New leader: restart a run the old leader didn't finish (cached probes are kept)"""
+    try:
+        saved = storage.load_report('repair')
+    except Exception as e:
+        print(f"Error loading repair status on takeover: {e}")
+        return
+    if saved and saved.get('status') == 'running' and repair_job['status'] != 'running':
+        print("RESUMING library repair")
+        start_repair()
+
+# --- Bulk Upload ---
+# /api/upload parts are streamed straight into a temp file in the upload
+# folder while their content fingerprint (the same blake2b as item['fp']) is
+# computed, so a part is written once and never re-read. Content already in
+# the library is skipped; new files are renamed into place, fsynced, added as
+# `pending` items and confirmed saved through flush_now(). Duration / art are
+# read by a background worker, after which the track joins rotation and
+# goes to ingest.
+METADATA_BATCH = 64      # items the metadata worker applies per library save
+
+class HashingUpload:
+    """Temp file in the upload folder that fingerprints what is written to it"""
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-', suffix='.part', delete=False)
+        self._hash = hashlib.blake2b(digest_size=8)
+        self.name = self._file.name
+        self.size = 0
+        self.done = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name) # seek / read / tell / close for werkzeug
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def commit(self, dest):
+        """Durably move the upload to `dest`"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.name, dest)
+        self.done = True
+
+    def discard(self):
+        if self.done:
+            return
+        self.done = True
+        self._file.close()
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
 
-                        if final_cands:
-                             next_media = random.choice(final_cands)
-                             log_loop(f"Selected SHUFFLE: {next_media['title']}")
-                        else:
-                             log_loop("No candidates found in library!")
+class RadioRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'upload_file':
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        part = HashingUpload(app.config['UPLOAD_FOLDER'])
+        self.upload_parts = getattr(self, 'upload_parts', []) + [part]
+        return part
 
-                    if next_media:
-                        state['current_track'] = next_media.copy()
-                        state['current_track']['start_time'] = time.time()
-                        state['playing'] = True
-                        
-                        # Add to history
-                        state['history'].append(next_media['id'])
-                        
-                        max_hist = max(10, len(state['library']) - 5) 
-                        if len(state['history']) > max_hist:
-                             state['history'].pop(0)
-                    else:
-                        state['current_track'] = None
-                        state['playing'] = False
-                        log_loop("RADIO STOPPED: No media available.")
-                    
-                    # Maintain Queue Depth (Run auto-fill)
-                    # ensure_queue_filled() # logic is inline now
+app.request_class = RadioRequest
 
-                    # Sync state to disk immediately
-                    save_state()
-                    save_data() # Save queue/schedule changes too
+def unique_upload_name(filename, fp):
+    """secure filename, suffixed with the fingerprint if a different file has the name"""
+    name = secure_filename(filename)
+    if os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], name)):
+        stem, ext = os.path.splitext(name)
+        name = f"{stem}-{fp}{ext}"
+    return name
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return # Windows: directories can't be opened
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+metadata_cond = threading.Condition()
+metadata_pending = deque()
+metadata_thread = None
 
+def metadata_worker():
+    while True:
+        with metadata_cond:
+            while not metadata_pending:
+                metadata_cond.wait()
+            batch = [metadata_pending.popleft() for _ in range(min(METADATA_BATCH, len(metadata_pending)))]
+        try:
+            read = []
+            for mid in batch:
+                with state_lock:
+                    item = state['library'].get(mid)
+                    filename = item['filename'] if item else None
+                path = media_path(filename) if filename else None
+                if path:
+                    read.append((mid,) + extract_metadata(path, mid))
+            done = []
+            with state_lock:
+                for mid, duration, art in read:
+                    item = state['library'].get(mid)
+                    if not item or not item.get('pending'):
+                        continue
+                    item['duration'] = duration
+                    if art and not item.get('art'): item['art'] = art
+                    item.pop('pending', None)
+                    state['library'].touch(item)
+                    done.append(mid)
+                if done:
+                    save_library()
+                    wake_radio() # In case the station was idle with nothing to play
+            for mid in done:
+                queue_ingest(mid)
+            print(f"METADATA: read {len(done)} uploaded tracks")
         except Exception as e:
-            print(f"CRITICAL RADIO LOOP ERROR: {e}")
-            try:
-                with open("loop_debug.log", "a") as f:
-                    f.write(f"CRASH: {e}\n")
-            except: pass
-            
-        time.sleep(1)
+            print(f"METADATA WORKER ERROR: {e}")
 
-# Thread management lock
-thread_start_lock = threading.Lock()
+def queue_metadata(media_ids):
+    global metadata_thread
+    with metadata_cond:
+        metadata_pending.extend(str(mid) for mid in media_ids)
+        if metadata_thread is None or not metadata_thread.is_alive():
+            metadata_thread = threading.Thread(target=metadata_worker, daemon=True)
+            metadata_thread.start()
+        metadata_cond.notify()
 
-def start_radio_thread():
-    global radio_thread
-    with thread_start_lock:
-        # Check if actually alive
-        if radio_thread is None or not radio_thread.is_alive():
-            print("Starting Radio Loop Thread...")
-            radio_thread = threading.Thread(target=radio_loop, daemon=True)
-            radio_thread.start()
+def queue_metadata_backfill():
+    """Leader only: finish uploads whose metadata wasn't read before a restart"""
+    with state_lock:
+        pending = [m['id'] for m in state['library'] if m.get('pending')]
+    if pending:
+        queue_metadata(pending)
 
-# Start initially
-start_radio_thread()
+# --- Download Jobs ---
+# YouTube imports are jobs run by the playout leader on YOUTUBE_WORKERS
+# threads, so at most that many downloads / ffmpeg post-processors compete
+# with playout. Any worker can add or cancel a job: the change goes to the
+# leader as a playout command. The leader saves the job list with the
+# write-behind flusher, so other workers can answer /api/jobs and unfinished
+# jobs resume after a restart (yt-dlp continues its .part files).
+YOUTUBE_WORKERS = int(os.environ.get('YOUTUBE_WORKERS', 2))
+JOB_HISTORY = 100        # finished jobs kept in the list
+JOB_PROGRESS_EVERY = 1.0 # seconds between saved progress updates
+JOB_ACTIVE = ('queued', 'running', 'processing')
 
-# Watchdog: Check thread on every request
-@app.before_request
-def watchdog():
-    start_radio_thread()
+download_jobs = OrderedDict() # job id -> job dict, leader only (guarded by state_lock)
+job_cond = threading.Condition()
+job_pending = deque()
+job_threads = []
 
-@app.route('/api/logs')
-def get_logs():
-    # Helper to view what the loop is doing
+def video_key(url):
+    """Identity of the video behind a URL, for dedup ('youtube:<id>')"""
     try:
-        with open("loop_debug.log", "r") as f:
-            lines = f.readlines()
-            return "<br>".join(lines[-50:]) # last 50 lines
-    except:
-        return "No logs"
+        if YoutubeIE.suitable(url):
+            return f"youtube:{YoutubeIE.get_temp_id(url)}"
+    except Exception:
+        pass
+    return url.strip()
 
-@app.route('/api/debug/state')
-def debug_state():
+def job_list():
+    """Jobs, oldest first: ours if we're the leader, else the last saved list"""
+    if playout_leader:
+        with state_lock:
+            return [dict(job) for job in download_jobs.values()]
+    try:
+        return storage.load_jobs() or []
+    except Exception as e:
+        print(f"Error loading jobs: {e}")
+        return []
+
+def existing_download(key, jobs):
+    """(job, media item) already covering this video, if any. Caller holds state_lock."""
+    for job in reversed(jobs):
+        if job['key'] == key and (job['status'] in JOB_ACTIVE or
+                                  (job['status'] == 'done' and job['media_id'] in state['library'])):
+            return job, state['library'].get(job['media_id'])
+    return None, state['library'].by_source(key)
+
+def update_job(job, **fields):
     with state_lock:
-        return jsonify({
-            "playing": state.get('playing'),
-            "current_track": state.get('current_track'),
-            "queue_len": len(state.get('queue', [])),
-            "library_len": len(state.get('library', [])),
-            "history_len": len(state.get('history', [])),
-            "library_sample": [m['title'] for m in state.get('library', [])[:5]],
-            "queue_dump": state.get('queue'),
-            "thread_alive": radio_thread.is_alive() if radio_thread else False
-        })
+        job.update(fields, updated_at=time.time())
+        mark_dirty('jobs')
 
-@app.route('/api/debug/logs')
-def debug_logs():
+def trim_jobs():
+    """Drop the oldest finished jobs past JOB_HISTORY. Caller holds state_lock."""
+    finished = [jid for jid, job in download_jobs.items() if job['status'] not in JOB_ACTIVE]
+    for jid in finished[:-JOB_HISTORY]:
+        del download_jobs[jid]
+
+@playout_command('job_add')
+def cmd_job_add(job):
+    if job['id'] in download_jobs or any(existing_download(job['key'], list(download_jobs.values()))):
+        return # duplicate posted from another worker
+    download_jobs[job['id']] = job
+    trim_jobs()
+    mark_dirty('jobs')
+    queue_download(job['id'])
+
+@playout_command('job_cancel')
+def cmd_job_cancel(job_id):
+    job = download_jobs.get(job_id)
+    if not job or job['status'] not in JOB_ACTIVE:
+        return
+    job['cancel'] = True # running jobs stop at the next progress hook
+    if job['status'] == 'queued':
+        job['status'] = 'cancelled'
+    job['updated_at'] = time.time()
+    mark_dirty('jobs')
+
+def queue_download(job_id):
+    with job_cond:
+        job_pending.append(job_id)
+        job_threads[:] = [t for t in job_threads if t.is_alive()]
+        while len(job_threads) < YOUTUBE_WORKERS:
+            t = threading.Thread(target=download_worker, daemon=True)
+            t.start()
+            job_threads.append(t)
+        job_cond.notify()
+
+def resume_download_jobs():
+    """New leader: pick up the saved job list and restart unfinished jobs"""
     try:
-        if os.path.exists("loop_debug.log"):
-            with open("loop_debug.log", "r") as f:
-                return "<pre>" + f.read() + "</pre>"
-        return "No logs"
+        saved = storage.load_jobs() or []
     except Exception as e:
-        return str(e)
+        print(f"Error loading jobs on takeover: {e}")
+        return
+    with state_lock:
+        for job in saved:
+            if job['id'] in download_jobs:
+                continue
+            if job['status'] in ('running', 'processing'):
+                job['status'] = 'queued' # interrupted by the restart
+            download_jobs[job['id']] = job
+        resume = [jid for jid, job in download_jobs.items() if job['status'] == 'queued']
+    for jid in resume:
+        queue_download(jid)
+    if resume:
+        print(f"RESUMING {len(resume)} download jobs")
+
+def download_worker():
+    while True:
+        with job_cond:
+            while not job_pending:
+                job_cond.wait()
+            job_id = job_pending.popleft()
+        with state_lock:
+            job = download_jobs.get(job_id)
+            if not job or job['status'] != 'queued':
+                continue # cancelled while queued
+            job.update(status='running', updated_at=time.time())
+            mark_dirty('jobs')
+        try:
+            run_download_job(job)
+        except DownloadCancelled:
+            update_job(job, status='cancelled')
+            print(f"DOWNLOAD CANCELLED: {job['url']}")
+        except Exception as e:
+            update_job(job, status='failed', error=str(e)[:300])
+            print(f"BACKGROUND ERROR: {e}")
+        request_flush()
+
+def run_download_job(job):
+    """Download one job's video as MP3 and add it to the library"""
+    print(f"BACKGROUND: Starting download for {job['url']} (Category: {job['category']})")
+    last_saved = [0.0]
+
+    def progress_hook(d):
+        if job.get('cancel'):
+            raise DownloadCancelled()
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            now = time.time()
+            if total and now - last_saved[0] >= JOB_PROGRESS_EVERY:
+                last_saved[0] = now
+                # Download is the first 90%, ffmpeg conversion the rest
+                update_job(job, progress=round(0.9 * d.get('downloaded_bytes', 0) / total, 3))
+        elif d['status'] == 'finished':
+            update_job(job, status='processing', progress=0.9)
+
+    def postprocessor_hook(d):
+        if job.get('cancel'):
+            raise DownloadCancelled()
+
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(app.config['UPLOAD_FOLDER'], '%(title)s.%(ext)s'),
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }],
+        'restrictfilenames': True,
+        'nocheckcertificate': True,
+        'noprogress': True,
+        'progress_hooks': [progress_hook],
+        'postprocessor_hooks': [postprocessor_hook],
+    }
+
+    # Check for cookies in tmp
+    cookie_path = os.path.join(tempfile.gettempdir(), 'grace_radio_cookies.txt')
+    if os.path.exists(cookie_path):
+        ydl_opts['cookiefile'] = cookie_path
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(job['url'], download=True)
+        filename = ydl.prepare_filename(info)
+        # Fix extension shuffle (webm -> mp3)
+        final_filename = os.path.splitext(os.path.basename(filename))[0] + ".mp3"
+
+    if job.get('cancel'): # too late to stop ffmpeg; drop the result
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], final_filename))
+        except OSError:
+            pass
+        raise DownloadCancelled()
+
+    entry = media_file('media', final_filename)
+    media_item = {
+        "id": uuid.uuid4().hex[:12],
+        "title": info.get('title', "Unknown Title"),
+        "filename": final_filename, # Ensure we point to the MP3
+        "fp": entry[3] if entry else None,
+        "duration": info.get('duration', 0),
+        "category": job['category'],
+        "type": "audio",
+        "source": job['key'],
+        "added_at": time.time()
+    }
 
-@app.route('/api/stream/current')
-def stream_current():
     with state_lock:
-        current = state.get('current_track')
-        if current and state.get('playing'):
-            # specific file URL
-            return redirect(f"/static/media/{current['filename']}")
-        else:
-            # Fallback or silent mp3
-            return "Radio Offline", 404
+        state['library'].add(media_item)
+        save_library()
+        wake_radio()
+        job.update(status='done', progress=1.0, title=media_item['title'],
+                   media_id=media_item['id'], updated_at=time.time())
+        trim_jobs()
+        mark_dirty('jobs')
+        print(f"BACKGROUND: Success! Added {media_item['title']}")
+    queue_ingest(media_item['id'])
 
 # --- Routes ---
 
@@ -655,6 +4576,44 @@ def index():
 def admin_dashboard():
     return render_template('index.html', is_admin=True)
 
+def listener_vote(snapshot, lid):
+    """This listener's rating of the on-air track, or None."""
+    current_id = snapshot[2]
+    if current_id and lid:
+        # Single dict lookup; no need for state_lock
+        return state['votes'].rating(current_id, lid)
+    return None
+
+def render_status(snapshot, lid, listeners):
+    """Splice the per-listener fields in front of the pre-encoded snapshot."""
+    version, body, current_id, start_time, playing = snapshot
+    now = time.time()
+
+    elapsed = 0
+    if current_id and playing:
+        elapsed = max(0, now - start_time)
+
+    user_vote = listener_vote(snapshot, lid)
+
+    head = '{"elapsed": %s, "server_time": %s, "listeners": %d, "user_vote": %s, ' % (
+        json.dumps(elapsed), json.dumps(now), listeners, json.dumps(user_vote))
+    return head.encode('utf-8') + body[1:]
+
+def etag_matches(etag):
+    """True if the request's If-None-Match lists etag (weak comparison) or *"""
+    inm = request.headers.get('If-None-Match')
+    if not inm:
+        return False
+    for tag in inm.split(','):
+        tag = tag.strip()
+        if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
+
+def status_etag(snapshot, listeners, user_vote=None):
+    # The voter's own rating is part of their copy; a vote doesn't bump the version
+    return f'"{snapshot[0]}-{listeners}-{user_vote}"'
+
 @app.route('/api/status')
 def get_status():
     # Update listener heartbeat
@@ -663,59 +4622,85 @@ def get_status():
     if lid:
         update_listeners(lid)
 
-    with state_lock:
-        now = time.time()
-        current = state['current_track']
-        
-        # Auto-Repair properties from library if missing (e.g. lyrics)
-        if current:
-            lib_item = next((m for m in state['library'] if str(m['id']) == str(current['id'])), None)
-            if lib_item:
-                if not current.get('lyrics') and lib_item.get('lyrics'):
-                     current['lyrics'] = lib_item['lyrics']
-                # Sync other props if stale? Optionally.
-        
-        # Calculate elapsed
-        elapsed = 0
-        if current and state['playing']:
-            elapsed = now - current['start_time']
-            if elapsed < 0: elapsed = 0
-            
-        # Check if user voted on this track
-        user_vote = None
-        if current and lid:
-            # Find vote by this listener for this track
-            # Performance: Search list (OK for now, optimize with dict later if needed)
-            v = next((x for x in state['votes'] if x['track_id'] == str(current['id']) and x.get('listener_id') == lid), None)
-            if v:
-                user_vote = v.get('rating')
-                # Compat
-                if user_vote is None:
-                    if v.get('vote') == 'like': user_vote = 5
-                    elif v.get('vote') == 'dislike': user_vote = 1
-        queue_preview = []
-        for q_id in state['queue'][:10]:
-            # Find in library
-            m = next((m for m in state['library'] if str(m['id']) == str(q_id)), None)
-            if m:
-                queue_preview.append({"id": m['id'], "title": m['title'], "category": m.get('category', 'Unknown')})
-            else:
-                queue_preview.append({"id": q_id, "title": "Loading...", "category": "Unknown"})
+    snapshot = status_snapshot
+    listeners = get_active_listeners()
+    etag = status_etag(snapshot, listeners, listener_vote(snapshot, lid))
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
 
-        return jsonify({
-            "playing": state['playing'],
-            "current_track": current,
-            "elapsed": elapsed,
-            "listeners": get_active_listeners(),
-            "queue": queue_preview,
-            "user_vote": user_vote,
-            "server_time": now
-        })
+    # Nothing changed since the client's copy (it extrapolates elapsed itself)
+    if etag_matches(etag):
+        return Response(status=304, headers=headers)
+
+    return Response(render_status(snapshot, lid, listeners), mimetype='application/json', headers=headers)
+
+@app.route('/api/events')
+def status_events():
+    """
+    Server-Sent Events stream of /api/status payloads.
+    Pushes only when the snapshot version, listener count or this
+    listener's rating changes;
+    sends a comment line every SSE_KEEPALIVE seconds otherwise.
+    EventSource cannot set headers, so the listener ID comes in ?lid=.
+    """
+    global sse_clients
+    lid = request.args.get('lid') or request.headers.get('X-Listener-ID')
+
+    with status_cond:
+        if sse_clients >= SSE_MAX_CLIENTS:
+            # Client falls back to polling /api/status
+            return "Too many streams", 503
+        sse_clients += 1
+
+    def stream():
+        last_version = None
+        last_listeners = None
+        last_vote = None
+        last_sent = 0
+        yield "retry: 3000\n\n"
+        while True:
+            with status_cond:
+                if status_snapshot[0] == last_version:
+                    status_cond.wait(SSE_CHECK_INTERVAL)
+                snapshot = status_snapshot
+
+            # The open stream is this listener's heartbeat
+            if lid:
+                update_listeners(lid)
+            listeners = get_active_listeners()
+            user_vote = listener_vote(snapshot, lid)
+            now = time.time()
+
+            if snapshot[0] != last_version or listeners != last_listeners or user_vote != last_vote:
+                last_version = snapshot[0]
+                last_listeners = listeners
+                last_vote = user_vote
+                last_sent = now
+                yield b"id: %d\nevent: status\ndata: " % snapshot[0] + render_status(snapshot, lid, listeners) + b"\n\n"
+            elif now - last_sent >= SSE_KEEPALIVE:
+                last_sent = now
+                yield ": keepalive\n\n"
+
+    def release():
+        global sse_clients
+        with status_cond:
+            sse_clients -= 1
+
+    resp = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Don't let nginx/Render buffer the stream
+    })
+    # The server closes every response (HEAD, early disconnects), even
+    # when the generator never ran
+    resp.call_on_close(release)
+    return resp
 
 @app.route('/api/library', methods=['GET', 'POST'])
 def library():
     if request.method == 'GET':
-        return jsonify(state['library'])
+        _, body, etag, _ = library_view()
+        if etag_matches(etag):
+            return Response(status=304, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+        return Response(body, mimetype='application/json', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
     
     # POST - Add items is handled by upload mostly, but maybe editing metadata?
     return jsonify({"error": "Use upload"}), 400
@@ -724,14 +4709,13 @@ def library():
 def library_folders():
     """Returns list of unique folder paths used in library"""
     folders = set()
-    with state_lock:
-        for item in state['library']:
-            fname = item.get('filename', '').replace('\\', '/')
-            if '/' in fname:
-                # Extract dir
-                d = os.path.dirname(fname)
-                if d and d != '.':
-                    folders.add(d)
+    for item in library_view()[3]:
+        fname = item.get('filename', '').replace('\\', '/')
+        if '/' in fname:
+            # Extract dir
+            d = os.path.dirname(fname)
+            if d and d != '.':
+                folders.add(d)
     return jsonify(sorted(list(folders)))
 
 @app.route('/api/library/batch_move', methods=['POST'])
@@ -744,7 +4728,7 @@ def batch_move():
     count = 0
     with state_lock:
         for mid in ids:
-            item = next((m for m in state['library'] if str(m['id']) == str(mid)), None)
+            item = state['library'].get(mid)
             if not item: continue
             
             old_filename = item['filename']
@@ -784,6 +4768,7 @@ def batch_move():
                              os.rename(src_path, dst_path)
                              
                         item['filename'] = new_filename
+                        state['library'].reindex(item)
                         count += 1
                     else:
                         print(f"Batch Move: Source not found for {old_filename}")
@@ -792,7 +4777,7 @@ def batch_move():
                     print(f"Batch Move Error {mid}: {e}")
         
         if count > 0:
-            save_data()
+            save_library()
             
     return jsonify({"status": "ok", "moved": count})
 @app.route('/api/upload', methods=['POST'])
@@ -800,56 +4785,62 @@ def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
-    files = request.files.getlist('file')
-    category = request.form.get('category', 'Music') # Music, Sermon, Announcement
-    uploaded_items = []
-
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            print(f"DEBUG: Saving file to {path}") # LOGGING
-            file.save(path)
-            
-            # Small sleep to ensure unique ID if multiple files uploaded instantly
-            time.sleep(0.01)
-            mid = str(int(time.time()*1000)) + str(random.randint(0,1000))
-            
-            duration, art = extract_metadata(path, mid)
-            
+    try:
+        files = request.files.getlist('file')
+        category = request.form.get('category', 'Music') # Music, Sermon, Announcement
+        uploaded_items = []
+        duplicates = []
+        seen = {}  # fp -> item, for the same file twice in one request
+
+        for file in files:
+            part = file.stream if file else None
+            if not isinstance(part, HashingUpload) or not allowed_file(file.filename):
+                continue
+            fp = part.hexdigest()
+            with state_lock:
+                existing = state['library'].by_fp(fp) or seen.get(fp)
+            if existing:
+                print(f"UPLOAD: {file.filename} is already in the library as {existing['id']}")
+                duplicates.append(dict(existing, duplicate=True))
+                continue
+
+            filename = unique_upload_name(file.filename, fp)
+            part.commit(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            media_paths.pop(('media', filename), None) # may now shadow a bundled file
             media_item = {
-                "id": mid,
-                "title": filename, 
+                "id": uuid.uuid4().hex[:12],
+                "title": filename,
                 "filename": filename,
-                "duration": duration,
-                "art": art,
+                "fp": fp,
+                "duration": 0,      # read by the metadata worker
+                "art": None,
                 "category": category,
-                "type": "audio"
+                "type": "audio",
+                "added_at": time.time(),
+                "pending": True     # not picked for rotation until then
             }
+            seen[fp] = media_item
             uploaded_items.append(media_item)
+    finally:
+        for part in getattr(request, 'upload_parts', []):
+            part.discard() # rejected / duplicate / aborted parts
+
+    if not uploaded_items and not duplicates:
+        return jsonify({'error': 'No valid files allowed'}), 400
 
     if uploaded_items:
+        fsync_dir(app.config['UPLOAD_FOLDER'])
         with state_lock:
             state['library'].extend(uploaded_items)
-            save_data()
-            
-            # VERIFY WRITE
-            try:
-                with open(DATA_FILE, 'r') as f:
-                    verify_data = json.load(f)
-                    verify_os = verify_data.get('library', [])
-                    # Check if our new IDs are in there
-                    for item in uploaded_items:
-                        if not any(str(v['id']) == str(item['id']) for v in verify_os):
-                            print(f"CRITICAL: Uploaded item {item['id']} NOT FOUND in disk after save!")
-                            return jsonify({"error": "Disk Write Failed"}), 500
-                    print(f"VERIFICATION SUCCESS: {len(verify_os)} items on disk.")
-            except Exception as e:
-                print(f"VERIFICATION ERROR: {e}")
-                
-        return jsonify(uploaded_items)
-    
-    return jsonify({'error': 'No valid files allowed'}), 400
+            save_library()
+        # Durable before we answer: flush_now() reports the storage commit
+        if not flush_now():
+            print(f"CRITICAL: {len(uploaded_items)} uploaded items not saved")
+            return jsonify({"error": "Disk Write Failed"}), 500
+        print(f"UPLOAD: saved {len(uploaded_items)} items ({len(duplicates)} duplicates skipped)")
+        queue_metadata([item['id'] for item in uploaded_items])
+
+    return jsonify(uploaded_items + duplicates)
 
 @app.route('/api/debug')
 def debug_info():
@@ -864,58 +4855,26 @@ def debug_info():
 @app.route('/api/danger/force_next', methods=['POST'])
 def force_next_track():
     with state_lock:
-        state['current_track'] = None
-        state['playing'] = False
-    # Explicitly wake loop? No need if sleep(1)
+        run_playout_command('skip')
     return jsonify({"status": "forced_reset"})
 
 import tempfile
 
 # ...
 
-@app.route('/api/admin/repair_library')
+@app.route('/api/admin/repair_library', methods=['GET', 'POST'])
 def repair_library():
-    """Fixes missing or incorrect durations using ffprobe"""
-    count = 0
-    fixed = []
-    
-    with state_lock:
-        for item in state['library']:
-            # Check if duration is suspicious (0, or <60s for non-music?)
-            # Or just check ALL to be safe.
-            # Let's check files that exist.
-            fpath = os.path.join(app.config['UPLOAD_FOLDER'], item['filename'])
-            if os.path.exists(fpath):
-                old_dur = item.get('duration', 0)
-                
-                # Get actual duration
-                try:
-                    # Use ffprobe via shell
-                    # ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 input.mp3
-                    cmd = [
-                        'ffprobe', '-v', 'error', 
-                        '-show_entries', 'format=duration', 
-                        '-of', 'default=noprint_wrappers=1:nokey=1', 
-                        fpath
-                    ]
-                    # We need to run this subprocess
-                    import subprocess
-                    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                    real_dur = float(result.stdout.strip())
-                    
-                    if abs(real_dur - old_dur) > 5: # If variance > 5s
-                        item['duration'] = real_dur
-                        fixed.append(f"{item['title']}: {old_dur} -> {real_dur}")
-                        count += 1
-                except Exception as e:
-                    print(f"Repair failed for {item['filename']}: {e}")
-        
-    if count > 0:
-        save_data()
-        
-    return jsonify({"processed": len(state['library']), "fixed": fixed})
-
-
+    """POST starts fixing missing or incorrect durations in the background; GET shows progress"""
+    if request.method == 'POST':
+        if not shutil.which('ffprobe'):
+            return jsonify({"error": "ffprobe not found"}), 503
+        if not playout_leader:
+            with state_lock:
+                run_playout_command('repair_start')
+            return jsonify({"status": "requested"}), 202 # the leader starts it
+        _, started = start_repair()
+        return jsonify(dict(repair_status(), started=started)), 202 if started else 200
+    return jsonify(repair_status())
 
 @app.route('/api/vote', methods=['POST'])
 def vote_track():
@@ -942,28 +4901,12 @@ def vote_track():
 
     now = time.time()
     
-    with state_lock:
+    # Votes have their own lock, so voting never waits on playout or uploads.
+    # No republish: the voter's rating is part of their status ETag.
+    with votes_lock:
         # Retention Policy: Clean old votes (older than 90 days)
-        cutoff = now - (90 * 24 * 60 * 60)
-        state['votes'] = [v for v in state['votes'] if v['timestamp'] > cutoff]
-        
-        # Check for existing vote
-        existing = next((v for v in state['votes'] if v['track_id'] == track_id and v.get('listener_id') == listener_id), None)
-        
-        if existing:
-            existing['rating'] = rating
-            existing['timestamp'] = now
-            # Clear legacy field if exists
-            if 'vote' in existing: del existing['vote']
-        else:
-            # Add new vote
-            state['votes'].append({
-                "track_id": track_id,
-                "listener_id": listener_id,
-                "rating": rating,
-                "timestamp": now
-            })
-            
+        state['votes'].expire(now - VOTE_RETENTION)
+        state['votes'].cast(track_id, listener_id, rating, now)
         save_votes()
         
     return jsonify({"status": "ok"})
@@ -972,32 +4915,12 @@ def vote_track():
 def get_vote_stats():
     # Admin only
     
-    # Aggregate
-    # {track_id: {total_score: 0, count: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0}}
-    stats = {} 
-    
+    # Aggregates are kept up to date by VoteStore on every vote
+    # {track_id: {total: 0, count: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0}}
+    with votes_lock:
+        stats = {tid: dict(data) for tid, data in state['votes'].stats().items()}
     with state_lock:
-        library_map = {str(item['id']): item for item in state['library']}
-        
-        for v in state['votes']:
-            tid = v['track_id']
-            
-            # Normalize rating
-            r = v.get('rating')
-            if r is None:
-                # Legacy fallback
-                legacy = v.get('vote')
-                if legacy == 'like': r = 5
-                elif legacy == 'dislike': r = 1
-                else: continue # Skip invalid
-            
-            if tid not in stats:
-                stats[tid] = {"total": 0, "count": 0, "1": 0, "2": 0, "3": 0, "4": 0, "5": 0}
-            
-            stats[tid]['total'] += r
-            stats[tid]['count'] += 1
-            if str(r) in stats[tid]:
-                stats[tid][str(r)] += 1
+        library_map = state['library']
         
         # Format for UI
         result = []
@@ -1026,12 +4949,25 @@ def get_vote_stats():
         
     return jsonify(result)
 
+@app.route('/api/stats/listeners')
+def get_listener_stats():
+    """Active / peak listeners and unique listeners per UTC hour and day, across workers"""
+    now = time.time()
+    report = None if playout_leader else leader_listener_report(now)
+    if report is None:
+        with listener_lock:
+            report = listeners.report(now)
+        report['pid'] = os.getpid()
+    return jsonify(report)
+
 @app.route('/api/stats/clear', methods=['POST'])
 def clear_vote_stats():
     # Admin only (but no auth check for this demo)
-    with state_lock:
-        state['votes'] = []
+    with votes_lock:
+        state['votes'].clear()
         save_votes()
+    with state_lock:
+        publish_status() # drop everyone's user_vote
     return jsonify({"status": "cleared"})
 
 @app.route('/api/upload/cookies', methods=['POST'])
@@ -1051,85 +4987,28 @@ def upload_cookies():
         return jsonify({"error": str(e)}), 500
 
 
-def run_youtube_download(url, category='Music'):
-    """Background task to handle the heavy download"""
-    print(f"BACKGROUND: Starting download for {url} (Category: {category})")
-    try:
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': os.path.join(app.config['UPLOAD_FOLDER'], '%(title)s.%(ext)s'),
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }], 
-            'restrictfilenames': True,
-            'nocheckcertificate': True,
-        }
-        
-        # Check for cookies in tmp
-        cookie_path = os.path.join(tempfile.gettempdir(), 'grace_radio_cookies.txt')
-        if os.path.exists(cookie_path):
-            ydl_opts['cookiefile'] = cookie_path
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            # Fix extension shuffle (webm -> mp3)
-            final_filename = os.path.splitext(os.path.basename(filename))[0] + ".mp3"
-            
-            duration = info.get('duration', 0)
-            
-            media_item = {
-                "id": str(int(time.time()*1000)),
-                "title": info.get('title', "Unknown Title"),
-                "filename": final_filename, # Ensure we point to the MP3
-                "duration": duration,
-                "category": category,
-                "type": "audio",
-                "added_at": time.time()
-            }
-            
-            with state_lock:
-                state['library'].append(media_item)
-                save_data()
-                print(f"BACKGROUND: Success! Added {media_item['title']}")
-
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"BACKGROUND ERROR: {e}")
-
 # --- Helpers ---
 def ensure_queue_filled(exclude_ids=None):
-    """Auto-fills queue with random music to maintain 10 items"""
-    if exclude_ids is None: exclude_ids = []
-    
-    # Strict Shuffle: Only Music
-    music_cands = [m for m in state['library'] if m.get('category') == 'Music']
-    if not music_cands: return # No music to pick from
-    
-    # Avoid recent repeats (History)
-    history_set = set(state['history'])
-    
+    """
+    Auto-fills queue with music from the rotation to maintain 10 items.
+    Caller holds state_lock. Returns True if anything was added.
+    """
+    # Strict Shuffle: Only Music. Queued tracks are not picked twice.
+    blocked = set(str(q) for q in state['queue'])
+    blocked.update(str(x) for x in exclude_ids or ())
+
     changes = False
-    attempts = 0
-    while len(state['queue']) < 10 and attempts < 20:
-        attempts += 1
-        # Filter candidates
-        cands = [m for m in music_cands if m['id'] not in history_set and str(m['id']) not in state['queue'] and str(m['id']) not in exclude_ids]
-        
-        if not cands:
-             # Relax history if strictly needed, or just pick any music
-             cands = music_cands
-        
-        if cands:
-            pick = random.choice(cands)
-            state['queue'].append(pick['id'])
-            changes = True
-    
+    while len(state['queue']) < 10:
+        pick = rotation.draw('music', ('Music',), blocked)
+        if not pick:
+            break # No (other) music to pick from
+        state['queue'].append(pick)
+        blocked.add(pick)
+        changes = True
+
     if changes:
-        save_state()
+        save_state() # Queue lives in playback state, not data
+    return changes
 
 @app.route('/api/library/update', methods=['POST'])
 def update_library_item():
@@ -1141,10 +5020,12 @@ def update_library_item():
 
     mid = data.get('id')
     with state_lock:
-        item = next((m for m in state['library'] if str(m['id']) == str(mid)), None)
+        item = state['library'].get(mid)
         if item:
             if 'title' in data: item['title'] = data['title']
-            if 'category' in data: item['category'] = data['category']
+            if 'category' in data:
+                item['category'] = data['category']
+                state['library'].reindex(item)
             if 'volume' in data: 
                 try: item['volume'] = float(data['volume'])
                 except: pass
@@ -1177,22 +5058,9 @@ def update_library_item():
                 file = request.files['art']
                 if file and file.filename != '':
                     try:
-                        # Ensure persistent dir exists
-                        art_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'art')
-                        if not os.path.exists(art_dir):
-                            os.makedirs(art_dir)
-
-                        # Save art with ID
-                        ext = os.path.splitext(file.filename)[1].lower()
-                        if not ext: ext = '.jpg'
-                        art_filename = f"{mid}{ext}"
-                        dest = os.path.join(art_dir, art_filename)
-                        file.save(dest)
-                        item['art'] = f"/static/art/{art_filename}?t={int(time.time())}" # cache bust
-                        
-                        # Propagate to Current Track
-                        if state.get('current_track') and str(state['current_track']['id']) == str(mid):
-                            state['current_track']['art'] = item['art']
+                        # Stored by content hash: new content, new URL
+                        # (also propagates to the current track)
+                        set_item_art(item, store_art(file.read()))
                     except Exception as e:
                         print(f"ART UPLOAD ERROR: {e}")
                         # Don't fail the whole request, just log it? 
@@ -1256,6 +5124,7 @@ def update_library_item():
                                  os.rename(src_path, dst_path)
 
                              item['filename'] = new_filename
+                             state['library'].reindex(item)
                              print(f"MOVED: {old_filename} -> {new_filename}")
 
                         else:
@@ -1268,7 +5137,10 @@ def update_library_item():
                         print(f"MOVE ERROR: {e}")
                         return jsonify({"error": f"Failed to move file: {str(e)}"}), 500
 
-            save_data()
+            state['library'].touch(item)
+            save_library()
+            publish_status()
+            wake_radio() # Trim edits move the current track's end
             return jsonify({"status": "updated", "item": item})
     return jsonify({"error": "not found"}), 404
 
@@ -1277,22 +5149,16 @@ def reorder_queue():
     """Expects [id1, id2, id3...] representing new order"""
     new_order = request.json.get('order', [])
     with state_lock:
-        valid_ids = []
-        for qid in new_order:
-             if any(str(m['id']) == str(qid) for m in state['library']):
-                 valid_ids.append(str(qid))
-        state['queue'] = valid_ids
-        ensure_queue_filled()
-        save_state()
-    return jsonify({"status": "ok", "queue": state['queue']})
+        valid_ids = [str(qid) for qid in new_order if qid in state['library']]
+        if run_playout_command('queue_reorder', order=valid_ids):
+            valid_ids = state['queue']
+    return jsonify({"status": "ok", "queue": valid_ids})
 
 @app.route('/api/queue/remove', methods=['POST'])
 def remove_from_queue():
     target_id = request.json.get('id')
     with state_lock:
-        state['queue'] = [q for q in state['queue'] if str(q) != str(target_id)]
-        ensure_queue_filled(exclude_ids=[str(target_id)])
-        save_state()
+        run_playout_command('queue_remove', media_id=str(target_id))
     return jsonify({"status": "removed"})
     
 @app.route('/api/upload/youtube', methods=['POST'])
@@ -1303,13 +5169,43 @@ def upload_youtube():
         category = data.get('category', 'Music') 
         if not url:
             return jsonify({"error": "No URL provided"}), 400
-        thread = threading.Thread(target=run_youtube_download, args=(url, category), daemon=True)
-        thread.start()
-        return jsonify({"status": "accepted", "message": "Download started in background."}), 202
+        key = video_key(url)
+        jobs = job_list()
+        with state_lock:
+            job, item = existing_download(key, jobs)
+            if job or item:
+                return jsonify({"status": "duplicate", "job": job, "media_id": item['id'] if item else None,
+                                "message": "Already in the library or downloading."}), 200
+            job = {
+                "id": uuid.uuid4().hex[:12], "url": url, "key": key, "category": category,
+                "status": "queued", "progress": 0.0, "title": None, "media_id": None, "error": None,
+                "created_at": time.time(), "updated_at": time.time()
+            }
+            run_playout_command('job_add', job=job)
+        return jsonify({"status": "accepted", "job": job, "message": "Download queued."}), 202
     except Exception as e:
         print(f"DL Launch Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/jobs')
+def list_jobs():
+    status = request.args.get('status')
+    jobs = [j for j in reversed(job_list()) if not status or j['status'] == status]
+    return jsonify({"jobs": jobs, "leader": playout_leader})
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    job = next((j for j in job_list() if j['id'] == job_id), None)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    with state_lock:
+        run_playout_command('job_cancel', job_id=job_id)
+    return jsonify({"status": "cancelling", "id": job_id}), 202
+
 @app.route('/api/queue/add', methods=['POST'])
 def add_to_queue():
     data = request.json
@@ -1317,14 +5213,11 @@ def add_to_queue():
     with state_lock:
         # verify exists
         # Fix: Ensure strict string comparison here too, in case library has int but we received str
-        if any(str(m['id']) == str(media_id) for m in state['library']):
-            # Priority: Insert at 0 so it plays NEXT
-            # Duplicate check handled?
+        if media_id in state['library']:
             # User might want to queue same song multiple times?
             # If we auto-fill, duplicates are disallowed.
             # Manual queues allow duplicates? Let's allow.
-            state['queue'].insert(0, str(media_id))
-            save_state() 
+            run_playout_command('queue_add', media_id=str(media_id))
             return jsonify({"status": "added"})
     return jsonify({"error": "not found"}), 404
 
@@ -1355,23 +5248,35 @@ def add_to_schedule():
     log_sched(f"ADD NORMALIZED: {run_at} (Now: {time.time()})")
 
     with state_lock:
-        state['schedule'].append({
-            "id": str(random.randint(0, 100000)),
+        state['schedule'].add({
+            "id": uuid.uuid4().hex[:12],
             "media_id": media_id,
             "run_at": run_at
         })
-        save_data()
+        save_schedule()
+        wake_radio()
         log_sched(f"Schedule Saved. Count: {len(state['schedule'])}")
     return jsonify({"status": "scheduled"})
 
+SCHEDULE_PAGE_SIZE = 200
+SCHEDULE_PAGE_MAX = 1000
+
 @app.route('/api/schedule/list', methods=['GET'])
 def list_schedule():
+    """
+    Scheduled items sorted by time. Optional ?start=&end= (timestamps) limit
+    the window; ?offset=&limit= page through it. The full match count is in
+    the X-Total-Count header.
+    """
+    start = request.args.get('start', type=float)
+    end = request.args.get('end', type=float)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', SCHEDULE_PAGE_SIZE, type=int)), SCHEDULE_PAGE_MAX)
+
     res = []
-    # Sort by time
-    sorted_sched = sorted(state['schedule'], key=lambda x: x['run_at'])
-    
-    for s in sorted_sched:
-        media = next((m for m in state['library'] if m['id'] == s['media_id']), None)
+    total, page = schedule_view().window(start, end, offset, limit)
+    for s in page:
+        media = state['library'].get(s['media_id']) # single dict lookup; no lock needed
         item = s.copy()
         if media:
             item['title'] = media['title']
@@ -1380,16 +5285,17 @@ def list_schedule():
         else:
              item['title'] = "Unknown ID: " + str(s['media_id'])
         res.append(item)
-    return jsonify(res)
+    resp = jsonify(res)
+    resp.headers['X-Total-Count'] = str(total)
+    return resp
 
 @app.route('/api/schedule/remove', methods=['POST'])
 def remove_schedule_item():
     item_id = request.json.get('id')
     with state_lock:
-        original_len = len(state['schedule'])
-        state['schedule'] = [s for s in state['schedule'] if str(s['id']) != str(item_id)]
-        if len(state['schedule']) < original_len:
-            save_data()
+        if state['schedule'].remove(item_id):
+            save_schedule()
+            wake_radio()
             return jsonify({"status": "removed"})
     return jsonify({"error": "not found"}), 404
 
@@ -1408,10 +5314,9 @@ def update_schedule_item():
         return jsonify({"error": "invalid timestamp"}), 400
 
     with state_lock:
-        item = next((s for s in state['schedule'] if str(s['id']) == str(item_id)), None)
-        if item:
-            item['run_at'] = float(new_run_at)
-            save_data()
+        if state['schedule'].update(item_id, new_run_at):
+            save_schedule()
+            wake_radio()
             return jsonify({"status": "updated"})
     return jsonify({"error": "not found"}), 404
 
@@ -1419,7 +5324,7 @@ def update_schedule_item():
 def delete_media(media_id):
     with state_lock:
         # Remove from library, queue, schedule
-        item = next((m for m in state['library'] if m['id'] == media_id), None)
+        item = state['library'].get(media_id)
         if item:
             try:
                 # Try delete from UPLOAD_FOLDER (Persistent)
@@ -1440,52 +5345,28 @@ def delete_media(media_id):
             if bn not in state['deleted_files']:
                 state['deleted_files'].append(bn)
 
-            state['library'] = [m for m in state['library'] if m['id'] != media_id]
+            state['library'].remove(media_id)
             state['queue'] = [q for q in state['queue'] if q != media_id]
-            state['schedule'] = [s for s in state['schedule'] if s['media_id'] != media_id]
+            state['schedule'].remove_media(media_id)
             save_data()
-            return jsonify({"status": "deleted"})
-    return jsonify({"error": "not found"}), 404
+            save_state() # Queue changed too
+            publish_status()
+            wake_radio()
+    if not item:
+        return jsonify({"error": "not found"}), 404
+    # The HLS thread removes its segments, after any cut of it in progress
+    queue_hls(media_id)
+    return jsonify({"status": "deleted"})
 
 
 @app.route('/api/skip', methods=['POST'])
 def skip_track():
     with state_lock:
-        state['current_track'] = None
-        state['playing'] = False
-        # loop runs every 1s, will pick up next immediately
+        run_playout_command('skip') # Loop picks the next track immediately
     return jsonify({"status": "skipped"})
 
-
-@app.route('/static/media/<path:filename>')
-def custom_static(filename):
-    # 1. Check Permanent Disk (Uploads)
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(upload_path):
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    
-    # 2. Check Local Static Folder (Built-in)
-    local_path = os.path.join(app.root_path, 'static', 'media')
-    if os.path.exists(os.path.join(local_path, filename)):
-        return send_from_directory(local_path, filename)
-        
-    print(f"404: Could not find {filename} in {app.config['UPLOAD_FOLDER']} or {local_path}")
-    return "File not found", 404
-
-@app.route('/static/art/<path:filename>')
-def custom_art(filename):
-    # 1. Check Permanent Disk (Uploads)
-    # Be careful with subdirectory 'art'
-    art_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'art')
-    upload_path = os.path.join(art_dir, filename)
-    
-    if os.path.exists(upload_path):
-        return send_from_directory(art_dir, filename)
-    
-    # 2. Check content-type param in filename? No.
-    
-    print(f"404 Art: {filename} not found in {art_dir}")
-    return "Not Found", 404
+# Start initially, last, so everything the loop calls is defined
+start_radio_thread()
 
 if __name__ == '__main__':
     # Local development
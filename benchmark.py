@@ -0,0 +1,443 @@
+"""
+Load test for Grace Radio.
+
+Starts the app against a throwaway STORAGE_DIR seeded with a synthetic
+library, then runs a simulated listener population (status polling,
+votes, ranged media fetches) next to admin traffic (uploads, queue
+reorders, schedule edits). Prints throughput and p50/p95/p99 per endpoint
+and saves the results as JSON.
+
+    python benchmark.py --tracks 10000 --listeners 200 --duration 60
+    python benchmark.py --out after.json --compare before.json
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CATEGORIES = ['Music', 'Worship', 'Sermon', 'Announcement']
+
+
+# --- Synthetic Library ---
+
+def seed_storage(storage_dir, tracks, media_files, media_size, rng):
+    """Write media files and a data.json library into storage_dir. Returns the items."""
+    files = []
+    for i in range(media_files):
+        name = f"bench-{i:04d}.mp3"
+        blob = rng.randbytes(media_size)
+        with open(os.path.join(storage_dir, name), 'wb') as f:
+            f.write(blob)
+        files.append((name, hashlib.blake2b(blob, digest_size=8).hexdigest()))
+
+    now = time.time()
+    library = []
+    for i in range(tracks):
+        name, fp = files[i % len(files)]
+        library.append({
+            "id": f"bench-{i:06d}",
+            "title": f"Bench Track {i}",
+            "filename": name,
+            "fp": fp,
+            "duration": rng.randint(120, 420),
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "type": "audio",
+            "added_at": now - i,
+            "gain": 1.0,
+            # Already measured, so the ingest/metadata backfills leave it alone
+            "loudness": {"i": -16.0, "tp": -1.0, "target": -16.0},
+        })
+    with open(os.path.join(storage_dir, 'data.json'), 'w') as f:
+        json.dump({"library": library, "schedule": [], "deleted_files": []}, f)
+    return library
+
+
+# --- Server ---
+
+def server_env(storage_dir, with_ffmpeg):
+    # Run from storage_dir so the app's relative debug logs land there too
+    pythonpath = os.pathsep.join(p for p in (ROOT, os.environ.get('PYTHONPATH')) if p)
+    env = dict(os.environ, STORAGE_DIR=storage_dir, PYTHONPATH=pythonpath, PYTHONUNBUFFERED='1')
+    if not with_ffmpeg:
+        # Without ffmpeg on the PATH the HLS/ingest backfills stay idle,
+        # so they don't compete with the requests being measured
+        keep = [p for p in env.get('PATH', '').split(os.pathsep)
+                if not (shutil.which('ffmpeg', path=p) or shutil.which('ffprobe', path=p))]
+        env['PATH'] = os.pathsep.join(keep)
+    return env
+
+
+def start_server(args, storage_dir):
+    if args.server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+               '-b', f"127.0.0.1:{args.port}", '--timeout', '120', 'app:app']
+    else:
+        cmd = [sys.executable, '-c',
+               f"from app import app; app.run(host='127.0.0.1', port={args.port}, threaded=True, use_reloader=False)"]
+    log = open(os.path.join(storage_dir, 'server.log'), 'wb')
+    proc = subprocess.Popen(cmd, cwd=storage_dir, env=server_env(storage_dir, args.with_ffmpeg),
+                            stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=2)
+            conn.request('GET', '/api/status')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.25)
+    stop_server(proc)
+    with open(log.name, 'rb') as f:
+        tail = f.read()[-4000:].decode('utf-8', 'replace')
+    sys.exit(f"Server did not come up on port {args.port}:\n{tail}")
+
+
+def stop_server(proc):
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+# --- Clients ---
+
+class Stats:
+    """Per-thread latency samples, merged at the end (no lock on the hot path)"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def add(self, name, seconds, status):
+        self.samples.setdefault(name, []).append(seconds)
+        codes = self.statuses.setdefault(name, {})
+        codes[status] = codes.get(status, 0) + 1
+        if status == 0 or status >= 500:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def merge(self, other):
+        for name, values in other.samples.items():
+            self.samples.setdefault(name, []).extend(values)
+        for name, n in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + n
+        for name, codes in other.statuses.items():
+            mine = self.statuses.setdefault(name, {})
+            for code, n in codes.items():
+                mine[code] = mine.get(code, 0) + n
+
+
+class Client:
+    """Keep-alive HTTP connection that times every request"""
+
+    def __init__(self, port, stats, measure_from):
+        self.port = port
+        self.stats = stats
+        self.measure_from = measure_from
+        self.conn = None
+
+    def request(self, name, method, path, body=None, headers=None):
+        """(status, headers, body); status 0 on connection errors"""
+        headers = dict(headers or {})
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+            status, resp_headers = resp.status, resp
+        except (OSError, http.client.HTTPException):
+            self.close()
+            status, resp_headers, data = 0, None, b''
+        elapsed = time.perf_counter() - start
+        if time.time() >= self.measure_from:
+            self.stats.add(name, elapsed, status)
+        return status, resp_headers, data
+
+    def json(self, name, method, path, payload, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        return self.request(name, method, path, json.dumps(payload).encode(), headers)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def listener(args, library, stats, measure_from, stop, seed):
+    rng = random.Random(seed)
+    client = Client(args.port, stats, measure_from)
+    lid = str(uuid.UUID(int=rng.getrandbits(128)))
+    etag = None
+    current = None
+    # Spread the first polls out instead of arriving as one burst
+    stop.wait(rng.uniform(0, args.poll))
+    while not stop.is_set():
+        headers = {'X-Listener-ID': lid}
+        if etag:
+            headers['If-None-Match'] = etag
+        status, resp, body = client.request('GET /api/status', 'GET', '/api/status', headers=headers)
+        if status == 200:
+            etag = resp.getheader('ETag')
+            try:
+                current = json.loads(body).get('current_track')
+            except ValueError:
+                current = None
+
+        if rng.random() < args.vote_p:
+            target = current['id'] if current and rng.random() < 0.7 else rng.choice(library)['id']
+            client.json('POST /api/vote', 'POST', '/api/vote',
+                        {"id": target, "rating": rng.randint(1, 5)}, {'X-Listener-ID': lid})
+
+        if rng.random() < args.fetch_p:
+            url = current.get('media_url') if current else None
+            if not url:
+                item = rng.choice(library)
+                url = f"/media/{item['fp']}/{item['filename']}"
+            start = rng.randrange(max(1, args.media_size - args.range_size))
+            client.request('GET /media (range)', 'GET', url,
+                           headers={'Range': f"bytes={start}-{start + args.range_size - 1}"})
+
+        stop.wait(args.poll * rng.uniform(0.8, 1.2))
+    client.close()
+
+
+def multipart(fields, file_field, filename, blob):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                 f'Content-Type: audio/mpeg\r\n\r\n'.encode() + blob + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def admin(args, library, stats, measure_from, stop, seed):
+    rng = random.Random(seed)
+    client = Client(args.port, stats, measure_from)
+    ops = ['upload', 'reorder', 'schedule', 'library']
+    n = 0
+    while not stop.is_set():
+        op = ops[n % len(ops)]
+        n += 1
+        if op == 'upload':
+            body, ctype = multipart({'category': rng.choice(CATEGORIES)}, 'file',
+                                    f"bench-upload-{uuid.uuid4().hex[:8]}.mp3", rng.randbytes(args.media_size))
+            client.request('POST /api/upload', 'POST', '/api/upload', body, {'Content-Type': ctype})
+        elif op == 'reorder':
+            # Queue a few tracks, then shuffle the queue
+            for item in rng.sample(library, 3):
+                client.json('POST /api/queue/add', 'POST', '/api/queue/add', {"id": item['id']})
+            status, _, body = client.request('GET /api/status', 'GET', '/api/status')
+            try:
+                queue = [q['id'] for q in json.loads(body).get('queue', [])] if status == 200 else []
+            except ValueError:
+                queue = []
+            rng.shuffle(queue)
+            client.json('POST /api/queue/reorder', 'POST', '/api/queue/reorder', {"order": queue})
+        elif op == 'schedule':
+            item = rng.choice(library)
+            run_at = time.time() + rng.uniform(3600, 7 * 86400)
+            client.json('POST /api/schedule/add', 'POST', '/api/schedule/add', {"id": item['id'], "run_at": run_at})
+            status, _, body = client.request('GET /api/schedule/list', 'GET', '/api/schedule/list')
+            try:
+                entries = json.loads(body) if status == 200 else []
+            except ValueError:
+                entries = []
+            if entries:
+                entry = rng.choice(entries)
+                client.json('POST /api/schedule/update', 'POST', '/api/schedule/update',
+                            {"id": entry['id'], "run_at": run_at + rng.uniform(60, 600)})
+                if len(entries) > 20:
+                    client.json('POST /api/schedule/remove', 'POST', '/api/schedule/remove',
+                                {"id": rng.choice(entries)['id']})
+        else:
+            client.request('GET /api/library', 'GET', '/api/library')
+        stop.wait(args.admin_interval)
+    client.close()
+
+
+def fetch_metrics(port):
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/metrics')
+        resp = conn.getresponse()
+        text = resp.read().decode('utf-8', 'replace')
+        conn.close()
+        return text if resp.status == 200 else None
+    except (OSError, http.client.HTTPException):
+        return None
+
+
+# --- Report ---
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(stats, seconds):
+    results = {}
+    for name in sorted(stats.samples):
+        values = sorted(stats.samples[name])
+        results[name] = {
+            "requests": len(values),
+            "errors": stats.errors.get(name, 0),
+            "statuses": {str(k): v for k, v in sorted(stats.statuses.get(name, {}).items())},
+            "rps": round(len(values) / seconds, 2) if seconds else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+    return results
+
+
+def print_table(results):
+    print(f"{'endpoint':<28}{'reqs':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<28}{r['requests']:>8}{r['errors']:>6}{r['rps']:>9.1f}"
+              f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}")
+
+
+def print_compare(results, path):
+    with open(path) as f:
+        old = json.load(f).get('endpoints', {})
+    print(f"\nCompared with {path}:")
+    print(f"{'endpoint':<28}{'rps':>10}{'Δ rps':>10}{'p95 ms':>10}{'Δ p95':>10}")
+    for name, r in results.items():
+        before = old.get(name)
+        if not before:
+            print(f"{name:<28}{r['rps']:>10.1f}{'new':>10}{r['p95_ms']:>10.1f}{'new':>10}")
+            continue
+        d_rps = (r['rps'] - before['rps']) / before['rps'] * 100 if before['rps'] else 0.0
+        d_p95 = (r['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+        print(f"{name:<28}{r['rps']:>10.1f}{d_rps:>+9.1f}%{r['p95_ms']:>10.1f}{d_p95:>+9.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP load test for Grace Radio")
+    parser.add_argument('--tracks', type=int, default=10000, help="synthetic library size")
+    parser.add_argument('--listeners', type=int, default=100, help="simulated listeners")
+    parser.add_argument('--duration', type=float, default=60, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument('--poll', type=float, default=5, help="seconds between a listener's status polls")
+    parser.add_argument('--vote-p', type=float, default=0.05, help="chance a listener votes per poll")
+    parser.add_argument('--fetch-p', type=float, default=0.2, help="chance a listener fetches a media range per poll")
+    parser.add_argument('--range-size', type=int, default=64 * 1024, help="bytes per media range request")
+    parser.add_argument('--admin-interval', type=float, default=1.0, help="seconds between admin actions")
+    parser.add_argument('--media-files', type=int, default=64, help="distinct media files behind the library")
+    parser.add_argument('--media-size', type=int, default=512 * 1024, help="bytes per media file")
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--with-ffmpeg', action='store_true', help="leave ffmpeg on the server's PATH")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help="results file (default benchmark-<time>.json)")
+    parser.add_argument('--compare', default=None, help="earlier results file to compare against")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary storage dir")
+    args = parser.parse_args()
+    args.range_size = max(1, min(args.range_size, args.media_size))
+
+    rng = random.Random(args.seed)
+    storage_dir = tempfile.mkdtemp(prefix='grace-bench-')
+    print(f"Seeding {args.tracks} tracks in {storage_dir}")
+    library = seed_storage(storage_dir, args.tracks, args.media_files, args.media_size, rng)
+
+    print(f"Starting {args.server} on port {args.port}")
+    started = time.time()
+    proc = start_server(args, storage_dir)
+    print(f"Server ready in {time.time() - started:.1f}s")
+
+    stop = threading.Event()
+    measure_from = time.time() + args.warmup
+    thread_stats = []
+    threads = []
+    for i in range(args.listeners):
+        stats = Stats()
+        thread_stats.append(stats)
+        threads.append(threading.Thread(target=listener, args=(args, library, stats, measure_from, stop, rng.random()),
+                                        daemon=True))
+    stats = Stats()
+    thread_stats.append(stats)
+    threads.append(threading.Thread(target=admin, args=(args, library, stats, measure_from, stop, rng.random()),
+                                    daemon=True))
+
+    try:
+        for t in threads:
+            t.start()
+        print(f"Running {args.listeners} listeners + admin: {args.warmup:g}s warmup, {args.duration:g}s measured")
+        time.sleep(args.warmup + args.duration)
+        stop.set()
+        for t in threads:
+            t.join(timeout=35)
+        metrics = fetch_metrics(args.port)
+    finally:
+        stop.set()
+        stop_server(proc)
+        if args.keep:
+            print(f"Storage kept in {storage_dir}")
+        else:
+            shutil.rmtree(storage_dir, ignore_errors=True)
+
+    merged = Stats()
+    for s in thread_stats:
+        merged.merge(s)
+    results = summarize(merged, args.duration)
+    print()
+    print_table(results)
+
+    config = {k: v for k, v in vars(args).items() if k not in ('out', 'compare', 'keep')}
+    report = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "config": config,
+        "endpoints": results,
+        "metrics": metrics,
+    }
+    out = args.out or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {out}")
+
+    if args.compare:
+        print_compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -273,12 +273,78 @@ function getListenerId() {
     return id;
 }
 
+// --- Status Channel ---
+// Prefer the /api/events push stream (server only sends when something changes).
+// Fall back to polling /api/status if EventSource is missing or the server refuses it.
+let lastStatus = null;   // Last payload received
+let lastStatusAt = 0;    // Local ms timestamp when it arrived
+let lastStatusEtag = null;
+let statusStream = null;
+let pollTimer = null;
+const POLL_INTERVAL = 1000;
+const STREAM_RETRY = 30000;
+
+// One-shot refresh (used after local actions like vote / remove / track end)
 async function updateStatus() {
     try {
-        const res = await fetch('/api/status?t=' + Date.now(), {
-            headers: { 'X-Listener-ID': getListenerId() }
-        });
+        const headers = { 'X-Listener-ID': getListenerId() };
+        // Track end forces a full refresh (currentMediaId was cleared)
+        if (lastStatusEtag && currentMediaId !== null) headers['If-None-Match'] = lastStatusEtag;
+
+        const res = await fetch('/api/status', { headers, cache: 'no-store' });
+        if (res.status === 304) return; // Unchanged; localTick keeps extrapolating
+        lastStatusEtag = res.headers.get('ETag');
         const data = await res.json();
+        receiveStatus(data);
+    } catch (e) {
+        console.error(e);
+    }
+}
+
+function receiveStatus(data) {
+    lastStatus = data;
+    lastStatusAt = Date.now();
+    serverTimeOffset = Date.now() / 1000 - data.server_time;
+    applyStatus(data, data.elapsed);
+}
+
+// Local clock: keeps progress, drift checks and auto-resume going between pushes
+function localTick() {
+    if (!lastStatus) return;
+    const elapsed = (lastStatus.elapsed || 0) + (Date.now() - lastStatusAt) / 1000;
+    applyStatus(lastStatus, elapsed);
+}
+
+function pollStatus() {
+    pollTimer = null;
+    if (statusStream) return;
+    updateStatus().finally(() => {
+        if (!statusStream && !pollTimer) pollTimer = setTimeout(pollStatus, POLL_INTERVAL);
+    });
+}
+
+function startStatusStream() {
+    if (!window.EventSource) {
+        pollStatus();
+        return;
+    }
+    const es = new EventSource('/api/events?lid=' + encodeURIComponent(getListenerId()));
+    statusStream = es;
+    es.addEventListener('status', (e) => {
+        try { receiveStatus(JSON.parse(e.data)); } catch (err) { console.error(err); }
+    });
+    es.onerror = () => {
+        if (es.readyState !== EventSource.CLOSED) return; // Browser reconnects by itself
+        // Refused (e.g. 503 at the stream limit): poll for a while, then try again
+        console.warn("Status stream closed. Falling back to polling.");
+        statusStream = null;
+        pollStatus();
+        setTimeout(startStatusStream, STREAM_RETRY);
+    };
+}
+
+function applyStatus(data, elapsed) {
+    try {
         const state = data.current_track;
         const queueList = data.queue || [];
         const listeners = data.listeners || 0;
@@ -290,7 +356,7 @@ async function updateStatus() {
         if (state) updateMediaSession(state);
 
         if (state && data.playing) {
-            state.elapsed = data.elapsed;
+            state.elapsed = elapsed;
             if (!userManuallyStopped) {
                 if (audioCtx.state === 'suspended') audioCtx.resume();
                 handleAudioSync(state);
@@ -303,8 +369,6 @@ async function updateStatus() {
 
     } catch (e) {
         console.error(e);
-    } finally {
-        setTimeout(updateStatus, 1000);
     }
 }
 
@@ -394,7 +458,7 @@ function updatePlayerUI(state, queueList, userVote) {
 
         // Update Art
         if (state.art) {
-            art.style.backgroundImage = `url('${state.art}')`;
+            art.style.backgroundImage = `url('${artUrl(state, 'm')}')`;
             art.style.backgroundSize = 'cover';
             art.style.backgroundPosition = 'center';
             initials.style.display = 'none';
@@ -440,13 +504,28 @@ function updatePlayerUI(state, queueList, userVote) {
     }
 }
 
+// Resized art variant for a surface: 's' thumbnail, 'm' player, 'l' lock screen
+function artUrl(item, variant) {
+    if (item.art_id) return `/art/${item.art_id}-${variant}`;
+    if (item.art && item.art.startsWith('/api/art/')) return `${item.art}?v=${variant}`;
+    return item.art || null;
+}
+
 function updateMediaSession(state) {
     if ('mediaSession' in navigator) {
+        const artwork = [];
+        if (state.art_id) {
+            [['s', '128x128'], ['m', '512x512'], ['l', '1024x1024']].forEach(([v, sizes]) => {
+                artwork.push({ src: artUrl(state, v), sizes });
+            });
+        } else if (state.art) {
+            artwork.push({ src: artUrl(state, 'l') });
+        }
         navigator.mediaSession.metadata = new MediaMetadata({
             title: state.title || "Grace Radio",
             artist: state.category || "Live Broadcast",
             album: "Grace Radio",
-            artwork: []
+            artwork
         });
     }
 }
@@ -470,6 +549,12 @@ window.removeFromQueue = async function (event, id) {
     }
 }
 
+// Per-track level: manual volume times the loudness gain measured at ingest
+function trackPreAmp(state) {
+    const volume = (state.volume !== undefined && state.volume !== null) ? state.volume : 1.0;
+    return volume * (state.gain || 1.0);
+}
+
 function handleAudioSync(state) {
     if (userManuallyStopped) return; // Block auto-play if user stopped
     if (!userInteracted || !decks.length) return;
@@ -502,9 +587,8 @@ function handleAudioSync(state) {
         activeDeckIndex = (activeDeckIndex + 1) % 2;
         const nextDeck = decks[activeDeckIndex];
 
-        // Prepare URL
-        let url = `/static/media/${state.filename.replace(/\\/g, '/')}`;
-        if (url.indexOf('?') === -1) url += '?t=' + Date.now();
+        // Prepare URL (fingerprinted, so the browser can cache it and range-seek)
+        const url = state.media_url || `/static/media/${state.filename.replace(/\\/g, '/')}`;
 
         // Logic for Trim
         const trimStart = state.trim_start || 0;
@@ -534,8 +618,9 @@ function handleAudioSync(state) {
         // Attempt Immediate Seek (for cached files)
         nextDeck.el.currentTime = targetTime;
 
+        nextDeck.trackGain = state.gain || 1.0;
         if (nextDeck.preAmp) {
-            nextDeck.preAmp.gain.value = (state.volume !== undefined && state.volume !== null) ? state.volume : 1.0;
+            nextDeck.preAmp.gain.value = trackPreAmp(state);
         }
 
         // CROSSFADE LOGIC
@@ -580,8 +665,9 @@ function handleAudioSync(state) {
         if (deck) {
             deck.trimStart = state.trim_start || 0;
             deck.trimEnd = state.trim_end || state.duration;
-            if (state.volume !== undefined && deck.preAmp) {
-                deck.preAmp.gain.value = state.volume;
+            deck.trackGain = state.gain || 1.0;
+            if (deck.preAmp) {
+                deck.preAmp.gain.value = trackPreAmp(state);
             }
             if (state.lyrics !== undefined) {
                 const raw = state.lyrics || "";
@@ -608,15 +694,16 @@ function handleAudioSync(state) {
     }
 
     // Apply Live EQ (Always, for listeners if supported)
-    const deck = decks[activeDeckIndex];
-    if (deck && deck.low && deck.mid && deck.high) {
+    // Re-read: a crossfade above may have switched the active deck
+    const eqDeck = decks[activeDeckIndex];
+    if (eqDeck && eqDeck.low && eqDeck.mid && eqDeck.high) {
         const eq = state.eq || { low: 0, mid: 0, high: 0 };
         const safeVal = (v) => Math.max(-10, Math.min(10, v || 0));
         const now = audioCtx.currentTime;
         // setTargetAtTime avoids clicks
-        deck.low.gain.setTargetAtTime(safeVal(eq.low), now, 0.2);
-        deck.mid.gain.setTargetAtTime(safeVal(eq.mid), now, 0.2);
-        deck.high.gain.setTargetAtTime(safeVal(eq.high), now, 0.2);
+        eqDeck.low.gain.setTargetAtTime(safeVal(eq.low), now, 0.2);
+        eqDeck.mid.gain.setTargetAtTime(safeVal(eq.mid), now, 0.2);
+        eqDeck.high.gain.setTargetAtTime(safeVal(eq.high), now, 0.2);
     }
 }
 
@@ -636,7 +723,8 @@ function openEQModal() {
         document.getElementById('eq-mid').value = deck.mid.gain.value;
         document.getElementById('eq-high').value = deck.high.gain.value;
         if (deck.preAmp) {
-            document.getElementById('eq-vol').value = deck.preAmp.gain.value;
+            // Slider edits the manual volume; the loudness gain stays applied
+            document.getElementById('eq-vol').value = deck.preAmp.gain.value / (deck.trackGain || 1.0);
         } else {
             document.getElementById('eq-vol').value = 1.0;
         }
@@ -680,7 +768,7 @@ function updateEQLabels() {
             deck.high.gain.value = high;
         }
         if (deck.preAmp) {
-            deck.preAmp.gain.value = vol;
+            deck.preAmp.gain.value = vol * (deck.trackGain || 1.0);
         }
     }
 }
@@ -934,9 +1022,11 @@ document.getElementById('upload-form').onsubmit = async (e) => {
             body: fd
         });
         if (res.ok) {
+            const items = await res.json();
+            const dupes = items.filter(i => i.duplicate).length;
             closeUploadModal();
             fetchLibrary();
-            alert("Uploaded successfully!");
+            alert(dupes ? `Uploaded ${items.length - dupes} file(s); ${dupes} already in the library.` : "Uploaded successfully!");
         } else {
             alert("Upload failed");
         }
@@ -1010,18 +1100,23 @@ document.getElementById('schedule-form').onsubmit = async (e) => {
     alert("Schedule Updated!");
 };
 
-async function fetchSchedule() {
+const SCHEDULE_PAGE = 200;
+let scheduleOffset = 0;
+
+async function fetchSchedule(more = false) {
     try {
-        const res = await fetch('/api/schedule/list');
+        scheduleOffset = more ? scheduleOffset + SCHEDULE_PAGE : 0;
+        const res = await fetch(`/api/schedule/list?offset=${scheduleOffset}&limit=${SCHEDULE_PAGE}`);
         const data = await res.json();
+        const total = parseInt(res.headers.get('X-Total-Count') || data.length, 10);
 
         const div = document.getElementById('schedule-list');
-        if (data.length === 0) {
+        if (!more && data.length === 0) {
             div.innerHTML = "<p class='empty-state'>No upcoming broadcasts scheduled.</p>";
             return;
         }
 
-        div.innerHTML = data.map(item => {
+        const html = data.map(item => {
             const date = new Date(item.run_at * 1000).toLocaleString();
             return `
             <div class="media-card" style="display:flex; justify-content:space-between; align-items:center;">
@@ -1037,6 +1132,16 @@ async function fetchSchedule() {
             </div>
             `;
         }).join('');
+
+        const oldMore = document.getElementById('schedule-more');
+        if (oldMore) oldMore.remove();
+        if (more) div.insertAdjacentHTML('beforeend', html);
+        else div.innerHTML = html;
+
+        if (scheduleOffset + data.length < total) {
+            div.insertAdjacentHTML('beforeend',
+                `<button id="schedule-more" class="btn-card" onclick="fetchSchedule(true)">Load more (${total - scheduleOffset - data.length} left)</button>`);
+        }
     } catch (e) { console.error(e); }
 }
 
@@ -1052,8 +1157,9 @@ async function removeScheduleItem(id) {
 
 
 // --- Init ---
-setInterval(updateStatus, 1000);
 updateStatus();
+startStatusStream();
+setInterval(localTick, 1000);
 
 // --- YouTube ---
 function openYoutubeModal() {
@@ -1085,7 +1191,7 @@ if (ytForm) {
             if (res.ok) {
                 closeYoutubeModal();
                 const d = await res.json();
-                if (res.status === 202) {
+                if (res.status === 202 || d.status === 'duplicate') {
                     alert(d.message || "Download started in background.");
                 } else {
                     alert("Imported successfully!");
@@ -1155,7 +1261,7 @@ function openEditModal(item) {
         if (artInput) artInput.value = ""; // Reset file
 
         if (item.art) {
-            preview.innerHTML = `<img src="${item.art}" style="height:50px; border-radius:4px;"> <span style="font-size:0.8em; color:#aaa;">Current Art</span>`;
+            preview.innerHTML = `<img src="${artUrl(item, 's')}" style="height:50px; border-radius:4px;"> <span style="font-size:0.8em; color:#aaa;">Current Art</span>`;
         } else {
             preview.innerHTML = ``;
         }